@@ -75,6 +75,55 @@ def args(parser: configargparse.ArgParser):
                              'Default: 8192 for models with multi-query attention (based on Llama 2, Falcon), 2048 for others')
     parser.add_argument('--max_chunk_size_bytes', type=int, default=256 * 1024 * 1024,
                         help='Maximum size of activation tensor processed in one go; larger tensors are split into chunks')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Benchmark this device at startup (once, the results are cached with the throughput) '
+                             'to choose the max number of tokens in inference steps processed by the whole span at '
+                             'once and the chunk size for long prefixes (never larger than --max_chunk_size_bytes)')
+    parser.add_argument('--max_backward_activation_bytes', type=int, default=0,
+                        help='Backward passes keep activations of the whole span up to this size to avoid recomputing '
+                             'forward passes; larger requests are split or fall back to recomputation. This memory '
+                             'is reserved in addition to the blocks, so it makes sense only for servers used for '
+                             'fine-tuning (e.g., 512 MiB). Default: 0 (disabled)')
+    parser.add_argument('--activation_cache_bytes', type=int, default=0,
+                        help='Keep block inputs computed in rpc_forward up to this total size, so that the following '
+                             'rpc_backward for the same training step does not recompute them. This memory is '
+                             'reserved in addition to the blocks and helps only clients that fine-tune models, '
+                             'so enable it (e.g., 256 MiB) only on servers used for training. Default: 0 (disabled)')
+    parser.add_argument('--activation_cache_timeout', type=float, default=60,
+                        help='Timeout (in seconds) after which unused activations are evicted from the activation cache')
+    parser.add_argument('--expert_cache_bytes', type=int, default=None,
+                        help='Mixtral only (CPU servers): keep expert weights memory-mapped from the checkpoint files '
+                             'and hold only recently used experts in RAM, up to this total size. '
+                             'Default: load all experts into RAM')
+    parser.add_argument('--compile', dest='torch_compile', action='store_true',
+                        help='Run forward and inference steps of blocks with torch.compile. Inputs are padded to '
+                             'a fixed set of shapes that are compiled when the server starts, compiled kernels are '
+                             'cached in --cache_dir, so restarts are faster. Not supported with tensor parallelism')
+    parser.add_argument('--cache_converted_blocks', action='store_true',
+                        help='Save blocks converted to --torch_dtype and --quant_type to --cache_dir, so that '
+                             'restarts load them directly instead of converting them again. With --quant_type none, '
+                             'CPU servers on the same host with the same --cache_dir also share memory of the blocks '
+                             'they both serve. Supported for --quant_type none and cpu_int8 without tensor parallelism')
+    parser.add_argument('--share_block_weights', action='store_true',
+                        help='Let other servers download weights of blocks from this server\'s --cache_dir '
+                             '(original ones or, with --cache_converted_blocks, converted ones)')
+    parser.add_argument('--fetch_block_weights', action='store_true',
+                        help='Try to download blocks from servers with --share_block_weights before downloading them '
+                             'from the HF Hub. Requires --trusted_weight_peers or --allow_untrusted_weight_peers')
+    parser.add_argument('--trusted_weight_peers', type=str, nargs='*', default=[],
+                        help='With --fetch_block_weights, download blocks only from these peer IDs and trust them '
+                             'without comparing hashes with other peers (e.g., your own servers in a private swarm)')
+    parser.add_argument('--allow_untrusted_weight_peers', action='store_true',
+                        help='With --fetch_block_weights, download blocks from any peers if several of them report '
+                             'the same hash. UNSAFE in public swarms: one operator may run several malicious peers')
+    parser.add_argument('--standby_cache_bytes', type=int, default=None,
+                        help='If set, keep up to this many bytes of blocks that the server would likely move to after '
+                             'rebalancing (the best span for it and the blocks next to its current span) in RAM, '
+                             'so that moving to them does not need reading and converting their weights')
+    parser.add_argument('--num_loading_workers', type=int, default=2,
+                        help='The number of threads that read the next blocks (and cast them to --torch_dtype) while '
+                             'the server converts the current one. Each of them may hold an extra block in RAM. '
+                             'The server starts serving the first blocks before the others are loaded')
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 16384 for models with multi-query attention (based on Llama 2, Falcon), 4096 for others')
@@ -110,6 +159,10 @@ def args(parser: configargparse.ArgParser):
                              'on the first run and uses these estimates for future runs. '
                              'If set to "eval", the script re-evaluates the throughput and overrides the cache. '
                              'If set to "dry_run", the script re-evaluates the throughput and exits.')
+    parser.add_argument('--profile_inference', action='store_true',
+                        help='Also measure inference step times for several batch sizes and prefix lengths '
+                             '(once, the results are cached with the throughput) and announce how the step time grows '
+                             'with them, so that clients can estimate the cost of their requests on this server')
     parser.add_argument('--update_period', type=float, required=False, default=120,
                         help='Server will report blocks to DHT once in this many seconds')
     parser.add_argument('--expiration', type=float, required=False, default=None,
@@ -147,6 +200,7 @@ def args(parser: configargparse.ArgParser):
     parser.add_argument('--quant_type', type=str, default=None, choices=[choice.name.lower() for choice in QuantType],
                         help="Quantize blocks to 8-bit (int8 from the LLM.int8() paper) or "
                              "4-bit (nf4 from the QLoRA paper) formats to save GPU memory. "
+                             "On CPU, use 'cpu_int8' (8-bit weights with dynamically quantized inputs) to save RAM. "
                              "Default: 'int8' if GPU is available, 'none' otherwise")
     parser.add_argument("--tensor_parallel_devices", nargs='+', default=None,
                         help=
@@ -161,6 +215,16 @@ def args(parser: configargparse.ArgParser):
     parser.add_argument("--adapters", nargs='*', default=(),
                         help="List of pre-loaded LoRA adapters that can be used for inference or training")
 
+    parser.add_argument('--max_hot_adapters', type=int, default=None,
+                        help="If specified, load other LoRA adapters requested by clients on demand "
+                             "(if they are present in the local HF cache), keeping at most this many of them "
+                             "in addition to --adapters and unloading the least recently used ones")
+
+    parser.add_argument('--merge_adapter', action='store_true',
+                        help="Fold the only adapter from --adapters into base weights, so that inference with it "
+                             "runs as fast as with the base model. The server will reject requests without this "
+                             "adapter, and clients will use other servers for them. Requires --quant_type none")
+
 
 def main(args: argparse.Namespace):
     # fmt:on
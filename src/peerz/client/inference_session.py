@@ -299,7 +299,7 @@ class InferenceSession:
                 server_session = None
                 try:
                     if not self._server_sessions or attempt_no >= 1:
-                        self._update_sequence(server_idx, block_idx, attempt_no)
+                        self._update_sequence(server_idx, block_idx, attempt_no, batch_size=inputs.shape[0])
 
                     server_session = self._server_sessions[server_idx]
                     inputs = server_session.step(
@@ -329,7 +329,7 @@ class InferenceSession:
         outputs = outputs.to(device=inputs_device, dtype=inputs_dtype)
         return outputs
 
-    def _update_sequence(self, server_idx: int, block_idx: int, attempt_no: int) -> int:
+    def _update_sequence(self, server_idx: int, block_idx: int, attempt_no: int, *, batch_size: int) -> int:
         # If there is a failed server session, this code closes it
         self._exit_server_sessions(self._server_sessions[server_idx : server_idx + 1])
 
@@ -342,7 +342,7 @@ class InferenceSession:
             )
 
         updated_spans = self._sequence_manager.make_sequence(
-            block_idx, update_end, mode="min_latency", cache_tokens_needed=self._max_length
+            block_idx, update_end, mode="min_latency", cache_tokens_needed=self._max_length, batch_size=batch_size
         )
         # make_sequence() could return a longer sequence
         updated_spans[-1].end = min(updated_spans[-1].end, update_end)
@@ -8,6 +8,7 @@ import random
 import threading
 import time
 import warnings
+from functools import partial
 from typing import Any, Dict, List, Optional, Sequence, Set, Union
 from weakref import WeakMethod
 
@@ -22,7 +23,7 @@ from hivemind.utils.logging import get_logger
 from peerz.client.config import ClientConfig
 from peerz.client.routing.sequence_info import RemoteSequenceInfo
 from peerz.client.routing.spending_policy import NoSpendingPolicy
-from peerz.data_structures import ModuleUID, RemoteSpanInfo, ServerState
+from peerz.data_structures import ModuleUID, RemoteSpanInfo, ServerInfo, ServerState
 from peerz.server.handler import TransformerConnectionHandler
 from peerz.utils.dht import get_remote_module_infos
 from peerz.utils.ping import PingAggregator
@@ -142,6 +143,7 @@ class RemoteSequenceManager:
         *,
         mode: str,
         cache_tokens_needed: Optional[int] = None,
+        batch_size: int = 1,
     ) -> List[RemoteSpanInfo]:
         """
         Form a sequence of remote servers that collectively serve all consecutive layers
@@ -149,6 +151,7 @@ class RemoteSequenceManager:
         :param start_index: optional index of the first module in a sequence, default = the first of block_uids
         :param end_index: optional index of the last module (non-inclusive), default = after last of block uids
         :param mode: one of ["max_throughput", "min_latency"]
+        :param batch_size: the number of sequences processed in inference steps (used in "min_latency" mode)
         """
         with self._thread_start_lock:
             if not self.is_alive():
@@ -160,7 +163,7 @@ class RemoteSequenceManager:
 
         if mode == "min_latency":
             span_sequence = self._make_sequence_with_min_latency(
-                start_index, end_index, cache_tokens_needed=cache_tokens_needed
+                start_index, end_index, cache_tokens_needed=cache_tokens_needed, batch_size=batch_size
             )
         elif mode == "max_throughput":
             span_sequence = self._make_sequence_with_max_throughput(start_index, end_index)
@@ -175,7 +178,7 @@ class RemoteSequenceManager:
         return span_sequence
 
     def _make_sequence_with_min_latency(
-        self, start_index: int, end_index: int, *, cache_tokens_needed: Optional[int]
+        self, start_index: int, end_index: int, *, cache_tokens_needed: Optional[int], batch_size: int = 1
     ) -> List[RemoteSpanInfo]:
         if start_index == end_index:
             return []
@@ -194,7 +197,9 @@ class RemoteSequenceManager:
                 for span in self.state.sequence_info.spans_containing_block[block_idx]
             }
 
-            graph = self._build_inference_graph(start_index, end_index, cache_tokens_needed=cache_tokens_needed)
+            graph = self._build_inference_graph(
+                start_index, end_index, cache_tokens_needed=cache_tokens_needed, batch_size=batch_size
+            )
 
         path = dijkstar.find_path(graph, "start", "end")
         logger.debug(f"Path info: {path}")
@@ -220,6 +225,7 @@ class RemoteSequenceManager:
         end_index: int,
         *,
         cache_tokens_needed: Optional[int],
+        batch_size: int = 1,
         overhead_delay: float = 0.018,  # Serialization overhead (empirically measured)
         default_inference_rps: float = 300,  # If inference RPS unknown
         alloc_delay: float = 10,  # If not enough cache left, we penalize the edge
@@ -268,12 +274,23 @@ class RemoteSequenceManager:
                     graph.add_edge((cur_span.peer_id, block_idx), (next_span.peer_id, block_idx), delay)
 
         # Compute delays
+        # On average, steps of a session use a half of its max length (cache_tokens_needed) as the prefix
+        mean_prefix_length = cache_tokens_needed // 2 if cache_tokens_needed is not None else 0
+        step_time_growth = self._estimate_step_time_growth(
+            [span.server_info for span in self.state.sequence_info.spans_by_priority],
+            batch_size=batch_size,
+            prefix_length=mean_prefix_length,
+        )
         for span in self.state.sequence_info.spans_by_priority:
+            step_time = self._estimate_step_time(
+                span.server_info,
+                batch_size=batch_size,
+                prefix_length=mean_prefix_length,
+                default_inference_rps=default_inference_rps,
+                step_time_growth=step_time_growth,
+            )
             for block_idx in range(max(span.start, start_index), min(span.end, end_index)):
-                inference_rps = span.server_info.inference_rps
-                if inference_rps is None:
-                    inference_rps = default_inference_rps
-                graph.add_edge((span.peer_id, block_idx), (span.peer_id, block_idx + 1), 1.0 / inference_rps)
+                graph.add_edge((span.peer_id, block_idx), (span.peer_id, block_idx + 1), step_time)
 
         return graph
 
@@ -288,6 +305,55 @@ class RemoteSequenceManager:
             return default_delay
         return min(rtt / 2, max_delay)
 
+    @staticmethod
+    def _estimate_step_time(
+        server_info: ServerInfo,
+        *,
+        batch_size: int,
+        prefix_length: int,
+        default_inference_rps: float,
+        step_time_growth: float = 1.0,
+    ) -> float:
+        """
+        Estimate the time of an inference step (one new token per sequence) through one block of a server.
+        Servers without an inference profile are assumed to take :step_time_growth: times longer than their
+        inference_rps suggests (it is measured for one sequence without a prefix), see _estimate_step_time_growth()
+        """
+        profile = server_info.inference_profile
+        if profile is not None:
+            return RemoteSequenceManager._get_profiled_step_time(
+                profile, batch_size=batch_size, prefix_length=prefix_length
+            )
+        inference_rps = server_info.inference_rps
+        if inference_rps is None:
+            inference_rps = default_inference_rps
+        return step_time_growth / inference_rps
+
+    @staticmethod
+    def _estimate_step_time_growth(server_infos: Sequence[ServerInfo], *, batch_size: int, prefix_length: int) -> float:
+        """
+        Estimate how many times a step with :batch_size: and :prefix_length: is longer than a step with one sequence
+        without a prefix, on average over servers with inference profiles (so that the step times of servers with and
+        without profiles are comparable). Returns 1.0 if no servers have profiles
+        """
+        growths = []
+        for server_info in server_infos:
+            if server_info.inference_profile is None:
+                continue
+            get_step_time = partial(RemoteSequenceManager._get_profiled_step_time, server_info.inference_profile)
+            base_step_time = get_step_time(batch_size=1, prefix_length=0)
+            if base_step_time > 0:
+                growths.append(get_step_time(batch_size=batch_size, prefix_length=prefix_length) / base_step_time)
+        return float(np.mean(growths)) if growths else 1.0
+
+    @staticmethod
+    def _get_profiled_step_time(profile: Dict[str, float], *, batch_size: int, prefix_length: int) -> float:
+        return (
+            profile.get("base", 0)
+            + profile.get("per_new_token", 0) * batch_size
+            + profile.get("per_cached_token", 0) * batch_size * prefix_length
+        )
+
     @staticmethod
     def _has_cache_for(span: RemoteSpanInfo, cache_tokens_needed: Optional[int] = None) -> bool:
         if cache_tokens_needed is None or span.server_info.cache_tokens_left is None:
@@ -351,6 +417,7 @@ class RemoteSequenceManager:
                 for peer_id, server_info in block_info.servers.items()
                 if (self.allowed_servers is None or peer_id in self.allowed_servers)
                 and (self.blocked_servers is None or peer_id not in self.blocked_servers)
+                and (server_info.merged_adapter is None or server_info.merged_adapter == self.config.active_adapter)
             }
 
             # Remove temporarily banned peers, unless there are no peers left
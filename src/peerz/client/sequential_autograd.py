@@ -3,6 +3,7 @@ A PyTorch autograd function that runs forward/backward on a sequence of remote s
 """
 import asyncio
 import itertools
+import uuid
 from collections import deque
 from typing import List, Optional, Sequence, Tuple
 
@@ -29,11 +30,15 @@ async def sequential_forward(
     sequence_manager: RemoteSequenceManager,
     start_index: int = 0,
     end_index: Optional[int] = None,
+    step_id: Optional[str] = None,
 ) -> Tuple[torch.Tensor, Sequence[torch.Tensor], Sequence[RemoteSpanInfo]]:
     """
     Constructs a routing path from <start_index> to <end_index>.
     Performs chained forward for each subsequence of blocks on the path.
     If some subsequence fails, reconstructs the remaining path and tries to finish the forward.
+
+    If step_id is specified, servers may keep activations for this step, so that sequential_backward
+    with the same step_id does not need to recompute them.
     """
 
     assert isinstance(inputs, torch.Tensor) and inputs.ndim == 3, f"{type(inputs)}: {inputs.ndim}"
@@ -74,6 +79,8 @@ async def sequential_forward(
                 metadata = sequence_manager.get_request_metadata(
                     "rpc_forward", args_structure, span_uids, *flat_tensors
                 )
+                if step_id is not None:
+                    metadata["step_id"] = step_id
                 (outputs,) = await run_remote_forward(
                     span_uids,
                     stub,
@@ -116,6 +123,7 @@ async def sequential_backward(
     prompts: torch.Tensor,
     forward_sequences: List[RemoteSpanInfo],
     sequence_manager: RemoteSequenceManager,
+    step_id: Optional[str] = None,
 ) -> Tuple[Sequence[torch.Tensor], torch.Tensor]:
     """
     Performs chained backward for each forward subsequence.
@@ -141,7 +149,12 @@ async def sequential_backward(
             try:
                 if attempt_no >= 1:
                     _, backup_inputs, backup_sequences = await sequential_forward(
-                        inputs, prompts, sequence_manager, start_index=span.start, end_index=span.end
+                        inputs,
+                        prompts,
+                        sequence_manager,
+                        start_index=span.start,
+                        end_index=span.end,
+                        step_id=step_id,
                     )
                     assert len(backup_inputs) == len(backup_sequences)
                     assert backup_sequences[0].start == span.start
@@ -162,6 +175,8 @@ async def sequential_backward(
                 metadata = sequence_manager.get_request_metadata(
                     "rpc_backward", args_structure, span_uids, *flat_tensors, peer_id=span.peer_id
                 )
+                if step_id is not None:
+                    metadata["step_id"] = step_id
                 grad_outputs, *span_grad_prompts = await run_remote_backward(
                     span_uids,
                     stub,
@@ -196,25 +211,25 @@ async def sequential_backward(
     return grad_outputs, grad_prompts
 
 
-async def _gather_forward(input_batches, prompt_batches, sequence_manager):
+async def _gather_forward(input_batches, prompt_batches, sequence_manager, step_ids):
     """Wrapper for asyncio.gather to perform parallel sequential forwards"""
     return await asyncio.gather(
         *[
-            sequential_forward(input_batch, prompt_batch, sequence_manager)
-            for input_batch, prompt_batch in zip(input_batches, prompt_batches)
+            sequential_forward(input_batch, prompt_batch, sequence_manager, step_id=step_id)
+            for input_batch, prompt_batch, step_id in zip(input_batches, prompt_batches, step_ids)
         ]
     )
 
 
 async def _gather_backward(
-    grad_output_batches, intermediate_input_batches, prompt_batches, forward_sequences, sequence_manager
+    grad_output_batches, intermediate_input_batches, prompt_batches, forward_sequences, sequence_manager, step_ids
 ):
     """Wrapper for asyncio.gather to perform parallel sequential backwards"""
     return await asyncio.gather(
         *[
-            sequential_backward((grad_output,), input_batch, prompt_batch, spans, sequence_manager)
-            for grad_output, input_batch, prompt_batch, spans in zip(
-                grad_output_batches, intermediate_input_batches, prompt_batches, forward_sequences
+            sequential_backward((grad_output,), input_batch, prompt_batch, spans, sequence_manager, step_id=step_id)
+            for grad_output, input_batch, prompt_batch, spans, step_id in zip(
+                grad_output_batches, intermediate_input_batches, prompt_batches, forward_sequences, step_ids
             )
         ]
     )
@@ -235,8 +250,14 @@ class _RemoteSequentialAutogradFunction(torch.autograd.Function):
         else:
             prompt_batches: Sequence[torch.Tensor] = prompts.detach().split(batch_size, dim=1)
 
+        # Tag each batch with a unique step id, so that servers can reuse forward activations during backward
+        needs_grad = any(ctx.needs_input_grad[:2])
+        step_ids = [uuid.uuid4().hex if needs_grad else None for _ in input_batches]
+
         sequence_manager.rpc_info  # lazy init
-        outputs = RemoteExpertWorker.run_coroutine(_gather_forward(input_batches, prompt_batches, sequence_manager))
+        outputs = RemoteExpertWorker.run_coroutine(
+            _gather_forward(input_batches, prompt_batches, sequence_manager, step_ids)
+        )
         assert len(outputs) == len(input_batches)
 
         output_batches = [output[0] for output in outputs]
@@ -247,6 +268,7 @@ class _RemoteSequentialAutogradFunction(torch.autograd.Function):
         ctx.sequence_manager = sequence_manager
         ctx.intemediate_input_batches = intemediate_input_batches
         ctx.sequences_for_batches = sequences_for_batches
+        ctx.step_ids = step_ids
         return torch.cat(output_batches, dim=0)
 
     @staticmethod
@@ -266,6 +288,7 @@ class _RemoteSequentialAutogradFunction(torch.autograd.Function):
                 ctx.prompt_batches,
                 forward_sequences,
                 ctx.sequence_manager,
+                ctx.step_ids,
             )
         )
         grad_input_batches = [output[0][0] for output in outputs]
@@ -1,6 +1,6 @@
 import dataclasses
 from enum import Enum
-from typing import Any, Dict, Optional, Sequence, Tuple
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 
 import pydantic
 from hivemind import PeerID
@@ -53,11 +53,15 @@ class ServerInfo:
     network_rps: Optional[RPS] = None
     forward_rps: Optional[RPS] = None
     inference_rps: Optional[RPS] = None
+    # Coefficients of the inference step time model fitted by summarize_inference_profile() (if measured)
+    inference_profile: Optional[Dict[str, pydantic.confloat(ge=0, strict=True)]] = None
 
     adapters: Sequence[str] = ()
+    merged_adapter: Optional[str] = None  # if set, the server serves only requests that use this adapter
     torch_dtype: Optional[str] = None
     quant_type: Optional[str] = None
     using_relay: Optional[bool] = None
+    shares_block_weights: Optional[bool] = None  # if True, other servers may download blocks from this one
     cache_tokens_left: Optional[pydantic.conint(ge=0, strict=True)] = None
     next_pings: Optional[Dict[str, pydantic.confloat(ge=0, strict=True)]] = None
 
@@ -114,4 +118,4 @@ class InferenceMetadata:
     uid: ExpertUID
     prefix_length: int
     cache_handles: Tuple[Handle, ...]
-    active_adapter: Optional[str]
+    active_adapter: Optional[Union[str, Tuple[str, ...]]]  # a tuple sets an adapter for each row of the batch
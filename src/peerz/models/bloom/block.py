@@ -6,13 +6,128 @@ See commit history for authorship.
 from typing import Optional, Tuple
 
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from transformers.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
-from transformers.models.bloom.modeling_bloom import BloomBlock, BloomModel, build_alibi_tensor
+from transformers.models.bloom.modeling_bloom import (
+    BloomAttention,
+    BloomBlock,
+    BloomConfig,
+    BloomMLP,
+    BloomModel,
+    LayerNorm,
+    build_alibi_tensor,
+    dropout_add,
+)
 
+from peerz.utils.kv_cache import update_kv_cache_inplace
 from peerz.utils.misc import is_dummy
 
 
+class OptimizedBloomAttention(BloomAttention):
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        residual: torch.Tensor,
+        alibi: torch.Tensor,
+        attention_mask: torch.Tensor,
+        layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        use_cache: bool = False,
+        output_attentions: bool = False,
+        kv_cache_position: Optional[int] = None,
+    ):
+        if kv_cache_position is None:
+            return super().forward(
+                hidden_states,
+                residual,
+                alibi,
+                attention_mask,
+                layer_past=layer_past,
+                head_mask=head_mask,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+            )
+        assert not output_attentions
+
+        fused_qkv = self.query_key_value(hidden_states)  # [batch_size, seq_length, 3 x hidden_size]
+
+        # 3 x [batch_size, seq_length, num_heads, head_dim]
+        (query_layer, key_layer, value_layer) = self._split_heads(fused_qkv)
+
+        batch_size, q_length, _, _ = query_layer.shape
+
+        query_layer = query_layer.transpose(1, 2).reshape(batch_size * self.num_heads, q_length, self.head_dim)
+
+        # write new keys/values into the preallocated cache and attend to its first kv_length tokens without copying
+        key_layer, value_layer = update_kv_cache_inplace(
+            *layer_past, key_layer.transpose(1, 2), value_layer.transpose(1, 2), kv_cache_position
+        )
+        key_layer = key_layer.transpose(-1, -2).flatten(0, 1)  # [batch_size * num_heads, head_dim, kv_length]
+        value_layer = value_layer.flatten(0, 1)  # [batch_size * num_heads, kv_length, head_dim]
+        _, _, kv_length = key_layer.shape
+
+        present = layer_past if use_cache else None
+
+        # [batch_size * num_heads, q_length, kv_length]
+        matmul_result = alibi.baddbmm(
+            batch1=query_layer,
+            batch2=key_layer,
+            beta=self.beta,
+            alpha=self.inv_norm_factor,
+        )
+
+        # change view to [batch_size, num_heads, q_length, kv_length]
+        attention_scores = matmul_result.view(batch_size, self.num_heads, q_length, kv_length)
+
+        # cast attention scores to fp32, compute scaled softmax and cast back to initial dtype
+        input_dtype = attention_scores.dtype
+        if input_dtype == torch.float16:
+            attention_scores = attention_scores.to(torch.float)
+        attn_weights = torch.masked_fill(attention_scores, attention_mask, torch.finfo(attention_scores.dtype).min)
+        attention_probs = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(input_dtype)
+        attention_probs = self.attention_dropout(attention_probs)
+
+        if head_mask is not None:
+            attention_probs = attention_probs * head_mask
+
+        # matmul: [batch_size * num_heads, q_length, head_dim]
+        attention_probs_reshaped = attention_probs.view(batch_size * self.num_heads, q_length, kv_length)
+        context_layer = torch.bmm(attention_probs_reshaped, value_layer)
+
+        # change view [batch_size, q_length, num_heads * head_dim]
+        context_layer = self._merge_heads(context_layer)
+
+        if self.pretraining_tp > 1 and self.slow_but_exact:
+            slices = self.hidden_size / self.pretraining_tp
+            output_tensor = torch.zeros_like(context_layer)
+            for i in range(self.pretraining_tp):
+                output_tensor = output_tensor + F.linear(
+                    context_layer[:, :, int(i * slices) : int((i + 1) * slices)],
+                    self.dense.weight[:, int(i * slices) : int((i + 1) * slices)],
+                )
+        else:
+            output_tensor = self.dense(context_layer)
+
+        output_tensor = dropout_add(output_tensor, residual, self.hidden_dropout, self.training)
+        return output_tensor, present
+
+
 class WrappedBloomBlock(BloomBlock):
+    def __init__(self, config: BloomConfig):
+        nn.Module.__init__(self)
+        hidden_size = config.hidden_size
+
+        self.input_layernorm = LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
+        self.num_heads = config.n_head
+        self.self_attention = OptimizedBloomAttention(config)
+        self.post_attention_layernorm = LayerNorm(hidden_size, eps=config.layer_norm_epsilon)
+
+        self.mlp = BloomMLP(config)
+
+        self.apply_residual_connection_post_layernorm = config.apply_residual_connection_post_layernorm
+        self.hidden_dropout = config.hidden_dropout
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -20,15 +135,22 @@ class WrappedBloomBlock(BloomBlock):
         attention_mask: Optional[torch.Tensor] = None,
         alibi: Optional[torch.Tensor] = None,
         layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        use_cache: bool = False,
+        kv_cache_position: Optional[int] = None,
         **kwargs
     ):
         assert attention_mask is None, "Non-causal attention masks are not supported yet"
         batch_size, seq_length = hidden_states.shape[:2]
-        if layer_past is not None and is_dummy(layer_past[0]):
-            # Bloom cannot use cache if it was misconsctructed(e.g. Dummy tensors)
-            # In this case, fallback to the old code:
-            layer_past = None
-        past_length = 0 if layer_past is None else layer_past[0].shape[-1]
+        if kv_cache_position is not None:
+            # layer_past holds preallocated caches, OptimizedBloomAttention writes new keys/values to them in-place
+            assert layer_past is not None, "kv_cache_position requires preallocated caches passed as layer_past"
+            past_length = kv_cache_position
+        else:
+            if layer_past is not None and is_dummy(layer_past[0]):
+                # Bloom cannot use cache if it was misconsctructed(e.g. Dummy tensors)
+                # In this case, fallback to the old code:
+                layer_past = None
+            past_length = 0 if layer_past is None else layer_past[0].shape[-1]
         seq_length_with_past = seq_length + past_length
         attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
         if alibi is None:
@@ -40,6 +162,32 @@ class WrappedBloomBlock(BloomBlock):
             past_key_values_length=past_length,
         )
         attention_mask = attention_mask.bool()
-        return super().forward(
-            hidden_states, *args, attention_mask=attention_mask, alibi=alibi, layer_past=layer_past, **kwargs
-        )
\ No newline at end of file
+        if kv_cache_position is None:
+            return super().forward(
+                hidden_states,
+                *args,
+                attention_mask=attention_mask,
+                alibi=alibi,
+                layer_past=layer_past,
+                use_cache=use_cache,
+                **kwargs,
+            )
+
+        # The same as BloomBlock.forward, but passes kv_cache_position to the attention layer
+        layernorm_output = self.input_layernorm(hidden_states)
+        residual = layernorm_output if self.apply_residual_connection_post_layernorm else hidden_states
+
+        attention_output, present = self.self_attention(
+            layernorm_output,
+            residual,
+            layer_past=layer_past,
+            attention_mask=attention_mask,
+            alibi=alibi,
+            use_cache=use_cache,
+            kv_cache_position=kv_cache_position,
+        )
+
+        layernorm_output = self.post_attention_layernorm(attention_output)
+        residual = layernorm_output if self.apply_residual_connection_post_layernorm else attention_output
+        output = self.mlp(layernorm_output, residual)
+        return (output, present) if use_cache else (output,)
@@ -16,13 +16,14 @@ from transformers.models.falcon.modeling_falcon import (
     FalconDecoderLayer,
     FalconLinear,
     FalconMLP,
-    FalconModel,
     LayerNorm,
     build_alibi_tensor,
     dropout_add,
     rotate_half,
 )
 
+from peerz.utils.kv_cache import causal_attention_with_past, update_kv_cache_inplace
+
 KVCache = Tuple[torch.Tensor, torch.Tensor]
 INFERENCE_MAX_LENGTH = 8192
 
@@ -175,11 +176,12 @@ class OptimizedFalconAttention(FalconAttention):
         self,
         hidden_states: torch.Tensor,
         alibi: Optional[torch.Tensor],
-        attention_mask: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
         layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         head_mask: Optional[torch.Tensor] = None,
         use_cache: bool = False,
         output_attentions: bool = False,
+        kv_cache_position: Optional[int] = None,
     ):
         assert not output_attentions
 
@@ -198,6 +200,11 @@ class OptimizedFalconAttention(FalconAttention):
 
         num_kv_heads = self.num_heads
         batch_size, query_length, _, _ = query_layer.shape
+        if kv_cache_position is not None:
+            # layer_past holds preallocated caches that store each key/value head only once, see peerz.utils.kv_cache
+            num_kv_heads = layer_past[0].shape[0] // batch_size
+            key_layer = key_layer[:, :, :: key_layer.shape[2] // num_kv_heads]
+            value_layer = value_layer[:, :, :: value_layer.shape[2] // num_kv_heads]
 
         query_layer = query_layer.transpose(1, 2).reshape(batch_size * self.num_heads, query_length, self.head_dim)
         key_layer = key_layer.transpose(1, 2).reshape(
@@ -207,10 +214,15 @@ class OptimizedFalconAttention(FalconAttention):
         )
         value_layer = value_layer.transpose(1, 2).reshape(batch_size * num_kv_heads, query_length, self.head_dim)
 
-        past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
+        if kv_cache_position is not None:
+            past_kv_length = kv_cache_position
+        else:
+            past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
         query_layer, key_layer = self.maybe_rotary(query_layer, key_layer, past_kv_length)
 
-        if layer_past is not None:
+        if kv_cache_position is not None:
+            key_layer, value_layer = update_kv_cache_inplace(*layer_past, key_layer, value_layer, kv_cache_position)
+        elif layer_past is not None:
             past_key, past_value = layer_past
             # concatenate along seq_length dimension:
             #  - key: [batch_size * self.num_heads, kv_length, head_dim]
@@ -220,7 +232,7 @@ class OptimizedFalconAttention(FalconAttention):
 
         _, kv_length, _ = key_layer.shape
         if use_cache:
-            present = (key_layer, value_layer)
+            present = layer_past if kv_cache_position is not None else (key_layer, value_layer)
         else:
             present = None
 
@@ -228,12 +240,23 @@ class OptimizedFalconAttention(FalconAttention):
         key_layer_ = key_layer.reshape(batch_size, num_kv_heads, -1, self.head_dim)
         value_layer_ = value_layer.reshape(batch_size, num_kv_heads, -1, self.head_dim)
 
-        attention_mask_float = (attention_mask * 1.0).masked_fill(attention_mask, float("-1e9")).to(query_layer.dtype)
+        if attention_mask is not None:
+            attention_mask_float = (attention_mask * 1.0).masked_fill(attention_mask, float("-1e9"))
+            attention_mask_float = attention_mask_float.to(query_layer.dtype)
 
         if alibi is None:
-            attn_output = F.scaled_dot_product_attention(
-                query_layer_, key_layer_, value_layer_, attn_mask=attention_mask_float, dropout_p=0.0, is_causal=False
-            )
+            if attention_mask is None:
+                # the attention is causal, so we can attend to the key/value heads in cache without repeating them
+                attn_output = causal_attention_with_past(query_layer_, key_layer_, value_layer_)
+            else:
+                attn_output = F.scaled_dot_product_attention(
+                    query_layer_,
+                    key_layer_,
+                    value_layer_,
+                    attn_mask=attention_mask_float,
+                    dropout_p=0.0,
+                    is_causal=False,
+                )
 
             attn_output = attn_output.view(batch_size, self.num_heads, query_length, self.head_dim)
             attn_output = attn_output.permute(0, 2, 1, 3)
@@ -243,6 +266,9 @@ class OptimizedFalconAttention(FalconAttention):
 
             return output_tensor, present
         else:
+            if num_kv_heads != self.num_heads:
+                key_layer_ = key_layer_.repeat_interleave(self.num_heads // num_kv_heads, dim=1)
+                value_layer_ = value_layer_.repeat_interleave(self.num_heads // num_kv_heads, dim=1)
             matmul_result = query_layer_ @ key_layer_.transpose(-1, -2)
 
             # change view to [batch_size, num_heads, q_length, kv_length]
@@ -340,11 +366,12 @@ class OptimizedFalconDecoderLayer(FalconDecoderLayer):
         self,
         hidden_states: torch.Tensor,
         alibi: Optional[torch.Tensor],
-        attention_mask: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
         layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         head_mask: Optional[torch.Tensor] = None,
         use_cache: bool = False,
         output_attentions: bool = False,
+        kv_cache_position: Optional[int] = None,
     ):
         residual = hidden_states
 
@@ -365,6 +392,7 @@ class OptimizedFalconDecoderLayer(FalconDecoderLayer):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
+            kv_cache_position=kv_cache_position,
         )
 
         attention_output = attn_outputs[0]
@@ -404,21 +432,29 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
         alibi: Optional[torch.Tensor] = None,
         layer_past: Optional[KVCache] = None,
         use_cache: bool = False,
+        kv_cache_position: Optional[int] = None,
         **kwargs,
     ):
         assert attention_mask is None
 
         batch_size, seq_length = hidden_states.shape[:2]
 
-        if layer_past is not None:
-            layer_past = self._reorder_cache_from_bloom_to_falcon(layer_past)
-        past_length = 0 if layer_past is None else layer_past[0].shape[1]
+        if kv_cache_position is not None:
+            # layer_past holds preallocated caches in bloom layout, attention writes new keys/values to them in-place
+            assert layer_past is not None, "kv_cache_position requires preallocated caches passed as layer_past"
+            past_length = kv_cache_position
+        else:
+            if layer_past is not None:
+                layer_past = self._reorder_cache_from_bloom_to_falcon(layer_past)
+            past_length = 0 if layer_past is None else layer_past[0].shape[1]
         seq_length_with_past = seq_length + past_length
 
-        attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
-        if alibi is None and self.config.alibi:
-            alibi = build_alibi_tensor(attention_mask, num_heads=self.num_heads, dtype=hidden_states.dtype)
-        attention_mask = FalconModel._prepare_attn_mask(attention_mask, (batch_size, seq_length), past_length)
+        if self.config.alibi:
+            if alibi is None:
+                attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
+                alibi = build_alibi_tensor(attention_mask, num_heads=self.num_heads, dtype=hidden_states.dtype)
+            attention_mask = _make_causal_mask(seq_length, past_length, device=hidden_states.device)
+        # otherwise, attention_mask=None tells OptimizedFalconAttention that attention is causal
 
         outputs = super().forward(
             hidden_states,
@@ -427,10 +463,11 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
             alibi=alibi,
             layer_past=layer_past,
             use_cache=use_cache,
+            kv_cache_position=kv_cache_position,
             **kwargs,
         )
 
-        if use_cache:
+        if use_cache and kv_cache_position is None:
             present_key_value = outputs[-1]
             present_key_value = self._reorder_cache_from_falcon_to_bloom(present_key_value)
             outputs = outputs[:-1] + (present_key_value,)
@@ -478,3 +515,9 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
         state = state[:, :, 0]
         state = state.view(batch_size * self.config.num_kv_heads, seq_len, head_dim)
         return state
+
+
+def _make_causal_mask(seq_length: int, past_length: int, device: torch.device) -> torch.Tensor:
+    """Create a boolean mask of shape [1, 1, seq_length, past_length + seq_length] where True marks masked tokens"""
+    mask = torch.ones(seq_length, past_length + seq_length, dtype=torch.bool, device=device).tril(past_length)
+    return ~mask[None, None]
@@ -22,6 +22,7 @@ from transformers.models.llama.modeling_llama import (
 )
 
 from peerz.utils.cuda_graphs import make_inference_graphed_callable
+from peerz.utils.kv_cache import causal_attention_with_past, update_kv_cache_inplace
 
 
 def apply_rotary_pos_emb(q, k, cos, sin):
@@ -34,6 +35,8 @@ class OptimizedLlamaAttention(LlamaAttention):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._rotary_graph = None
+        # Use F.scaled_dot_product_attention for causal attention unless the user explicitly asked for eager attention
+        self.use_sdpa = getattr(self.config, "_attn_implementation_internal", None) != "eager"
 
     def _optimized_apply_rotary(self, query_states, key_states, cos, sin):
         if self._rotary_graph is None:
@@ -51,10 +54,14 @@ class OptimizedLlamaAttention(LlamaAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        kv_cache_position: Optional[int] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         assert not output_attentions
-        if position_ids is None:
+        if kv_cache_position is not None:
+            past_seen_tokens = kv_cache_position  # past_key_value holds preallocated caches, see peerz.utils.kv_cache
+        else:
             past_seen_tokens = past_key_value[0].shape[2] if past_key_value is not None else 0
+        if position_ids is None:
             position_ids = torch.arange(
                 past_seen_tokens, past_seen_tokens + hidden_states.shape[1], device=hidden_states.device
             ).unsqueeze(0)
@@ -87,9 +94,7 @@ class OptimizedLlamaAttention(LlamaAttention):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
-        kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
+        kv_seq_len = past_seen_tokens + key_states.shape[-2]
         cos, sin = self.rotary_emb(value_states, position_ids, seq_len=kv_seq_len)
         cos, sin = cos.unsqueeze(1), sin.unsqueeze(1)
 
@@ -98,25 +103,25 @@ class OptimizedLlamaAttention(LlamaAttention):
         else:
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
-        if past_key_value is not None:
+        if kv_cache_position is not None:
+            # write new keys/values into the cache and attend to its first kv_seq_len tokens without copying them
+            key_states, value_states = update_kv_cache_inplace(
+                *past_key_value, key_states, value_states, past_seen_tokens
+            )
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
-
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
-
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
-
-        if attention_mask is not None:
-            attn_weights = attn_weights + attention_mask
+        if use_cache:
+            past_key_value = past_key_value if kv_cache_position is not None else (key_states, value_states)
+        else:
+            past_key_value = None
 
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+        if self.use_sdpa and attention_mask is None:
+            attn_output = causal_attention_with_past(query_states, key_states, value_states)
+        else:
+            attn_output = self._eager_attention(query_states, key_states, value_states, attention_mask)
 
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
@@ -130,6 +135,26 @@ class OptimizedLlamaAttention(LlamaAttention):
 
         return attn_output, None, past_key_value
 
+    def _eager_attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        # repeat k/v heads if n_kv_heads < n_heads
+        key_states = repeat_kv(key_states, self.num_key_value_groups)
+        value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+
+        if attention_mask is not None:
+            attn_weights = attn_weights + attention_mask
+
+        # upcast attention to fp32
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+        return torch.matmul(attn_weights, value_states)
+
 
 class OptimizedLlamaDecoderLayer(LlamaDecoderLayer):
     def __init__(self, config: LlamaConfig):
@@ -234,6 +259,7 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
         position_ids: Optional[torch.LongTensor] = None,
         layer_past: Optional[Tuple[torch.Tensor]] = None,
         use_cache: bool = False,
+        kv_cache_position: Optional[int] = None,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         batch_size, seq_length, _ = hidden_states.shape
@@ -242,7 +268,12 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
         past_key_values_length = 0
 
         past_key_value = layer_past
-        if past_key_value is not None:
+        if kv_cache_position is not None:
+            # layer_past holds preallocated caches in bloom layout, OptimizedLlamaAttention writes to them in-place
+            assert layer_past is not None, "kv_cache_position requires preallocated caches passed as layer_past"
+            past_key_values_length = kv_cache_position
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_value is not None:
             past_key_values_length = past_key_value[0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
             past_key_value = self._reorder_cache_from_bloom_to_llama(past_key_value, batch_size, past_key_values_length)
@@ -250,16 +281,19 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
         assert position_ids is None
 
         # embed positions
-        if attention_mask is None:
-            attention_mask = torch.ones(
-                (batch_size, seq_length_with_past), dtype=torch.bool, device=hidden_states.device
+        if attention_mask is None and self.self_attn.use_sdpa:
+            pass  # attention is causal without padding, so OptimizedLlamaAttention needs no explicit mask
+        else:
+            if attention_mask is None:
+                attention_mask = torch.ones(
+                    (batch_size, seq_length_with_past), dtype=torch.bool, device=hidden_states.device
+                )
+            attention_mask = _prepare_4d_causal_attention_mask(
+                attention_mask=attention_mask,
+                input_shape=(batch_size, seq_length),
+                inputs_embeds=hidden_states,
+                past_key_values_length=past_key_values_length,
             )
-        attention_mask = _prepare_4d_causal_attention_mask(
-            attention_mask=attention_mask,
-            input_shape=(batch_size, seq_length),
-            inputs_embeds=hidden_states,
-            past_key_values_length=past_key_values_length,
-        )
 
         outputs = super().forward(
             hidden_states,
@@ -268,10 +302,11 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
             position_ids=position_ids,
             past_key_value=past_key_value,
             use_cache=use_cache,
+            kv_cache_position=kv_cache_position,
             **kwargs,
         )
 
-        if use_cache:
+        if use_cache and kv_cache_position is None:
             present_key_value = outputs[-1]
             present_key_value = self._reorder_cache_from_llama_to_bloom(
                 present_key_value, batch_size, seq_length_with_past
@@ -300,4 +335,4 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
         )
         key_states = key_states.view(*value_states.shape)
         key_states = key_states.permute(0, 2, 1)
-        return (key_states, value_states)
\ No newline at end of file
+        return (key_states, value_states)
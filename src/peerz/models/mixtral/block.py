@@ -1,21 +1,166 @@
-import json
-from typing import Optional, Tuple
+import math
+from typing import Hashable, Optional, Tuple
 
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from transformers import MixtralConfig
-from transformers.cache_utils import DynamicCache
-from transformers.modeling_attn_mask_utils import (
-    _prepare_4d_causal_attention_mask,
-    _prepare_4d_causal_attention_mask_for_sdpa,
+from transformers.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
+from transformers.models.mixtral.modeling_mixtral import (
+    MixtralAttention,
+    MixtralDecoderLayer,
+    MixtralModel,
+    MixtralRMSNorm,
+    MixtralSparseMoeBlock,
+    apply_rotary_pos_emb,
+    repeat_kv,
 )
-from transformers.models.mixtral.modeling_mixtral import MixtralDecoderLayer, MixtralModel
 
+from peerz.utils.kv_cache import causal_attention_with_past, update_kv_cache_inplace
+
+
+class OptimizedMixtralAttention(MixtralAttention):
+    """MixtralAttention that takes past keys/values as tensors (or preallocated caches) instead of a DynamicCache"""
 
-class WrappedMixtralBlock(MixtralDecoderLayer):
     def __init__(self, config: MixtralConfig, layer_idx: int):
         super().__init__(config, layer_idx)
+        # Use F.scaled_dot_product_attention for causal attention unless the user explicitly asked for eager attention
+        self.use_sdpa = getattr(config, "_attn_implementation_internal", None) != "eager"
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        output_attentions: bool = False,
+        use_cache: bool = False,
+        kv_cache_position: Optional[int] = None,
+        **kwargs,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        assert not output_attentions
+        if kv_cache_position is not None:
+            past_seen_tokens = kv_cache_position  # past_key_value holds preallocated caches, see peerz.utils.kv_cache
+        else:
+            past_seen_tokens = past_key_value[0].shape[2] if past_key_value is not None else 0
+
+        bsz, q_len, _ = hidden_states.size()
+        if position_ids is None:
+            position_ids = torch.arange(
+                past_seen_tokens, past_seen_tokens + q_len, device=hidden_states.device
+            ).unsqueeze(0)
+
+        query_states = self.q_proj(hidden_states)
+        key_states = self.k_proj(hidden_states)
+        value_states = self.v_proj(hidden_states)
+
+        query_states = query_states.view(bsz, q_len, self.num_heads, self.head_dim).transpose(1, 2)
+        key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+        value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
+
+        kv_seq_len = past_seen_tokens + q_len
+        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
+
+        if kv_cache_position is not None:
+            # write new keys/values into the cache and attend to its first kv_seq_len tokens without copying them
+            key_states, value_states = update_kv_cache_inplace(
+                *past_key_value, key_states, value_states, past_seen_tokens
+            )
+        elif past_key_value is not None:
+            key_states = torch.cat([past_key_value[0], key_states], dim=2)
+            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+        if use_cache:
+            past_key_value = past_key_value if kv_cache_position is not None else (key_states, value_states)
+        else:
+            past_key_value = None
+
+        if attention_mask is None:
+            attn_output = causal_attention_with_past(query_states, key_states, value_states)
+        else:
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            attn_weights = attn_weights + attention_mask
+            # upcast attention to fp32
+            attn_weights = F.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_output = torch.matmul(attn_weights, value_states)
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
+        attn_output = self.o_proj(attn_output)
+        return attn_output, None, past_key_value
+
+
+class OptimizedMixtralSparseMoeBlock(MixtralSparseMoeBlock):
+    """
+    MixtralSparseMoeBlock that sorts (token, expert) pairs by expert, so that each expert processes a contiguous
+    slice of tokens. This replaces a boolean mask lookup per expert with one gather and one scatter per block.
+
+    If an expert cache is set (see peerz.server.expert_cache), expert weights are expected to be memory-mapped
+    from checkpoint files. They are materialized in the input dtype only when an expert receives tokens.
+    """
+
+    def __init__(self, config: MixtralConfig):
+        super().__init__(config)
+        self.expert_cache, self.expert_cache_prefix = None, None
+
+    def set_expert_cache(self, expert_cache, prefix: Hashable):
+        """Run experts with weights taken from :expert_cache: under keys (prefix, expert_index)"""
+        self.expert_cache, self.expert_cache_prefix = expert_cache, prefix
+
+    def forward(self, hidden_states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, sequence_length, hidden_dim = hidden_states.shape
+        hidden_states = hidden_states.view(-1, hidden_dim)
+        # router_logits: (batch * sequence_length, n_experts)
+        router_logits = self.gate(hidden_states)
+
+        routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
+        routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+        routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
+        # we cast back to the input dtype
+        routing_weights = routing_weights.to(hidden_states.dtype)
+
+        selected_experts = selected_experts.flatten()
+        order = selected_experts.argsort()
+        token_indices = order // self.top_k
+        tokens_per_expert = torch.bincount(selected_experts, minlength=self.num_experts).tolist()
+
+        sorted_hidden_states = hidden_states[token_indices]
+        expert_outputs = []
+        for expert_index, expert_inputs in enumerate(sorted_hidden_states.split(tokens_per_expert)):
+            if expert_inputs.shape[0] > 0:
+                expert_outputs.append(self._run_expert(expert_index, expert_inputs).to(hidden_states.dtype))
+        expert_outputs = torch.cat(expert_outputs) * routing_weights.flatten()[order, None]
+
+        final_hidden_states = torch.zeros_like(hidden_states).index_add_(0, token_indices, expert_outputs)
+        final_hidden_states = final_hidden_states.reshape(batch_size, sequence_length, hidden_dim)
+        return final_hidden_states, router_logits
+
+    def _run_expert(self, expert_index: int, hidden_states: torch.Tensor) -> torch.Tensor:
+        expert_layer = self.experts[expert_index]
+        if self.expert_cache is None:
+            return expert_layer(hidden_states)
+
+        def load_weights():
+            # Materialize weights as regular (not inference) tensors, so that they can be reused in backward passes
+            with torch.inference_mode(False), torch.no_grad():
+                layers = (expert_layer.w1, expert_layer.w2, expert_layer.w3)
+                return [layer.weight.to(hidden_states.dtype, copy=True) for layer in layers]
+
+        w1, w2, w3 = self.expert_cache.get((self.expert_cache_prefix, expert_index), load_weights)
+        return F.linear(expert_layer.act_fn(F.linear(hidden_states, w1)) * F.linear(hidden_states, w3), w2)
+
+
+class WrappedMixtralBlock(MixtralDecoderLayer):
+    def __init__(self, config: MixtralConfig, layer_idx: int):
+        nn.Module.__init__(self)
+        self.hidden_size = config.hidden_size
+        self.self_attn = OptimizedMixtralAttention(config, layer_idx)
+        self.block_sparse_moe = OptimizedMixtralSparseMoeBlock(config)
+        self.input_layernorm = MixtralRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.post_attention_layernorm = MixtralRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
-        self._attn_implementation = config._attn_implementation
         self.sliding_window = config.sliding_window
         self.layer_idx = layer_idx
 
@@ -26,7 +171,8 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
         attention_mask: Optional[torch.Tensor] = None,
         layer_past: Optional[Tuple[torch.Tensor]] = None,
         use_cache: bool = False,
-        **kwargs
+        kv_cache_position: Optional[int] = None,
+        **kwargs,
     ):
         batch_size, seq_length, _ = hidden_states.shape
 
@@ -35,29 +181,20 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
 
         past_key_value = layer_past
 
-        if past_key_value is not None:
+        if kv_cache_position is not None:
+            # layer_past holds preallocated caches in bloom layout, attention writes new keys/values to them in-place
+            assert layer_past is not None, "kv_cache_position requires preallocated caches passed as layer_past"
+            past_key_values_length = kv_cache_position
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_value is not None:
             past_key_values_length = past_key_value[0].shape[2]
             seq_length_with_past = seq_length_with_past + past_key_values_length
-            _past_key_value = self._reorder_cache_from_bloom(past_key_value, batch_size, past_key_values_length)
-            past_key_value = DynamicCache()
-            past_key_value.key_cache = [torch.empty(0) for _ in range(self.layer_idx)] + [_past_key_value[0]]
-            past_key_value.value_cache = [torch.empty(0) for _ in range(self.layer_idx)] + [_past_key_value[1]]
-            past_key_value._seen_tokens = past_key_values_length
-
-        if self._attn_implementation == "flash_attention_2":
-            # 2d mask is passed through the layers
-            attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
-        elif self._attn_implementation == "sdpa":
-            # output_attentions=True can not be supported when using SDPA, and we fall back on
-            # the manual implementation that requires a 4D causal mask in all cases.
-            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
-                attention_mask,
-                (batch_size, seq_length),
-                hidden_states,
-                past_key_values_length,
-            )
+            past_key_value = self._reorder_cache_from_bloom(past_key_value, batch_size, past_key_values_length)
+
+        within_sliding_window = self.sliding_window is None or seq_length_with_past <= self.sliding_window
+        if attention_mask is None and self.self_attn.use_sdpa and within_sliding_window:
+            pass  # attention is causal without padding, so OptimizedMixtralAttention needs no explicit mask
         else:
-            # 4d mask is passed through the layers
             attention_mask = _prepare_4d_causal_attention_mask(
                 attention_mask,
                 (batch_size, seq_length),
@@ -71,23 +208,28 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
         )
         position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
 
-        outputs = super().forward(
+        residual = hidden_states
+        hidden_states = self.input_layernorm(hidden_states)
+        hidden_states, _, present_key_value = self.self_attn(
             hidden_states,
-            *args,
             attention_mask=attention_mask,
             position_ids=position_ids,
             past_key_value=past_key_value,
             use_cache=use_cache,
-            **kwargs
+            kv_cache_position=kv_cache_position,
         )
+        hidden_states = residual + hidden_states
 
-        if use_cache:
-            present_key_value = outputs[-1]
-            present_key_value = present_key_value[self.layer_idx]
-            present_key_value = self._reorder_cache_to_bloom(present_key_value, batch_size, seq_length_with_past)
-            outputs = outputs[:-1] + (present_key_value,)
+        residual = hidden_states
+        hidden_states = self.post_attention_layernorm(hidden_states)
+        hidden_states, _ = self.block_sparse_moe(hidden_states)
+        hidden_states = residual + hidden_states
 
-        return outputs
+        if not use_cache:
+            return (hidden_states,)
+        if kv_cache_position is None:
+            present_key_value = self._reorder_cache_to_bloom(present_key_value, batch_size, seq_length_with_past)
+        return (hidden_states, present_key_value)
 
     def _reorder_cache_from_bloom(
         self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
@@ -106,9 +248,9 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
     ) -> Tuple[torch.Tensor]:
         # TODO: Move to mixin
         key_states, value_states = key_value
-        value_states = value_states.view(
+        value_states = value_states.reshape(
             batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
         )
-        key_states = key_states.view(*value_states.shape)
+        key_states = key_states.reshape(*value_states.shape)
         key_states = key_states.permute(0, 2, 1)
         return (key_states, value_states)
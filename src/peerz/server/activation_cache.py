@@ -0,0 +1,114 @@
+"""
+A short-lived cache of per-block inputs that links rpc_forward with the rpc_backward that follows it.
+
+During fine-tuning, a client runs forward through a span and, shortly after, backward through the same span
+with the same inputs. If the client tags both requests with the same step id, the runtime keeps the inputs of
+each block computed during forward, so that backward does not have to recompute the forward chain.
+
+The cache lives in the Runtime process (entries are added and taken by _MergedForwardStep and _MergedBackwardStep),
+while its size is stored in shared memory so that ConnectionHandlers can report it in rpc_info.
+"""
+import ctypes
+import multiprocessing as mp
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional, Sequence
+
+import torch
+from hivemind.utils import get_logger
+
+from peerz.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class CachedActivations:
+    block_inputs: Sequence[torch.Tensor]  # inputs of each block in the span, with prompts already added
+    prompts: Sequence[torch.Tensor]  # prompts for each block, used to check that backward gets the same ones
+    expiration_time: float
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(tensor.numel() * get_size_in_bytes(tensor.dtype) for tensor in self.block_inputs)
+
+    def matches(self, first_block_inputs: torch.Tensor, prompts: Sequence[torch.Tensor]) -> bool:
+        return (
+            _same_tensors(self.block_inputs[0], first_block_inputs)
+            and len(self.prompts) == len(prompts)
+            and all(map(_same_tensors, self.prompts, prompts))
+        )
+
+
+class ActivationCache:
+    """A size-bounded cache of span activations with a short time-to-live, see module docstring for details"""
+
+    def __init__(self, max_size_bytes: int, timeout: float):
+        self.max_size_bytes, self.timeout = max_size_bytes, timeout
+        self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_hits = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_misses = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._entries: OrderedDict[Hashable, CachedActivations] = OrderedDict()  # valid only inside Runtime
+
+    @property
+    def current_size_bytes(self) -> int:
+        return self._current_size.value
+
+    @property
+    def bytes_left(self) -> int:
+        return max(0, self.max_size_bytes - self.current_size_bytes)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self._num_hits.value + self._num_misses.value
+        return self._num_hits.value / total if total > 0 else 0.0
+
+    def store(self, key: Hashable, block_inputs: Sequence[torch.Tensor], prompts: Sequence[torch.Tensor]) -> bool:
+        """Save activations of a forward pass; returns False if they do not fit into the cache"""
+        entry = CachedActivations(tuple(block_inputs), tuple(prompts), time.monotonic() + self.timeout)
+        self._pop(key)
+        self._remove_expired()
+        if entry.size_bytes > self.max_size_bytes:
+            return False
+        while self.current_size_bytes + entry.size_bytes > self.max_size_bytes:
+            self._pop(next(iter(self._entries)))  # evict the oldest entry
+
+        self._entries[key] = entry
+        self._current_size.value += entry.size_bytes
+        return True
+
+    def take(
+        self, key: Hashable, first_block_inputs: torch.Tensor, prompts: Sequence[torch.Tensor]
+    ) -> Optional[CachedActivations]:
+        """Remove and return activations saved for this key if they were computed for the same inputs and prompts"""
+        self._remove_expired()
+        entry = self._pop(key)
+        if entry is not None and not entry.matches(first_block_inputs, prompts):
+            logger.debug(f"Ignoring cached activations for {key} since they were computed for different inputs")
+            entry = None
+
+        if entry is not None:
+            self._num_hits.value += 1
+        else:
+            self._num_misses.value += 1
+        return entry
+
+    def _pop(self, key: Hashable) -> Optional[CachedActivations]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._current_size.value -= entry.size_bytes
+        return entry
+
+    def _remove_expired(self):
+        current_time = time.monotonic()
+        while self._entries and next(iter(self._entries.values())).expiration_time <= current_time:
+            self._pop(next(iter(self._entries)))
+
+
+def _same_tensors(cached: torch.Tensor, received: torch.Tensor) -> bool:
+    return (
+        cached.shape == received.shape
+        and cached.dtype == received.dtype
+        and torch.equal(cached, received.to(cached.device))
+    )
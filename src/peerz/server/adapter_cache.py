@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import torch.nn as nn
+from hivemind.utils import get_logger
+
+from peerz.utils.disk_cache import allow_cache_reads
+
+logger = get_logger(__name__)
+
+
+class AdapterCache:
+    """
+    Loads LoRA adapters into served blocks on demand (from the local HF cache), keeping at most :max_adapters: of them
+    besides :pinned_adapters: (the ones loaded at startup) and unloading the least recently used ones.
+
+    :note: loading and unloading modify blocks in-place, so ensure_loaded() must only be called from the Runtime thread,
+      while add_block() and remove_block() may be called from other threads for blocks that are not served
+    """
+
+    def __init__(self, max_adapters: int, *, pinned_adapters: Sequence[str] = (), cache_dir: Optional[str] = None):
+        assert max_adapters > 0, "max_adapters must be positive"
+        self.max_adapters, self.pinned_adapters, self.cache_dir = max_adapters, tuple(pinned_adapters), cache_dir
+        self._blocks: Dict[int, nn.Module] = {}
+        self._loaded_adapters = OrderedDict()  # adapters loaded on demand, from least to most recently used
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()  # held while adapters are added to blocks or removed from them
+
+    @property
+    def adapters(self) -> Tuple[str, ...]:
+        """All adapters that are currently loaded, as announced in ServerInfo.adapters"""
+        with self._lock:
+            return self.pinned_adapters + tuple(self._loaded_adapters)
+
+    def add_block(self, block_index: int, block: nn.Module):
+        """Register a block (with LoRA layers created by create_lora_adapter) and load the current adapters into it"""
+        from peerz.utils.peft import add_adapter_to_block, get_adapter_from_repo
+
+        with self._update_lock:
+            with self._lock:
+                loaded_adapters = tuple(self._loaded_adapters)
+            with allow_cache_reads(self.cache_dir):
+                for adapter_name in loaded_adapters:
+                    adapter_config, adapter_state_dict = get_adapter_from_repo(
+                        adapter_name, block_index, cache_dir=self.cache_dir, local_files_only=True
+                    )
+                    add_adapter_to_block(block, block_index, adapter_name, adapter_config, adapter_state_dict)
+            self._blocks[block_index] = block
+
+    def remove_block(self, block_index: int):
+        """Stop loading adapters into a block (e.g., when the server does not serve it anymore)"""
+        with self._update_lock:
+            del self._blocks[block_index]
+
+    def ensure_loaded(self, active_adapter: Optional[Union[str, Sequence[str]]]):
+        """Make sure that an adapter (or all adapters used by rows of a batch, see using_adapter) are loaded"""
+        if active_adapter is None or isinstance(active_adapter, str):
+            active_adapter = (active_adapter,)
+        requested = {adapter for adapter in active_adapter if adapter and adapter not in self.pinned_adapters}
+        if len(requested) > self.max_adapters:
+            raise ValueError(
+                f"A batch uses {len(requested)} adapters, but this server loads at most {self.max_adapters} at a time"
+            )
+
+        for adapter in requested:
+            if adapter in self._loaded_adapters:
+                with self._lock:
+                    self._loaded_adapters.move_to_end(adapter)
+                continue
+            self._load(adapter)  # we load an adapter before unloading others, so that failed loads do not evict them
+            while len(self._loaded_adapters) > self.max_adapters:
+                self._unload(next(name for name in self._loaded_adapters if name not in requested))
+
+    def _load(self, adapter_name: str):
+        # Delay import of peerz.utils.peft to avoid unnecessary import of bitsandbytes
+        from peerz.utils.peft import add_adapter_to_block, get_adapter_from_repo, remove_adapter_from_block
+
+        start_time = time.perf_counter()
+        with self._update_lock:
+            try:
+                with allow_cache_reads(self.cache_dir):
+                    for block_index, block in self._blocks.items():
+                        adapter_config, adapter_state_dict = get_adapter_from_repo(
+                            adapter_name, block_index, cache_dir=self.cache_dir, local_files_only=True
+                        )
+                        add_adapter_to_block(block, block_index, adapter_name, adapter_config, adapter_state_dict)
+            except BaseException:
+                for block in self._blocks.values():
+                    remove_adapter_from_block(block, adapter_name)
+                raise
+            with self._lock:
+                self._loaded_adapters[adapter_name] = None
+        logger.info(f"Loaded adapter {adapter_name} on demand in {time.perf_counter() - start_time:.1f} sec")
+
+    def _unload(self, adapter_name: str):
+        from peerz.utils.peft import remove_adapter_from_block
+
+        with self._update_lock:
+            for block in self._blocks.values():
+                remove_adapter_from_block(block, adapter_name)
+            with self._lock:
+                del self._loaded_adapters[adapter_name]
+        logger.info(f"Unloaded adapter {adapter_name} since it is the least recently used one")
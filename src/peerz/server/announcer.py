@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import dataclasses
 import threading
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import hivemind
 from hivemind import DHT, get_dht_time
@@ -11,7 +12,9 @@ from transformers import PretrainedConfig
 
 from peerz.constants import DTYPE_MAP
 from peerz.data_structures import UID_DELIMITER, ModelInfo, ServerInfo, ServerState, parse_uid
+from peerz.server.adapter_cache import AdapterCache
 from peerz.server.memory_cache import MemoryCache
+from peerz.server.throughput_monitor import ThroughputMonitor
 from peerz.utils.dht import declare_active_modules, get_remote_module_infos
 from peerz.utils.misc import get_size_in_bytes
 from peerz.utils.ping import PingAggregator
@@ -31,6 +34,8 @@ class ModuleAnnouncerThread(threading.Thread):
         *,
         block_config: PretrainedConfig,
         memory_cache: MemoryCache,
+        adapter_cache: Optional[AdapterCache] = None,
+        throughput_monitor: Optional[ThroughputMonitor] = None,
         update_period: float,
         expiration: float,
         max_pinged: int = 5,
@@ -42,6 +47,8 @@ class ModuleAnnouncerThread(threading.Thread):
         self.server_info = server_info
         self.model_info = model_info
         self.memory_cache = memory_cache
+        self.adapter_cache = adapter_cache
+        self.throughput_monitor = throughput_monitor
 
         self.bytes_per_token = block_config.hidden_size * get_size_in_bytes(DTYPE_MAP[server_info.torch_dtype])
         self.bytes_per_token //= block_config.num_key_value_groups
@@ -51,22 +58,30 @@ class ModuleAnnouncerThread(threading.Thread):
         self.trigger = threading.Event()
 
         self.dht_prefix = parse_uid(module_uids[0])[0]
-        block_indices = [parse_uid(uid)[1] for uid in module_uids]
-        self.server_info.start_block = min(block_indices)
-        self.server_info.end_block = max(block_indices) + 1
+        self.server_info.start_block, self.server_info.end_block = _get_span(module_uids)
+        self.online_uids = list(module_uids)  # see update_blocks()
+        self._removed_uids = []
+        self._lock = threading.Lock()
 
         self.max_pinged = max_pinged
-        self.next_uids = [
-            f"{self.dht_prefix}{UID_DELIMITER}{i}"
-            for i in range(self.server_info.start_block + 1, self.server_info.end_block + 1)
-        ]
         self.ping_aggregator = PingAggregator(self.dht)
 
     def run(self) -> None:
         while True:
             start_time = time.perf_counter()
 
+            with self._lock:
+                module_uids, removed_uids = self.module_uids, self._removed_uids
+                online_uids = self.online_uids if self.server_info.state == ServerState.ONLINE else module_uids
+                self._removed_uids = []
+            loading_uids = [uid for uid in module_uids if uid not in online_uids]
+            self.server_info.start_block, self.server_info.end_block = _get_span(online_uids)
+
             self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            if self.adapter_cache is not None:
+                self.server_info.adapters = self.adapter_cache.adapters
+            if self.throughput_monitor is not None:
+                self.throughput_monitor.update_server_info(self.server_info)
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -77,10 +92,27 @@ class ModuleAnnouncerThread(threading.Thread):
 
             declare_active_modules(
                 self.dht,
-                self.module_uids,
+                online_uids,
                 self.server_info,
                 expiration_time=get_dht_time() + self.expiration,
             )
+            if loading_uids:
+                # Keep announcing the blocks that are still loading, so that they don't disappear from the DHT
+                start_block, end_block = _get_span(loading_uids)
+                loading_info = dataclasses.replace(
+                    self.server_info, state=ServerState.JOINING, start_block=start_block, end_block=end_block
+                )
+                declare_active_modules(
+                    self.dht, loading_uids, loading_info, expiration_time=get_dht_time() + self.expiration
+                )
+            if removed_uids:
+                start_block, end_block = _get_span(removed_uids)
+                removed_info = dataclasses.replace(
+                    self.server_info, state=ServerState.OFFLINE, start_block=start_block, end_block=end_block
+                )
+                declare_active_modules(
+                    self.dht, removed_uids, removed_info, expiration_time=get_dht_time() + self.expiration
+                )
             if self.server_info.state == ServerState.OFFLINE:
                 break
             if not self.dht_prefix.startswith("_"):  # Not private
@@ -105,11 +137,32 @@ class ModuleAnnouncerThread(threading.Thread):
         if state == ServerState.OFFLINE:
             self.join()
 
+    def update_blocks(self, module_uids: Sequence[str], *, online_uids: Sequence[str]) -> None:
+        """
+        Announce that this container hosts :module_uids: (instead of the previous ones, which are announced as OFFLINE),
+        where :online_uids: are a contiguous span of ONLINE blocks and the rest of them are still JOINING
+        """
+        assert online_uids and set(online_uids) <= set(module_uids)
+        with self._lock:
+            removed_uids = self._removed_uids + [uid for uid in self.module_uids if uid not in module_uids]
+            self._removed_uids = [uid for uid in removed_uids if uid not in module_uids]
+            self.module_uids, self.online_uids = list(module_uids), list(online_uids)
+        self.announce(ServerState.ONLINE)
+
     def _ping_next_servers(self) -> Dict[hivemind.PeerID, float]:
-        module_infos = get_remote_module_infos(self.dht, self.next_uids, latest=True)
+        next_uids = [
+            f"{self.dht_prefix}{UID_DELIMITER}{i}"
+            for i in range(self.server_info.start_block + 1, self.server_info.end_block + 1)
+        ]
+        module_infos = get_remote_module_infos(self.dht, next_uids, latest=True)
         middle_servers = {peer_id for info in module_infos[:-1] for peer_id in info.servers}
         pinged_servers = set(sample_up_to(middle_servers, self.max_pinged))
         pinged_servers.discard(self.dht.peer_id)
         # Sample servers hosting the block after the last one (most likely continuations) separately
         pinged_servers |= set(sample_up_to(module_infos[-1].servers, self.max_pinged))
         self.ping_aggregator.ping(list(pinged_servers))
+
+
+def _get_span(uids: Sequence[str]) -> Tuple[int, int]:
+    block_indices = [parse_uid(uid)[1] for uid in uids]
+    return min(block_indices), max(block_indices) + 1
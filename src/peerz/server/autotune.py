@@ -0,0 +1,198 @@
+"""
+Autotuning of inference thresholds for the server's hardware (enabled by --autotune).
+
+- max_short_inference_tokens: inference steps with at most this many tokens are processed through the whole span in
+  one Runtime task (see iterate_rpc_inference), longer ones are split into per-block tasks so that they do not delay
+  other sessions for too long. Instead of the defaults tuned for mainstream GPUs (MAX_SHORT_INFERENCE_TOKENS and
+  MAX_NF4_SHORT_INFERENCE_TOKENS), we choose the largest number of tokens whose step takes at most :max_slowdown:
+  times longer than a step with one token, i.e. while extra tokens are almost free for this device.
+- max_chunk_size_bytes: long prefixes are processed in chunks whose attention scores take at most this many bytes
+  (see TransformerBackend._estimate_max_chunk_length). We time a long prefill for candidate sizes up to the value set
+  by --max_chunk_size_bytes (it bounds the memory reserved for this, so we never exceed it) and choose the smallest
+  size that is within :tolerance: of the fastest one, since smaller chunks leave more memory for other requests.
+
+The measurements are saved in the throughput cache, so they are taken once per host, model, dtype, and quantization.
+"""
+import time
+from typing import Dict, List, Optional, Sequence, Union
+
+import torch
+from hivemind.utils.logging import get_logger
+from transformers import PretrainedConfig
+
+from peerz.server.backend import get_shard_num_heads
+from peerz.server.block_functions import MAX_NF4_SHORT_INFERENCE_TOKENS, MAX_SHORT_INFERENCE_TOKENS
+from peerz.server.block_utils import resolve_block_dtype
+from peerz.server.throughput import (
+    _create_benchmark_block,
+    _create_benchmark_caches,
+    get_throughput_cache_key,
+    locked_throughput_cache,
+    synchronize,
+)
+from peerz.utils.convert_block import QuantType
+from peerz.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+SHORT_INFERENCE_TOKENS_CANDIDATES = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+CHUNK_SIZE_BYTES_CANDIDATES = tuple(2**power * 1024**2 for power in range(4, 13))  # From 16 MiB to 4 GiB
+
+
+def get_autotuned_settings(
+    model_name: str,
+    config: PretrainedConfig,
+    device: torch.device,
+    dtype: Union[str, torch.dtype],
+    *,
+    quant_type: QuantType,
+    tensor_parallel_devices: Sequence[torch.device],
+    max_chunk_size_bytes: int,
+    prefill_length: int = 2048,
+    max_slowdown: float = 2.0,
+    tolerance: float = 0.05,
+    force_eval: bool = False,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, int]:
+    """
+    Measure step times for candidate settings (or load them from the throughput cache), return the chosen
+    max_short_inference_tokens and max_chunk_size_bytes (the latter is at most :max_chunk_size_bytes:)
+    """
+    dtype = resolve_block_dtype(config, dtype)
+    chunk_size_candidates = [size for size in CHUNK_SIZE_BYTES_CANDIDATES if size < max_chunk_size_bytes]
+    chunk_size_candidates.append(max_chunk_size_bytes)
+
+    cache_key = "autotune_" + get_throughput_cache_key(model_name, device, dtype, quant_type, tensor_parallel_devices)
+    logger.info("Loading autotuned settings")
+    with locked_throughput_cache(cache_dir) as cache:
+        if force_eval:
+            cache.pop(cache_key, None)
+        entry = cache.setdefault(cache_key, {"short_inference_step_times": [], "prefill_times": []})
+        measured_num_tokens = {num_tokens for num_tokens, _ in entry["short_inference_step_times"]}
+        measured_chunk_sizes = {chunk_size for chunk_size, _ in entry["prefill_times"]}
+        missing_num_tokens = [n for n in SHORT_INFERENCE_TOKENS_CANDIDATES if n not in measured_num_tokens]
+        missing_chunk_sizes = [size for size in chunk_size_candidates if size not in measured_chunk_sizes]
+
+        if missing_num_tokens or missing_chunk_sizes:
+            logger.info("Autotuning inference settings, this may take a few minutes")
+            block = _create_benchmark_block(config, torch.device(device), dtype, quant_type, tensor_parallel_devices)
+            entry["short_inference_step_times"] += measure_short_inference_step_times(
+                block, config, device, dtype, num_tokens_candidates=missing_num_tokens
+            )
+            entry["prefill_times"] += measure_prefill_times(
+                block, config, device, dtype, chunk_size_candidates=missing_chunk_sizes, prefill_length=prefill_length
+            )
+            del block
+
+    step_times = dict(map(tuple, entry["short_inference_step_times"]))
+    prefill_times = dict(map(tuple, entry["prefill_times"]))
+    settings = dict(
+        max_short_inference_tokens=choose_max_short_inference_tokens(step_times, max_slowdown=max_slowdown),
+        max_chunk_size_bytes=choose_max_chunk_size_bytes(
+            {size: prefill_times[size] for size in chunk_size_candidates}, tolerance=tolerance
+        ),
+    )
+    default_short_tokens = MAX_NF4_SHORT_INFERENCE_TOKENS if quant_type == QuantType.NF4 else MAX_SHORT_INFERENCE_TOKENS
+    logger.info(
+        f"Autotuned settings: max_short_inference_tokens={settings['max_short_inference_tokens']} "
+        f"(default: {default_short_tokens}), max_chunk_size_bytes={settings['max_chunk_size_bytes']} "
+        f"(limit: {max_chunk_size_bytes})"
+    )
+    return settings
+
+
+def measure_short_inference_step_times(
+    block: torch.nn.Module,
+    config: PretrainedConfig,
+    device: torch.device,
+    dtype: torch.dtype,
+    *,
+    num_tokens_candidates: Sequence[int],
+    prefix_length: int = 512,
+    n_steps: int = 5,
+) -> List[List[float]]:
+    """Measure the time of an inference step through one block for each number of new tokens, return [[n, time]]"""
+    device = torch.device(device)
+    results = []
+    with torch.inference_mode():
+        # Step times do not depend on the cache contents, so we don't need to compute the prefix
+        layer_past = _create_benchmark_caches(
+            block, config, dtype, batch_size=1, max_length=prefix_length + max(num_tokens_candidates, default=0)
+        )
+
+        for num_tokens in num_tokens_candidates:
+            dummy_input = torch.randn(1, num_tokens, config.hidden_size, device=device, dtype=dtype)
+
+            # Like TransformerBackend.inference_step, all steps write new tokens into the cache after the prefix
+            def step():
+                block.forward(dummy_input, use_cache=True, layer_past=layer_past, kv_cache_position=prefix_length)
+
+            step()  # Skip the 1st step (initialization)
+            synchronize(device)
+
+            start_time = time.perf_counter()
+            for _ in range(n_steps):
+                step()
+            synchronize(device)
+            step_time = (time.perf_counter() - start_time) / n_steps
+            results.append([num_tokens, step_time])
+            logger.debug(f"Inference step time for {num_tokens} tokens: {step_time * 1000:.1f} ms")
+    return results
+
+
+def measure_prefill_times(
+    block: torch.nn.Module,
+    config: PretrainedConfig,
+    device: torch.device,
+    dtype: torch.dtype,
+    *,
+    chunk_size_candidates: Sequence[int],
+    prefill_length: int,
+    n_repeats: int = 2,
+) -> List[List[float]]:
+    """Measure the time of a chunked prefill through one block for each max_chunk_size_bytes, return [[size, time]]"""
+    device = torch.device(device)
+    results = []
+    with torch.inference_mode():
+        layer_past = _create_benchmark_caches(block, config, dtype, batch_size=1, max_length=prefill_length)
+        dummy_input = torch.randn(1, prefill_length, config.hidden_size, device=device, dtype=dtype)
+        max_shard_num_heads = max(get_shard_num_heads(block, config))
+
+        for chunk_size_bytes in chunk_size_candidates:
+            # The same formula as in TransformerBackend._estimate_max_chunk_length() for a prefill without a prefix
+            attn_bytes_per_token = max_shard_num_heads * get_size_in_bytes(dtype) * prefill_length
+            max_chunk_length = max(1, chunk_size_bytes // attn_bytes_per_token)
+
+            elapsed = []
+            for _ in range(n_repeats + 1):  # Skip the 1st repeat (initialization)
+                synchronize(device)
+                start_time = time.perf_counter()
+                for offset in range(0, prefill_length, max_chunk_length):
+                    # Chunks are written into preallocated caches in place, as in TransformerBackend.inference_step
+                    block.forward(
+                        dummy_input[:, offset : offset + max_chunk_length],
+                        use_cache=True,
+                        layer_past=layer_past,
+                        kv_cache_position=offset,
+                    )
+                synchronize(device)
+                elapsed.append(time.perf_counter() - start_time)
+            prefill_time = min(elapsed[1:])
+            results.append([chunk_size_bytes, prefill_time])
+            logger.debug(
+                f"Prefill time with max_chunk_size_bytes={chunk_size_bytes} "
+                f"({max_chunk_length} tokens per chunk): {prefill_time * 1000:.1f} ms"
+            )
+    return results
+
+
+def choose_max_short_inference_tokens(step_times: Dict[int, float], *, max_slowdown: float) -> int:
+    """Choose the largest number of tokens whose step time is at most :max_slowdown: times the 1-token step time"""
+    base_time = step_times[1]
+    return max(num_tokens for num_tokens, step_time in step_times.items() if step_time <= max_slowdown * base_time)
+
+
+def choose_max_chunk_size_bytes(prefill_times: Dict[int, float], *, tolerance: float) -> int:
+    """Choose the smallest chunk size whose prefill time is within :tolerance: of the fastest one"""
+    best_time = min(prefill_times.values())
+    return min(size for size, prefill_time in prefill_times.items() if prefill_time <= (1 + tolerance) * best_time)
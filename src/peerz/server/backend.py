@@ -2,21 +2,25 @@ from __future__ import annotations
 
 from collections import Counter
 from itertools import chain
-from typing import Any, Dict, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import BatchTensorDescriptor, TensorDescriptor
 from hivemind.moe.expert_uid import ExpertUID
 from hivemind.moe.server.module_backend import ModuleBackend
 from hivemind.utils import get_logger
+from hivemind.utils.nested import nested_flatten
 from tensor_parallel import TensorParallel
 from tensor_parallel.tensor_parallel import PerDeviceTensors
 from transformers import PretrainedConfig
 
 from peerz.data_structures import InferenceMetadata
+from peerz.server.activation_cache import ActivationCache
+from peerz.server.adapter_cache import AdapterCache
+from peerz.server.compiled_block import CompiledBlock
 from peerz.server.memory_cache import MemoryCache
 from peerz.server.task_pool import PrioritizedTaskPool
-from peerz.utils.misc import get_size_in_bytes, is_dummy
+from peerz.utils.misc import DUMMY, get_size_in_bytes, is_dummy
 
 logger = get_logger(__name__)
 
@@ -33,6 +37,10 @@ class TransformerBackend(ModuleBackend):
         memory_cache: MemoryCache,
         backend_dtype: torch.dtype,
         max_chunk_size_bytes: int,
+        max_backward_activation_bytes: int = 0,
+        activation_cache: Optional[ActivationCache] = None,
+        adapter_cache: Optional[AdapterCache] = None,
+        use_compile: bool = False,
         **kwargs,
     ):
         import peerz.utils.peft as _peft_module
@@ -44,6 +52,10 @@ class TransformerBackend(ModuleBackend):
         self.config = config
         self.memory_cache = memory_cache
         self.max_chunk_size_bytes = max_chunk_size_bytes
+        self.max_backward_activation_bytes = max_backward_activation_bytes
+        self.activation_cache = activation_cache
+        self.adapter_cache = adapter_cache
+        self.compiled_block = CompiledBlock(self.module) if use_compile else None
 
         for name, param in self.module.named_parameters():
             assert not param.requires_grad, f"Block parameters must not accumulate gradients, but {name} does"
@@ -64,13 +76,7 @@ class TransformerBackend(ModuleBackend):
 
         self.dtype = backend_dtype
         self.dtype_bytes = get_size_in_bytes(self.dtype)
-        self.shard_num_heads = []
-        for shard in self.module.module_shards:
-            for submodule in shard.modules():
-                if isinstance(submodule, config.attn_class):
-                    self.shard_num_heads.append(submodule.num_heads)
-        assert len(self.shard_num_heads) == len(self.module.devices)
-        assert sum(self.shard_num_heads) == config.num_attention_heads
+        self.shard_num_heads = get_shard_num_heads(self.module, config)
 
         self.inference_schema = (
             (
@@ -85,29 +91,49 @@ class TransformerBackend(ModuleBackend):
         for descr in self.get_inference_cache_descriptors(batch_size=1, max_length=1):
             self.cache_bytes_per_token[descr.device] += descr.numel() * get_size_in_bytes(descr.dtype)
 
+    def replace_module(self, module: TensorParallel):
+        """Serve another block with the same architecture and devices (e.g., once it is loaded, see ModuleContainer)"""
+        assert isinstance(module, TensorParallel) and module.devices == self.module.devices
+        self.module = module
+        if self.compiled_block is not None:
+            self.compiled_block = CompiledBlock(module)
+
     def get_inference_cache_descriptors(self, batch_size: int, max_length: int) -> Sequence[TensorDescriptor]:
         """Create tensor descriptors for attention cache tensors used during inference_step"""
-        head_dim = self.config.hidden_size // self.config.num_attention_heads
-        cache_tensors = []
-        for device, num_heads in zip(self.module.devices, self.shard_num_heads):
-            num_heads //= self.config.num_key_value_groups
-            if hasattr(self.config, "num_key_value_heads"):
-                num_heads = self.config.num_key_value_heads
-            keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=self.dtype, device=device)
-            values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=self.dtype, device=device)
-            cache_tensors.extend((keys, values))
-        return cache_tensors
+        return make_inference_cache_descriptors(
+            self.config,
+            self.dtype,
+            self.module.devices,
+            self.shard_num_heads,
+            batch_size=batch_size,
+            max_length=max_length,
+        )
+
+    def _using_adapter(self, active_adapter: Optional[Union[str, Tuple[str, ...]]]):
+        if self.adapter_cache is not None:
+            self.adapter_cache.ensure_loaded(active_adapter)
+        return self._peft_module.using_adapter(active_adapter)
 
     def forward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
-        with self._peft_module.using_adapter(active_adapter):
-            return super().forward(*inputs)
+        with self._using_adapter(active_adapter):
+            if self.compiled_block is None or isinstance(active_adapter, tuple):
+                return super().forward(*inputs)  # per-row adapters run eagerly, since padding changes the batch size
+            (hidden_states,) = inputs
+            with torch.no_grad():
+                return (self.compiled_block.forward(hidden_states),)
 
     def backward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
-        with self._peft_module.using_adapter(active_adapter):
+        with self._using_adapter(active_adapter):
             return super().backward(*inputs)
 
+    def forward_with_grad(self, hidden_states: torch.Tensor, active_adapter: str) -> torch.Tensor:
+        """Apply the block with autograd enabled, keeping its activations for a subsequent backward pass"""
+        with self._using_adapter(active_adapter), torch.enable_grad():
+            outputs = self.module(hidden_states)
+        return next(iter(nested_flatten(outputs)))
+
     @torch.inference_mode()
     def inference_step(
         self,
@@ -118,9 +144,9 @@ class TransformerBackend(ModuleBackend):
         assert hidden_states.ndim == 3, "expected hidden states to be 3-dimensional: [batch_size, seq_len, hid_size]"
         seq_len = hidden_states.shape[1]
 
-        with self.memory_cache.use_cache(
-            *inference_info.cache_handles
-        ) as cache_tensors, self._peft_module.using_adapter(inference_info.active_adapter):
+        with self.memory_cache.use_cache(*inference_info.cache_handles) as cache_tensors, self._using_adapter(
+            inference_info.active_adapter
+        ):
             self._reorder_cache_inplace(cache_tensors, hypo_ids)
 
             # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
@@ -128,19 +154,24 @@ class TransformerBackend(ModuleBackend):
             # is at least 4-6x less than `autograd_memory`.
             max_chunk_length = self._estimate_max_chunk_length(hidden_states, inference_info)
             output_hidden_states = torch.empty_like(hidden_states) if seq_len > max_chunk_length else None
-            layer_past = self._select_layer_past(cache_tensors, inference_info.prefix_length)
+            layer_past = self._select_layer_past(cache_tensors)
             for offset in range(0, seq_len, max_chunk_length):
                 hidden_states_chunk = hidden_states[:, offset : offset + max_chunk_length, :]
-                output_hidden_states_chunk, new_kvs = self.module.forward(
-                    hidden_states_chunk, layer_past=layer_past, use_cache=True
-                )
+                # the block writes new keys/values right into cache tensors, after the first kv_cache_position tokens
+                kv_cache_position = inference_info.prefix_length + offset
+                if self.compiled_block is not None and not isinstance(inference_info.active_adapter, tuple):
+                    output_hidden_states_chunk = self.compiled_block.inference_step(
+                        hidden_states_chunk, layer_past, kv_cache_position=kv_cache_position
+                    )
+                else:
+                    output_hidden_states_chunk, _ = self.module.forward(
+                        hidden_states_chunk, layer_past=layer_past, use_cache=True, kv_cache_position=kv_cache_position
+                    )
                 if seq_len > max_chunk_length:
                     output_hidden_states[:, offset : offset + max_chunk_length] = output_hidden_states_chunk
                 else:
                     output_hidden_states = output_hidden_states_chunk  # saves one memcopy
-                layer_past = new_kvs
 
-            self._update_cache_inplace(cache_tensors, new_kvs, inference_info.prefix_length)
             return (output_hidden_states,)
 
     def _estimate_max_chunk_length(self, hidden_states: torch.Tensor, inference_info: InferenceMetadata) -> int:
@@ -151,34 +182,36 @@ class TransformerBackend(ModuleBackend):
         attn_bytes_per_token = max(self.shard_num_heads) * batch_size * self.dtype_bytes * worst_case_length
         return max(1, self.max_chunk_size_bytes // attn_bytes_per_token)
 
+    def _estimate_max_batch_chunk_size(self, hidden_states: torch.Tensor) -> int:
+        # Forward and backward see the whole sequence at once (there is no attention cache to carry over),
+        # so we can only split them along the batch dimension. As above, we count attention logits only
+        batch_size, seq_length, hidden_size = hidden_states.shape
+        attn_bytes_per_sample = max(self.shard_num_heads) * self.dtype_bytes * seq_length**2
+        return max(1, self.max_chunk_size_bytes // attn_bytes_per_sample)
+
+    def _estimate_backward_activation_bytes(self, hidden_states: torch.Tensor) -> int:
+        # We assume that a block keeps attention scores and probabilities plus a couple dozen hidden-sized tensors
+        # per token (normalized inputs, query/key/value states, MLP activations, etc.) until its backward is done
+        batch_size, seq_length, hidden_size = hidden_states.shape
+        attn_bytes_per_sample = 2 * max(self.shard_num_heads) * seq_length**2
+        hidden_bytes_per_sample = 24 * hidden_size * seq_length
+        return (attn_bytes_per_sample + hidden_bytes_per_sample) * self.dtype_bytes
+
     def _reorder_cache_inplace(self, cache_tensors: torch.Tensor, hypo_ids: torch.Tensor):
         """If hypo_ids is specified, reorder elements of each cache tensor in-place by taking indices from hypo_ids"""
         if not is_dummy(hypo_ids):
             for cache_tensor in cache_tensors:
                 cache_tensor[...] = cache_tensor[hypo_ids.to(cache_tensor.device)]  # in-place reorder cache by hypo ids
 
-    def _select_layer_past(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> Sequence[torch.Tensor]:
-        """Extract first {prefix_length} tokens and reshape them such that they can be used as layer_past"""
-        key_cache, value_cache = list(cache_tensors[0::2]), list(cache_tensors[1::2])
-        for i in range(len(key_cache)):
-            key_cache[i] = key_cache[i].flatten(0, 1)[:, :, :prefix_length]
-            # shape: [batch * num_kv_heads, head_dim, kv_length]
-            value_cache[i] = value_cache[i].flatten(0, 1)[:, :prefix_length]
-            # shape: [batch * num_kv_heads, kv_length, head_dim]
-        layer_past = tuple(chain(*zip(key_cache, value_cache)))
-        return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else layer_past
-
-    def _update_cache_inplace(
-        self, cache_tensors: Sequence[torch.Tensor], new_kvs: Sequence[torch.Tensor], prefix_length: int
-    ):
-        """Writes new key/value tensors back into cache, works in-place"""
-        _batch_size_times_num_kv_heads, head_dim, new_length = new_kvs[0].shape
-        for cache_key, new_key in zip(cache_tensors[0::2], new_kvs[0::2]):
-            new_key = new_key.view(*cache_key.shape[:3], new_length)
-            cache_key[:, :, :, prefix_length:new_length] = new_key[:, :, :, prefix_length:new_length]
-        for cache_value, new_value in zip(cache_tensors[1::2], new_kvs[1::2]):
-            new_value = new_value.view(*cache_value.shape[:2], new_length, head_dim)
-            cache_value[:, :, prefix_length:new_length, :] = new_value[:, :, prefix_length:new_length, :]
+    def _select_layer_past(self, cache_tensors: Sequence[torch.Tensor]) -> Sequence[torch.Tensor]:
+        """Reshape cache tensors (without copying) such that blocks can write to them in-place, see utils.kv_cache"""
+        return select_layer_past(self.module, cache_tensors)
+
+    def warmup_compiled_block(self, max_length: int = 64):
+        """Compile the block for typical request shapes before serving it, see CompiledBlock.warmup"""
+        assert self.compiled_block is not None, "this backend was created without use_compile=True"
+        cache_tensors = [descr.make_zeros() for descr in self.get_inference_cache_descriptors(1, max_length)]
+        self.compiled_block.warmup(self.config.hidden_size, self.dtype, self._select_layer_past(cache_tensors))
 
     def get_pools(self) -> Sequence[PrioritizedTaskPool]:
         return self.forward_pool, self.backward_pool, self.inference_pool
@@ -198,6 +231,50 @@ class TransformerBackend(ModuleBackend):
             p.data = dummy
 
 
+def get_shard_num_heads(block: TensorParallel, config: PretrainedConfig) -> List[int]:
+    """Get the number of attention heads in each shard of a (possibly tensor-parallel) block"""
+    shard_num_heads = []
+    for shard in block.module_shards:
+        for submodule in shard.modules():
+            if isinstance(submodule, config.attn_class):
+                shard_num_heads.append(submodule.num_heads)
+    assert len(shard_num_heads) == len(block.devices)
+    assert sum(shard_num_heads) == config.num_attention_heads
+    return shard_num_heads
+
+
+def make_inference_cache_descriptors(
+    config: PretrainedConfig,
+    dtype: torch.dtype,
+    devices: Sequence[torch.device],
+    shard_num_heads: Sequence[int],
+    *,
+    batch_size: int,
+    max_length: int,
+) -> List[TensorDescriptor]:
+    """Create tensor descriptors for attention caches of a block with :shard_num_heads: heads on :devices:"""
+    head_dim = config.hidden_size // config.num_attention_heads
+    cache_tensors = []
+    for device, num_heads in zip(devices, shard_num_heads):
+        num_heads //= config.num_key_value_groups
+        if hasattr(config, "num_key_value_heads"):
+            num_heads = config.num_key_value_heads
+        keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=dtype, device=device)
+        values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=dtype, device=device)
+        cache_tensors.extend((keys, values))
+    return cache_tensors
+
+
+def select_layer_past(block: TensorParallel, cache_tensors: Sequence[torch.Tensor]) -> Sequence[torch.Tensor]:
+    """Reshape cache tensors (without copying) such that :block: can write to them in-place, see utils.kv_cache"""
+    key_cache, value_cache = list(cache_tensors[0::2]), list(cache_tensors[1::2])
+    for i in range(len(key_cache)):
+        key_cache[i] = key_cache[i].flatten(0, 1)  # shape: [batch * num_kv_heads, head_dim, max_length]
+        value_cache[i] = value_cache[i].flatten(0, 1)  # shape: [batch * num_kv_heads, max_length, head_dim]
+    layer_past = tuple(chain(*zip(key_cache, value_cache)))
+    return PerDeviceTensors(*layer_past) if len(block.module_shards) > 1 else layer_past
+
+
 def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
     """Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call"""
     assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
@@ -233,3 +310,260 @@ class _MergedInferenceStep:
                 hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
             (hidden_states,) = self.backends[inference_info.uid].inference_step(hidden_states, hypo_ids, inference_info)
         return (hidden_states,)
+
+
+def merge_forward_backward_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
+    """Replace each backend's forward and backward pools with combined pools that run a span of blocks in one call"""
+    assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
+    first_backend = next(iter(backends.values()))
+    merged_forward_pool = PrioritizedTaskPool(
+        _MergedForwardStep(backends),
+        max_batch_size=first_backend.forward_pool.max_batch_size,
+        device=first_backend.forward_pool.device,
+        name=f"merged_forward",
+    )
+    merged_backward_pool = PrioritizedTaskPool(
+        _MergedBackwardStep(backends),
+        max_batch_size=first_backend.backward_pool.max_batch_size,
+        device=first_backend.backward_pool.device,
+        name=f"merged_backward",
+    )
+    for backend in backends.values():
+        assert not backend.forward_pool.is_alive() and not backend.backward_pool.is_alive()
+        backend.forward_pool = merged_forward_pool
+        backend.backward_pool = merged_backward_pool
+
+
+class _MergedForwardStep:
+    """Runs forward through a span of blocks in a single runtime task, splitting the batch into chunks if needed"""
+
+    def __init__(self, backends: Dict[ExpertUID, TransformerBackend]):
+        self.backends = backends
+
+    def __call__(
+        self,
+        hidden_states: torch.Tensor,
+        active_adapter: str,
+        uids: Sequence[ExpertUID],
+        step_id: Optional[str],
+        *prompts: torch.Tensor,
+    ) -> Tuple[torch.Tensor, ...]:
+        assert len(uids) == len(prompts), f"found {len(uids)} blocks but {len(prompts)} prompts"
+        backends = [self.backends[uid] for uid in uids]
+        batch_size = hidden_states.shape[0]
+        max_chunk_size = min(backend._estimate_max_batch_chunk_size(hidden_states) for backend in backends)
+
+        activation_cache = backends[0].activation_cache
+        should_cache = step_id is not None and activation_cache is not None
+        block_input_chunks = [[] for _ in backends]
+
+        output_hidden_states = torch.empty_like(hidden_states) if batch_size > max_chunk_size else None
+        for offset in range(0, batch_size, max_chunk_size):
+            hidden_states_chunk = hidden_states[offset : offset + max_chunk_size]
+            active_adapter_chunk = _select_adapter_chunk(active_adapter, offset, max_chunk_size)
+            for i, (backend, prompt) in enumerate(zip(backends, prompts)):
+                if not is_dummy(prompt):
+                    prompt = _select_batch_chunk(prompt, offset, max_chunk_size)
+                    hidden_states_chunk[:, : prompt.shape[1]] += prompt
+                if should_cache:
+                    block_input_chunks[i].append(hidden_states_chunk)
+                (hidden_states_chunk,) = backend.forward(hidden_states_chunk, active_adapter_chunk)
+
+            if batch_size > max_chunk_size:
+                output_hidden_states[offset : offset + max_chunk_size] = hidden_states_chunk
+            else:
+                output_hidden_states = hidden_states_chunk  # saves one memcopy
+
+        if should_cache:
+            block_inputs = [torch.cat(chunks, dim=0) for chunks in block_input_chunks]  # note: this also copies them
+            activation_cache.store((step_id, tuple(uids), active_adapter), block_inputs, prompts)
+        return (output_hidden_states,)
+
+
+class _MergedBackwardStep:
+    """
+    Runs backward through a span of blocks in a single runtime task, splitting the batch into chunks if needed.
+
+    If the forward pass for this step left block inputs in the activation cache, we use them instead of recomputing
+    the forward chain (see _cached_backward_chunk). Otherwise, if activations of the whole span fit into
+    max_backward_activation_bytes, each block is run forward only once with autograd enabled (see
+    _fused_backward_chunk). Otherwise, we recompute intermediate inputs without grad and let each block recompute
+    its own forward inside backward (see _recomputing_backward_chunk).
+    """
+
+    def __init__(self, backends: Dict[ExpertUID, TransformerBackend]):
+        self.backends = backends
+
+    def __call__(
+        self,
+        inputs: torch.Tensor,
+        grad_outputs: torch.Tensor,
+        active_adapter: str,
+        uids: Sequence[ExpertUID],
+        step_id: Optional[str],
+        *prompts: torch.Tensor,
+    ) -> Tuple[torch.Tensor, ...]:
+        assert len(uids) == len(prompts), f"found {len(uids)} blocks but {len(prompts)} prompts"
+        backends = [self.backends[uid] for uid in uids]
+        max_chunk_size = min(backend._estimate_max_batch_chunk_size(inputs) for backend in backends)
+
+        activation_cache = backends[0].activation_cache
+        if step_id is not None and activation_cache is not None:
+            first_block_inputs = inputs.clone()
+            if not is_dummy(prompts[0]):
+                first_block_inputs[:, : prompts[0].shape[1]] += prompts[0]
+            cached = activation_cache.take((step_id, tuple(uids), active_adapter), first_block_inputs, prompts)
+            if cached is not None:
+                return self._run_chunks(
+                    self._cached_backward_chunk,
+                    cached.block_inputs,
+                    grad_outputs,
+                    active_adapter,
+                    backends,
+                    prompts,
+                    max_chunk_size=max_chunk_size,
+                )
+
+        activation_bytes_per_sample = sum(
+            backend._estimate_backward_activation_bytes(inputs[:1]) for backend in backends
+        )
+        max_fused_chunk_size = min(backend.max_backward_activation_bytes for backend in backends) // max(
+            1, activation_bytes_per_sample
+        )
+        if max_fused_chunk_size > 0:
+            backward_chunk = self._fused_backward_chunk
+            max_chunk_size = min(max_chunk_size, max_fused_chunk_size)
+        else:
+            backward_chunk = self._recomputing_backward_chunk
+        return self._run_chunks(
+            backward_chunk, inputs, grad_outputs, active_adapter, backends, prompts, max_chunk_size=max_chunk_size
+        )
+
+    @staticmethod
+    def _run_chunks(
+        backward_chunk: Callable,
+        inputs: Union[torch.Tensor, Sequence[torch.Tensor]],
+        grad_outputs: torch.Tensor,
+        active_adapter: str,
+        backends: Sequence[TransformerBackend],
+        prompts: Sequence[torch.Tensor],
+        *,
+        max_chunk_size: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size = grad_outputs.shape[0]
+        grad_inputs = torch.empty_like(grad_outputs) if batch_size > max_chunk_size else None
+        grad_prompt_chunks = []
+        for offset in range(0, batch_size, max_chunk_size):
+            if isinstance(inputs, torch.Tensor):
+                inputs_chunk = inputs[offset : offset + max_chunk_size]
+            else:
+                inputs_chunk = [block_inputs[offset : offset + max_chunk_size] for block_inputs in inputs]
+            grad_inputs_chunk, grad_prompts_chunk = backward_chunk(
+                inputs_chunk,
+                grad_outputs[offset : offset + max_chunk_size],
+                _select_adapter_chunk(active_adapter, offset, max_chunk_size),
+                backends,
+                [_select_batch_chunk(prompt, offset, max_chunk_size) for prompt in prompts],
+            )
+            if batch_size > max_chunk_size:
+                grad_inputs[offset : offset + max_chunk_size] = grad_inputs_chunk
+            else:
+                grad_inputs = grad_inputs_chunk  # saves one memcopy
+            grad_prompt_chunks.append(grad_prompts_chunk)
+
+        grad_prompts = torch.cat(grad_prompt_chunks, dim=1) if not is_dummy(grad_prompt_chunks[0]) else DUMMY
+        return grad_inputs, grad_prompts
+
+    @staticmethod
+    def _cached_backward_chunk(
+        block_inputs: Sequence[torch.Tensor],
+        grad_outputs: torch.Tensor,
+        active_adapter: str,
+        backends: Sequence[TransformerBackend],
+        prompts: Sequence[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Block inputs were saved during forward, so we only need to run backward for each block
+        grad_prompts_reversed = []
+        for inp, prompt, backend in zip(*map(reversed, (block_inputs, prompts, backends))):
+            (grad_outputs,) = backend.backward(inp, grad_outputs, active_adapter)
+            if not is_dummy(prompt):
+                grad_prompts_reversed.append(grad_outputs[:, : prompt.shape[1]].unsqueeze(0))
+
+        grad_prompts = torch.cat(grad_prompts_reversed[::-1], dim=0) if grad_prompts_reversed else DUMMY
+        return grad_outputs, grad_prompts
+
+    @staticmethod
+    def _fused_backward_chunk(
+        inputs: torch.Tensor,
+        grad_outputs: torch.Tensor,
+        active_adapter: str,
+        backends: Sequence[TransformerBackend],
+        prompts: Sequence[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Run each block forward once, keeping the autograd graph of the whole span, then backpropagate through it
+        with torch.enable_grad():
+            inputs = hidden_states = inputs.detach().requires_grad_(True)
+            prompted_inputs = []
+            for backend, prompt in zip(backends, prompts):
+                if not is_dummy(prompt):
+                    pre_seq_len = prompt.shape[1]
+                    hidden_states = torch.cat(
+                        [hidden_states[:, :pre_seq_len] + prompt, hidden_states[:, pre_seq_len:]], dim=1
+                    )
+                    prompted_inputs.append(hidden_states)
+                hidden_states = backend.forward_with_grad(hidden_states, active_adapter)
+
+            grad_outputs = grad_outputs.to(device=hidden_states.device, dtype=hidden_states.dtype)
+            grad_inputs, *grad_prompted_inputs = torch.autograd.grad(
+                hidden_states, [inputs, *prompted_inputs], grad_outputs=grad_outputs
+            )
+
+        prompt_lengths = [prompt.shape[1] for prompt in prompts if not is_dummy(prompt)]
+        grad_prompts = [grad[:, :length].unsqueeze(0) for grad, length in zip(grad_prompted_inputs, prompt_lengths)]
+        return grad_inputs, torch.cat(grad_prompts, dim=0) if grad_prompts else DUMMY
+
+    @staticmethod
+    def _recomputing_backward_chunk(
+        inputs: torch.Tensor,
+        grad_outputs: torch.Tensor,
+        active_adapter: str,
+        backends: Sequence[TransformerBackend],
+        prompts: Sequence[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Run a forward chain to collect intermediate inputs
+        # Note that we do not forward for the last module since we do not need its output
+        inter_inputs = []
+        for backend, prompt in zip(backends[:-1], prompts[:-1]):
+            if not is_dummy(prompt):
+                inputs[:, : prompt.shape[1]] += prompt
+            inter_inputs.append(inputs)
+            (inputs,) = backend.forward(inputs, active_adapter)
+
+        if not is_dummy(prompts[-1]):
+            inputs[:, : prompts[-1].shape[1]] += prompts[-1]
+        inter_inputs.append(inputs)
+
+        grad_prompts_reversed = []
+        for inp, prompt, backend in zip(*map(reversed, (inter_inputs, prompts, backends))):
+            (grad_outputs,) = backend.backward(inp, grad_outputs, active_adapter)
+            if not is_dummy(prompt):
+                grad_prompts_reversed.append(grad_outputs[:, : prompt.shape[1]].unsqueeze(0))
+
+        grad_prompts = torch.cat(grad_prompts_reversed[::-1], dim=0) if grad_prompts_reversed else DUMMY
+        return grad_outputs, grad_prompts
+
+
+def _select_batch_chunk(prompt: torch.Tensor, offset: int, max_chunk_size: int) -> torch.Tensor:
+    """Select prompts for a chunk of the batch, keeping prompts that are broadcasted over the batch intact"""
+    if is_dummy(prompt) or prompt.shape[0] == 1:
+        return prompt
+    return prompt[offset : offset + max_chunk_size]
+
+
+def _select_adapter_chunk(
+    active_adapter: Optional[Union[str, Tuple[str, ...]]], offset: int, max_chunk_size: int
+) -> Optional[Union[str, Tuple[str, ...]]]:
+    """Select adapters for a chunk of the batch if they are set per row (see using_adapter)"""
+    if active_adapter is None or isinstance(active_adapter, str):
+        return active_adapter
+    return tuple(active_adapter[offset : offset + max_chunk_size])
@@ -0,0 +1,206 @@
+"""
+A disk cache of converted blocks (enabled by --cache_converted_blocks).
+
+Loading a block from the original checkpoint involves parsing its shards, casting weights to the server's dtype and
+quantizing them. With this cache, the server saves each block after these steps to a safetensors file under
+<cache_dir>/converted_blocks, so that restarts (and rebalancing to previously served blocks) only need to memory-map
+this file. The files are evicted together with other cached files when disk space is needed (see free_disk_space_for).
+
+Blocks are cached before tensor parallelism and adapters are applied, so the cache does not depend on the device
+layout. Quantization types that are applied while moving weights to GPU (bitsandbytes' int8 and nf4) are not cached.
+
+Servers on the same host that use the same --cache_dir share the memory of blocks they both serve on CPU: tensors of
+non-quantized blocks stay memory-mapped from the cached file, so the OS keeps one copy of them in the page cache.
+To make this work for blocks that are not cached yet, only one process converts a block at a time (holding a lock
+file next to it), while the others wait and then map the file saved by it.
+"""
+import fcntl
+import os
+import re
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import torch
+import torch.nn as nn
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from hivemind.utils.logging import get_logger
+from safetensors.torch import save_file
+from transformers import PretrainedConfig
+
+from peerz.server.block_utils import get_model_block
+from peerz.server.block_weights import BlockWeightsClient, StateDict
+from peerz.server.from_pretrained import _load_state_dict_from_local_file, load_pretrained_block
+from peerz.utils.convert_block import CpuInt8Linear, QuantType, quantize_module
+from peerz.utils.disk_cache import (
+    CONVERTED_BLOCKS_DIR,
+    DEFAULT_CACHE_DIR,
+    allow_cache_reads,
+    allow_cache_writes,
+    free_disk_space_for,
+    register_cached_file,
+    unregister_cached_file,
+)
+
+logger = get_logger(__name__)
+
+BLOCK_CACHE_VERSION = 1  # Increase this when the format of cached blocks changes
+CACHEABLE_QUANT_TYPES = (QuantType.NONE, QuantType.CPU_INT8)
+
+
+def load_quantized_block(
+    model_name: str,
+    block_index: int,
+    *,
+    config: PretrainedConfig,
+    torch_dtype: torch.dtype,
+    quant_type: QuantType,
+    revision: Optional[str] = None,
+    token: Optional[Union[str, bool]] = None,
+    cache_dir: Optional[str] = None,
+    max_disk_space: Optional[int] = None,
+    block_weights_client: Optional[BlockWeightsClient] = None,
+) -> nn.Module:
+    """
+    Load a block with weights in :torch_dtype: and quantized with :quant_type: (on CPU), reusing the cached block if
+    possible. The result should then be passed to convert_block(), where quantize_module() does not change it further.
+
+    :param block_weights_client: if set, blocks that are not cached are downloaded from other servers that share them
+      (converted if they have it in their cache, original otherwise) before trying the HF Hub
+    """
+    assert quant_type in CACHEABLE_QUANT_TYPES, f"blocks with quant_type={quant_type} can't be cached"
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    path = get_converted_block_path(
+        model_name, block_index, revision=revision, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+    )
+
+    with _converting_lock(path):
+        block = _load_cached_block(
+            path, config=config, block_index=block_index, quant_type=quant_type, cache_dir=cache_dir
+        )
+        if block is not None:
+            logger.info(f"Loaded {model_name} block {block_index} from the converted block cache")
+            return block
+
+        state_dict = None
+        if block_weights_client is not None:
+            state_dict = block_weights_client.get_state_dict(
+                block_index, torch_dtype=torch_dtype, quant_type=quant_type
+            )
+        if state_dict is not None:
+            block = _create_block(state_dict, config=config, block_index=block_index, quant_type=quant_type)
+        else:
+            block = load_pretrained_block(
+                model_name,
+                block_index,
+                config=config,
+                torch_dtype=torch_dtype,
+                revision=revision,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+                block_weights_client=block_weights_client,
+            )
+            if quant_type != QuantType.NONE:
+                block = quantize_module(block, quant_type=quant_type)
+            state_dict = block.state_dict()
+
+        is_saved = _save_cached_state_dict(state_dict, path, cache_dir=cache_dir, max_disk_space=max_disk_space)
+        if is_saved and quant_type == QuantType.NONE:
+            # Use the mapping of the saved file instead of the private copy, so that other servers on this host
+            # share memory with this block (quantized layers pack their weights into private memory anyway)
+            mapped_block = _load_cached_block(
+                path, config=config, block_index=block_index, quant_type=quant_type, cache_dir=cache_dir
+            )
+            if mapped_block is not None:
+                block = mapped_block
+        return block
+
+
+def get_converted_block_path(
+    model_name: str,
+    block_index: int,
+    *,
+    revision: Optional[str],
+    torch_dtype: torch.dtype,
+    quant_type: QuantType,
+    cache_dir: str,
+) -> str:
+    repo_dir = re.sub(r"[^\w.-]", "--", f"{model_name.strip('/')}@{revision or 'main'}")
+    dtype_name = str(torch_dtype).replace("torch.", "")
+    filename = f"block{block_index}.{dtype_name}.{quant_type.name.lower()}.safetensors"
+    return os.path.join(cache_dir, CONVERTED_BLOCKS_DIR, f"v{BLOCK_CACHE_VERSION}", repo_dir, filename)
+
+
+@contextmanager
+def _converting_lock(path: str):
+    """Ensures that only one process (or thread) on this host converts and saves a block at a time"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "wb+") as lock_fd:
+        fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
+        # The OS will release the lock when lock_fd is closed or the process is killed
+        yield
+
+
+def _load_cached_block(
+    path: str, *, config: PretrainedConfig, block_index: int, quant_type: QuantType, cache_dir: str
+) -> Optional[nn.Module]:
+    try:
+        with allow_cache_reads(cache_dir):
+            if not os.path.exists(path):
+                return None
+            state_dict = _load_state_dict_from_local_file(path)  # Tensors stay memory-mapped from the file
+            os.utime(path)  # Mark as recently used for free_disk_space_for()
+        return _create_block(state_dict, config=config, block_index=block_index, quant_type=quant_type)
+    except Exception:
+        logger.warning(f"Failed to load cached block from {path}, it will be converted again", exc_info=True)
+        with allow_cache_writes(cache_dir):
+            if os.path.exists(path):
+                unregister_cached_file(path, cache_dir=cache_dir)
+                os.remove(path)
+        return None
+
+
+def _create_block(
+    state_dict: StateDict, *, config: PretrainedConfig, block_index: int, quant_type: QuantType
+) -> nn.Module:
+    with init_empty_weights():
+        block = get_model_block(config, layer_idx=block_index)
+        if quant_type == QuantType.CPU_INT8:
+            _replace_linear_layers_with_cpu_int8(block)
+    expected_keys = block.state_dict().keys()
+    if state_dict.keys() != expected_keys:
+        raise RuntimeError(
+            f"Cached block has unexpected tensors {sorted(state_dict.keys() - expected_keys)} "
+            f"and misses tensors {sorted(expected_keys - state_dict.keys())}"
+        )
+    for name, tensor in state_dict.items():
+        # Unlike load_state_dict(), this keeps tensors memory-mapped instead of copying them into empty weights
+        set_module_tensor_to_device(block, name, "cpu", value=tensor, dtype=tensor.dtype)
+    return block
+
+
+def _save_cached_state_dict(state_dict: StateDict, path: str, *, cache_dir: str, max_disk_space: Optional[int]) -> bool:
+    state_dict = {name: tensor.contiguous() for name, tensor in state_dict.items()}
+    size = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+    try:
+        with allow_cache_writes(cache_dir):
+            free_disk_space_for(size, cache_dir=cache_dir, max_disk_space=max_disk_space)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_file(state_dict, path + ".tmp")
+            os.replace(path + ".tmp", path)  # Readers never see partially written files
+            register_cached_file(path, cache_dir=cache_dir)
+        return True
+    except Exception:
+        logger.warning(f"Failed to save converted block to {path}, the server will work without it", exc_info=True)
+        return False
+
+
+def _replace_linear_layers_with_cpu_int8(module: nn.Module):
+    """Create empty CpuInt8Linear layers in the same places as quantize_module(), to load their state dicts later"""
+    for name, child in module.named_children():
+        if len(list(child.children())) > 0:
+            _replace_linear_layers_with_cpu_int8(child)
+        if isinstance(child, nn.Linear) and name not in ["lm_head", "score"]:
+            module._modules[name] = CpuInt8Linear(child.in_features, child.out_features, bias=child.bias is not None)
@@ -32,10 +32,11 @@ logger = get_logger(__name__)
 async def run_rpc_forward(
     *flat_tensors: torch.Tensor,
     requested_backends: Sequence[TransformerBackend],
-    active_adapter: str = "",
+    active_adapter: Union[str, Tuple[str, ...]] = "",
     prioritizer: TaskPrioritizerBase,
     points: int = 0,
     args_structure: Any = None,
+    step_id: Optional[str] = None,
 ) -> torch.Tensor:
     """
     Run forward pass on deserialized inputs and prompts, used by rpc_forward and rpc_forward_stream
@@ -43,6 +44,7 @@ async def run_rpc_forward(
     :param flat_tensors: a list of tensors that includes first layer inputs, optional prompts and extra tensors
     :note: some input tensors can be missing, in which case they will be replaced with dummy tensors (see is_dummy)
     :param requested_backends: a sequence of transformer blocks in the same order as they appear in forward pass
+    :param step_id: if specified, block inputs are kept in the activation cache for the backward pass of this step
     :returns: hidden states after the last layer [batch_size, seq_length, hid_size]
     """
     if args_structure is not None:
@@ -59,24 +61,18 @@ async def run_rpc_forward(
     else:
         prompts = [p.squeeze(0) for p in prompts.to(requested_backends[0].dtype).split(1, dim=0)]
 
-    # Run a chain of requested backends
-    for backend, prompt in zip(requested_backends, prompts):
-        if not is_dummy(prompt):
-            hidden_states[:, : prompt.shape[1]] += prompt
+    if len(prompts) != len(requested_backends):
+        raise ValueError(f"Received {len(prompts)} prompts for {len(requested_backends)} backends")
 
-        assert isinstance(backend.inference_pool, PrioritizedTaskPool), "peerz support only prioritized pools"
-        priority = prioritizer.prioritize(
-            hidden_states, points=points / len(requested_backends), backend=backend, type="forward"
-        )
-        (hidden_states,) = await backend.forward_pool.submit_task(
-            hidden_states,
-            active_adapter,
-            priority=priority,
-        )
-        assert isinstance(hidden_states, torch.Tensor)
-        assert (
-            hidden_states.ndim == 3
-        ), f"inputs to {type(backend)} must be a list with a single 3d tensor of hidden states"
+    # Run the whole chain of requested backends as a single task, see _MergedForwardStep
+    requested_uids = tuple(backend.name for backend in requested_backends)
+    assert isinstance(requested_backends[0].forward_pool, PrioritizedTaskPool), "peerz support only prioritized pools"
+    priority = prioritizer.prioritize(hidden_states, points=points, requested_uids=requested_uids, type="forward")
+    (hidden_states,) = await requested_backends[0].forward_pool.submit_task(
+        hidden_states, active_adapter, requested_uids, step_id, *prompts, priority=priority
+    )
+    assert isinstance(hidden_states, torch.Tensor)
+    assert hidden_states.ndim == 3, f"outputs of {requested_uids} must be a single 3d tensor of hidden states"
 
     return hidden_states
 
@@ -84,10 +80,11 @@ async def run_rpc_forward(
 async def run_rpc_backward(
     *flat_tensors: torch.Tensor,
     requested_backends: Sequence[TransformerBackend],
-    active_adapter: str = "",
+    active_adapter: Union[str, Tuple[str, ...]] = "",
     prioritizer: TaskPrioritizerBase,
     points: int = 0,
     args_structure: Any = None,
+    step_id: Optional[str] = None,
 ) -> Union[torch.Tensor, Sequence[torch.Tensor]]:
     if args_structure is not None:
         # TODO: kwargs currently is unused, it can be used later for peft-like adaptation
@@ -103,48 +100,28 @@ async def run_rpc_backward(
     else:
         prompts = [p.squeeze(0) for p in prompts.to(requested_backends[0].dtype).split(1, dim=0)]
 
-    # Run a forward chain to collect intermediate inputs
-    # Note that we do not forward for the last module since we do not need its output
-    inter_inputs = []
-    for backend, prompt in zip(requested_backends[:-1], prompts[:-1]):
-        assert inputs.ndim == 3, f"inputs to {type(backend)} must be a single 3d tensor of hidden states"
-        if not is_dummy(prompt):
-            inputs[:, : prompt.shape[1]] += prompt
-        inter_inputs.append(inputs)
-        assert isinstance(backend.inference_pool, PrioritizedTaskPool), "peerz support only prioritized pools"
-        priority = prioritizer.prioritize(
-            inputs, points=points / len(requested_backends), backend=backend, type="forward_in_backward"
-        )
-        (inputs,) = await backend.forward_pool.submit_task(inputs, active_adapter, priority=priority)
-
-        assert isinstance(inputs, torch.Tensor)
+    if len(prompts) != len(requested_backends):
+        raise ValueError(f"Received {len(prompts)} prompts for {len(requested_backends)} backends")
+
+    # Run backward through the whole chain as a single task, see _MergedBackwardStep
+    requested_uids = tuple(backend.name for backend in requested_backends)
+    assert inputs.ndim == 3, f"inputs to {requested_uids} must be a single 3d tensor of hidden states"
+    assert isinstance(requested_backends[0].backward_pool, PrioritizedTaskPool), "peerz support only prioritized pools"
+    priority = prioritizer.prioritize(
+        inputs, grad_outputs, points=points, requested_uids=requested_uids, type="backward"
+    )
+    grad_outputs, grad_prompts = await requested_backends[0].backward_pool.submit_task(
+        inputs, grad_outputs, active_adapter, requested_uids, step_id, *prompts, priority=priority
+    )
+    assert isinstance(grad_outputs, torch.Tensor)
 
-    if not is_dummy(prompts[-1]):
-        inputs[:, : prompts[-1].shape[1]] += prompts[-1]
-    inter_inputs.append(inputs)
-
-    assert len(inter_inputs) == len(prompts) == len(requested_backends), "internal shape error during backward"
-    grad_prompts_reversed = []
-    # Run a chain of requested backends
-    for inp, prompt, backend in zip(*map(reversed, (inter_inputs, prompts, requested_backends))):
-        assert isinstance(backend.inference_pool, PrioritizedTaskPool), "peerz support only prioritized pools"
-        priority = prioritizer.prioritize(
-            inp, grad_outputs, points=points / len(requested_backends), backend=backend, type="backward"
-        )
-        (grad_outputs,) = await backend.backward_pool.submit_task(inp, grad_outputs, active_adapter, priority=priority)
-
-        assert isinstance(grad_outputs, torch.Tensor)
-        if not is_dummy(prompt):
-            grad_prompts_reversed.append(grad_outputs[:, : prompt.shape[1]].unsqueeze(0))
-
-    grad_prompts = torch.cat(grad_prompts_reversed[::-1], dim=0) if grad_prompts_reversed else DUMMY
     return [grad_outputs] if is_dummy(grad_prompts) else [grad_outputs, grad_prompts]  # TODO un-duct-tape
 
 
 async def iterate_rpc_inference(
     requested_uids: Sequence[ExpertUID],
     requested_backends: Sequence[TransformerBackend],
-    active_adapter: Optional[str],
+    active_adapter: Optional[Union[str, Tuple[str, ...]]],
     input_iterator: AsyncIterator[Tuple[runtime_pb2.ExpertRequest, dict]],
     cache_handles: Sequence[Sequence[Handle]],
     *,
@@ -152,6 +129,7 @@ async def iterate_rpc_inference(
     prioritizer: TaskPrioritizerBase,
     points: int,
     quant_type: QuantType,
+    max_short_inference_tokens: Optional[int] = None,
     args_structure: Any = None,
 ) -> AsyncIterator[Tuple[Sequence[runtime_pb2.Tensor], bool, Dict]]:
     assert len(cache_handles) == len(requested_backends)
@@ -189,7 +167,11 @@ async def iterate_rpc_inference(
                 f" exceeds pre-allocated maximum {max_length}"
             )
 
-        merge_max_tokens = MAX_NF4_SHORT_INFERENCE_TOKENS if quant_type == QuantType.NF4 else MAX_SHORT_INFERENCE_TOKENS
+        merge_max_tokens = max_short_inference_tokens
+        if merge_max_tokens is None:
+            merge_max_tokens = (
+                MAX_NF4_SHORT_INFERENCE_TOKENS if quant_type == QuantType.NF4 else MAX_SHORT_INFERENCE_TOKENS
+            )
         can_merge_pools = batch_size * length_increment <= merge_max_tokens
         priority = prioritizer.prioritize(
             hidden_states,
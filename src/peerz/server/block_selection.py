@@ -20,9 +20,34 @@ def compute_throughputs(spans: Dict[PeerID, RemoteSpanInfo], *, total_blocks: in
     return throughputs
 
 
+def _sliding_window_min(values: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    Compute minima of all windows of :window_size: consecutive values in O(len(values)) time (van Herk/Gil-Werman):
+    each window covers the suffix of one group of :window_size: values and the prefix of the next one, so its minimum
+    is the minimum of the suffix minimum and the prefix minimum computed within these groups
+    """
+    num_windows = len(values) - window_size + 1
+    groups = np.pad(values, (0, -len(values) % window_size), constant_values=values.max()).reshape(-1, window_size)
+    prefix_mins = np.minimum.accumulate(groups, axis=1).ravel()
+    suffix_mins = np.minimum.accumulate(groups[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.minimum(suffix_mins[:num_windows], prefix_mins[window_size - 1 : window_size - 1 + num_windows])
+
+
 def _choose_best_start(throughputs: np.ndarray, num_blocks: int) -> int:
-    options = ((sorted(throughputs[i : i + num_blocks]), i) for i in range(0, len(throughputs) - num_blocks + 1))
-    return min(options)[-1]
+    """
+    Choose the span of :num_blocks: blocks whose sorted throughputs are the lexicographically smallest (i.e., the span
+    with the weakest bottleneck, then the weakest 2nd smallest throughput, etc.), the leftmost one in case of ties
+    """
+    # Only the spans sharing the smallest sliding-window minimum can win, so we compare other order statistics
+    # just for them (usually, these are a few spans covering the same bottleneck block)
+    window_mins = _sliding_window_min(throughputs, num_blocks)
+    (candidates,) = np.nonzero(window_mins == window_mins.min())
+    if len(candidates) == 1:
+        return int(candidates[0])
+    windows = np.lib.stride_tricks.sliding_window_view(throughputs, num_blocks)
+    sorted_windows = np.sort(windows[candidates], axis=1)
+    order = np.lexsort(sorted_windows.T[::-1])  # The sort is stable, so ties keep the leftmost span first
+    return int(candidates[order[0]])
 
 
 def choose_best_blocks(num_blocks: int, module_infos: List[RemoteModuleInfo]) -> List[int]:
@@ -33,6 +58,28 @@ def choose_best_blocks(num_blocks: int, module_infos: List[RemoteModuleInfo]) ->
     return list(range(start, start + num_blocks))
 
 
+def choose_standby_blocks(local_peer_id: PeerID, module_infos: List[RemoteModuleInfo]) -> List[int]:
+    """
+    Choose blocks that this server would likely load if it moves to other blocks, from the most to the least likely:
+    first, the blocks of the span that _choose_best_start() chooses without this server, then the blocks adjacent
+    to the current span (the closest ones first)
+    """
+    spans = compute_spans(module_infos, min_state=ServerState.JOINING)
+    if local_peer_id not in spans:
+        return []
+    throughputs = compute_throughputs(spans, total_blocks=len(module_infos))
+    local_span = spans[local_peer_id]
+    throughputs[local_span.start : local_span.end] -= local_span.throughput
+
+    new_start = _choose_best_start(throughputs, local_span.length)
+    candidates = list(range(new_start, new_start + local_span.length))
+    for distance in range(1, len(module_infos)):
+        candidates.extend([local_span.end - 1 + distance, local_span.start - distance])
+
+    candidates = [i for i in candidates if 0 <= i < len(module_infos) and not local_span.start <= i < local_span.end]
+    return list(dict.fromkeys(candidates))  # Removes duplicates, keeping the order
+
+
 def _move_span(span: RemoteSpanInfo, new_start: int):
     span.start, span.end = new_start, new_start + span.length
 
@@ -40,7 +40,7 @@ def get_block_size(
         if quant_type == QuantType.NONE:
             dtype = resolve_block_dtype(config, dtype)
             bytes_per_value = get_size_in_bytes(dtype)
-        elif quant_type == QuantType.INT8:
+        elif quant_type in (QuantType.INT8, QuantType.CPU_INT8):
             bytes_per_value = 1
         elif quant_type == QuantType.NF4:
             bytes_per_value = 4.25 / 8  # Bitness of NF4 with this config (measured empirically)
@@ -53,6 +53,13 @@ def get_block_size(
     return round(n_params * bytes_per_value * (1 + eps))
 
 
+def get_expert_params_per_block(config: PretrainedConfig) -> int:
+    """The number of parameters in Mixture-of-Experts MLPs of one block (0 for models without experts)"""
+    if config.block_class != WrappedMixtralBlock:
+        return 0
+    return config.num_local_experts * 3 * config.hidden_size * config.intermediate_size
+
+
 def get_model_block(config, layer_idx: int = 0):
     """
     The function to create a model block based on the block class
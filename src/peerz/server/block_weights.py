@@ -0,0 +1,261 @@
+"""
+Transferring block weights between servers (enabled by --share_block_weights).
+
+With --fetch_block_weights, a server that loads a block first asks other servers that announce shares_block_weights
+for it. These servers send the block's tensors from their disk cache: either in the original form (the block's part of
+the checkpoint) or converted to the requester's dtype and quantization (if they have it in the converted block cache).
+
+The content hash sent along with the tensors comes from the same peer, so it does not protect from malicious peers by
+itself. Therefore, the requester downloads blocks only from peers it trusts (--trusted_weight_peers, e.g. in private
+swarms). Alternatively, with --allow_untrusted_weight_peers, it asks several peers for the hash first and accepts the
+tensors only if at least :min_agreeing_peers: of them report the same one. This is not a protection in a public swarm,
+since one operator may run several malicious peers, so this mode is meant for swarms where all servers are known.
+The requester falls back to the HF Hub if no peers can send verified tensors.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections import Counter
+from functools import partial
+from typing import AsyncIterator, Collection, Dict, List, Optional, Tuple
+
+import torch
+from async_timeout import timeout
+from hivemind import DHT, MSGPackSerializer, PeerID, anext
+from hivemind.compression.serialization import deserialize_tensor_stream, serialize_torch_tensor
+from hivemind.moe.client.remote_expert_worker import RemoteExpertWorker
+from hivemind.p2p.p2p_daemon import DEFAULT_MAX_MSG_SIZE
+from hivemind.proto import runtime_pb2
+from hivemind.utils.logging import get_logger
+from hivemind.utils.streaming import split_for_streaming
+
+from peerz.constants import DTYPE_MAP
+from peerz.data_structures import UID_DELIMITER, ModuleUID, ServerState
+from peerz.utils.convert_block import QuantType
+from peerz.utils.dht import get_remote_module_infos
+
+logger = get_logger(__name__)
+
+StateDict = Dict[str, torch.Tensor]
+
+
+class BlockWeightsSource:
+    """Reads weights of blocks from the local disk cache (without downloading them) to send them to other servers"""
+
+    def __init__(self, model_name: str, *, block_prefix: str, revision: Optional[str], cache_dir: str):
+        self.model_name, self.block_prefix = model_name, block_prefix
+        self.revision, self.cache_dir = revision, cache_dir
+
+    def load_state_dict(
+        self, block_index: int, *, torch_dtype: Optional[str] = None, quant_type: Optional[str] = None
+    ) -> StateDict:
+        """
+        Load the original weights of a block or, if :torch_dtype: and :quant_type: are specified, the converted ones.
+        Raises FileNotFoundError if they are not cached.
+        """
+        # Delay imports to avoid circular imports (these modules load blocks using BlockWeightsClient)
+        from peerz.server.block_cache import get_converted_block_path
+        from peerz.server.from_pretrained import _load_state_dict_from_local_file, _load_state_dict_from_repo
+        from peerz.utils.disk_cache import allow_cache_reads
+
+        if torch_dtype is None and quant_type is None:
+            return _load_state_dict_from_repo(
+                self.model_name,
+                f"{self.block_prefix}.{block_index}.",
+                revision=self.revision,
+                cache_dir=self.cache_dir,
+                local_files_only=True,
+            )
+
+        path = get_converted_block_path(
+            self.model_name,
+            block_index,
+            revision=self.revision,
+            torch_dtype=DTYPE_MAP[torch_dtype],
+            quant_type=QuantType[quant_type.upper()],
+            cache_dir=self.cache_dir,
+        )
+        with allow_cache_reads(self.cache_dir):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Converted block {block_index} is not cached")
+            return _load_state_dict_from_local_file(path)
+
+    async def iterate_responses(
+        self,
+        block_index: int,
+        *,
+        torch_dtype: Optional[str] = None,
+        quant_type: Optional[str] = None,
+        hash_only: bool = False,
+    ) -> AsyncIterator[runtime_pb2.ExpertResponse]:
+        """
+        Stream a block's weights: the first message has their names, dtypes and hash, the next ones have tensors
+        (unless :hash_only: is True)
+        """
+        loop = asyncio.get_running_loop()
+        state_dict = await loop.run_in_executor(
+            None, partial(self.load_state_dict, block_index, torch_dtype=torch_dtype, quant_type=quant_type)
+        )
+        keys = sorted(state_dict)
+        header = dict(
+            keys=keys,
+            dtypes=[str(state_dict[key].dtype).replace("torch.", "") for key in keys],
+            hash=await loop.run_in_executor(None, get_weights_hash, state_dict),
+        )
+        yield runtime_pb2.ExpertResponse(metadata=MSGPackSerializer.dumps(header))
+        if hash_only:
+            return
+
+        for key in keys:
+            tensor = state_dict[key]
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)  # hivemind sends bfloat16 as float32, so we send the raw bits instead
+            serialized = await loop.run_in_executor(None, serialize_torch_tensor, tensor)
+            for part in split_for_streaming(serialized, DEFAULT_MAX_MSG_SIZE):
+                yield runtime_pb2.ExpertResponse(tensors=[part])
+
+
+class BlockWeightsClient:
+    """
+    Downloads weights of blocks from other servers that share them (see BlockWeightsSource)
+
+    :param trusted_peers: if set, download weights only from these peers and accept the hashes they send. Otherwise,
+      download weights from any peers, but only if at least :min_agreeing_peers: of them report the same hash
+    """
+
+    def __init__(
+        self,
+        dht: DHT,
+        dht_prefix: str,
+        *,
+        trusted_peers: Optional[Collection[PeerID]] = None,
+        min_agreeing_peers: int = 2,
+        max_peers: int = 3,
+        request_timeout: float = 30 * 60,
+    ):
+        assert trusted_peers is None or len(trusted_peers) > 0, "trusted_peers must be None or non-empty"
+        assert 1 <= min_agreeing_peers <= max_peers, "min_agreeing_peers must be between 1 and max_peers"
+        self.dht, self.dht_prefix = dht, dht_prefix
+        self.trusted_peers = set(trusted_peers) if trusted_peers is not None else None
+        self.min_agreeing_peers, self.max_peers, self.request_timeout = min_agreeing_peers, max_peers, request_timeout
+        self._p2p = None
+
+    def get_state_dict(
+        self, block_index: int, *, torch_dtype: Optional[torch.dtype] = None, quant_type: Optional[QuantType] = None
+    ) -> Optional[StateDict]:
+        """
+        Download the original weights of a block (or the converted ones, if :torch_dtype: and :quant_type: are
+        specified) from a random server that shares them. Returns None if no servers managed to send verified weights.
+        """
+        uid = f"{self.dht_prefix}{UID_DELIMITER}{block_index}"
+        try:
+            (module_info,) = get_remote_module_infos(self.dht, [uid], latest=True)
+        except Exception as e:
+            logger.warning(f"Failed to find servers that share block {block_index}: {repr(e)}")
+            return None
+        peer_ids = [
+            peer_id
+            for peer_id, server_info in module_info.servers.items()
+            if server_info.shares_block_weights
+            and server_info.state != ServerState.OFFLINE
+            and peer_id != self.dht.peer_id
+            and (self.trusted_peers is None or peer_id in self.trusted_peers)
+        ]
+        random.shuffle(peer_ids)
+        peer_ids = peer_ids[: self.max_peers]
+
+        metadata = {}
+        if torch_dtype is not None:
+            metadata["torch_dtype"] = str(torch_dtype).replace("torch.", "")
+        if quant_type is not None:
+            metadata["quant_type"] = quant_type.name.lower()
+
+        agreed_hash = None
+        if self.trusted_peers is None:
+            agreed_hash, peer_ids = self._get_agreed_hash(block_index, uid, peer_ids, metadata)
+            if agreed_hash is None:
+                return None
+
+        for peer_id in peer_ids:
+            try:
+                start_time = time.perf_counter()
+                state_dict, expected_hash = RemoteExpertWorker.run_coroutine(self._download(peer_id, uid, metadata))
+                if agreed_hash is not None and expected_hash != agreed_hash:
+                    raise ValueError("The peer sent a hash different from the one reported by other peers")
+                if get_weights_hash(state_dict) != expected_hash:
+                    raise ValueError("Received weights do not match their hash")
+                logger.info(
+                    f"Downloaded block {block_index} from peer {peer_id} in {time.perf_counter() - start_time:.1f} sec"
+                )
+                return state_dict
+            except Exception as e:
+                logger.warning(f"Failed to download block {block_index} from peer {peer_id}: {repr(e)}")
+        return None
+
+    def _get_agreed_hash(
+        self, block_index: int, uid: ModuleUID, peer_ids: List[PeerID], metadata: dict
+    ) -> Tuple[Optional[str], List[PeerID]]:
+        """Ask :peer_ids: for the hash of the weights, return the hash reported by enough of them and these peers"""
+        reported_hashes = {}
+        for peer_id in peer_ids:
+            try:
+                reported_hashes[peer_id] = RemoteExpertWorker.run_coroutine(self._get_hash(peer_id, uid, metadata))
+            except Exception as e:
+                logger.debug(f"Failed to get the hash of block {block_index} from peer {peer_id}: {repr(e)}")
+
+        agreed_hash, num_agreeing = (
+            Counter(reported_hashes.values()).most_common(1)[0] if reported_hashes else (None, 0)
+        )
+        if num_agreeing >= self.min_agreeing_peers:
+            return agreed_hash, [peer_id for peer_id in reported_hashes if reported_hashes[peer_id] == agreed_hash]
+        if peer_ids:
+            logger.info(
+                f"Not downloading block {block_index} from peers: only {num_agreeing} of {len(peer_ids)} peers "
+                f"report the same weights, {self.min_agreeing_peers} are required"
+            )
+        return None, []
+
+    async def _get_hash(self, peer_id: PeerID, uid: ModuleUID, metadata: dict) -> str:
+        stub = await self._get_stub(peer_id)
+        request = runtime_pb2.ExpertRequest(uid=uid, metadata=MSGPackSerializer.dumps(dict(metadata, hash_only=True)))
+        async with timeout(self.request_timeout):
+            header = MSGPackSerializer.loads((await anext(await stub.rpc_get_block_weights(request))).metadata)
+        return header["hash"]
+
+    async def _download(self, peer_id: PeerID, uid: ModuleUID, metadata: dict) -> Tuple[StateDict, str]:
+        stub = await self._get_stub(peer_id)
+        request = runtime_pb2.ExpertRequest(uid=uid, metadata=MSGPackSerializer.dumps(metadata))
+        async with timeout(self.request_timeout):
+            return await receive_block_weights(await stub.rpc_get_block_weights(request))
+
+    async def _get_stub(self, peer_id: PeerID):
+        from peerz.server.handler import TransformerConnectionHandler  # Delay import to avoid a circular import
+
+        if self._p2p is None:
+            self._p2p = await self.dht.replicate_p2p()
+        return TransformerConnectionHandler.get_stub(self._p2p, peer_id)
+
+
+async def receive_block_weights(responses: AsyncIterator[runtime_pb2.ExpertResponse]) -> Tuple[StateDict, str]:
+    """Parse responses of BlockWeightsSource.iterate_responses(), return the weights and their expected hash"""
+    header = MSGPackSerializer.loads((await anext(responses)).metadata)
+    tensors = await deserialize_tensor_stream(response.tensors async for response in responses)
+    if len(tensors) != len(header["keys"]):
+        raise ValueError(f"Expected {len(header['keys'])} tensors, got {len(tensors)}")
+    state_dict = {
+        key: tensor.view(torch.bfloat16) if dtype == "bfloat16" else tensor
+        for key, dtype, tensor in zip(header["keys"], header["dtypes"], tensors)
+    }
+    return state_dict, header["hash"]
+
+
+def get_weights_hash(state_dict: StateDict) -> str:
+    """A hash of tensor names, dtypes, shapes, and contents, used to verify weights received from other servers"""
+    hasher = hashlib.sha256()
+    for key in sorted(state_dict):
+        tensor = state_dict[key].detach().cpu().contiguous()
+        hasher.update(f"{key}:{tensor.dtype}:{list(tensor.shape)};".encode())
+        hasher.update(tensor.view(-1).view(torch.uint8).numpy())
+    return hasher.hexdigest()
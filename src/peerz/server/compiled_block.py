@@ -0,0 +1,112 @@
+"""
+Running transformer blocks with torch.compile (enabled by --compile).
+
+CompiledBlock wraps a converted block and runs its forward and inference steps through torch.compile. To keep the
+number of distinct shapes (and thus recompilations) small, inputs are padded to the nearest (batch_size, seq_len)
+bucket. This is safe since blocks use causal attention: padding tokens go after the real ones and do not affect
+them, while their keys/values are written to the cache after the real tokens and overwritten by the next step.
+Buckets are prewarmed in ModuleContainer.create, and inductor's graph cache is stored under the peerz cache dir,
+so that a restarted server reuses compiled kernels instead of compiling them again.
+
+Backward passes are not compiled: they run through the original block. Parts of a block that torch.compile can't trace
+(e.g., data-dependent expert routing in Mixtral) run eagerly between compiled graphs. If compiling a block fails,
+the error is logged and this block runs eagerly from then on, while the other blocks stay compiled.
+"""
+import bisect
+import os
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from hivemind.utils import get_logger
+from tensor_parallel import TensorParallel
+
+logger = get_logger(__name__)
+
+SEQ_LEN_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+WARMUP_SEQ_LENS = (1, 2, 16)  # after a few distinct shapes, torch.compile switches to shape-generic kernels
+
+
+def enable_compile_cache(cache_dir: str, num_blocks: int):
+    """Store inductor's compiled graphs under :cache_dir: and allow one set of graphs per served block"""
+    import torch._dynamo
+    import torch._inductor.config
+
+    # Inductor reads this variable once, so this needs to be called before anything is compiled in this process
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "torch_compile"))
+    if hasattr(torch._inductor.config, "fx_graph_cache"):  # Added in torch 2.1, older versions don't store graphs
+        torch._inductor.config.fx_graph_cache = True
+    # Dynamo guards on block parameters, so each block gets its own graphs (they hit the same cache entries, though)
+    for limit_name in ["cache_size_limit", "accumulated_cache_size_limit"]:  # The latter was added in torch 2.1
+        if hasattr(torch._dynamo.config, limit_name):
+            setattr(torch._dynamo.config, limit_name, max(getattr(torch._dynamo.config, limit_name), 8 * num_blocks))
+
+
+class CompiledBlock:
+    """Runs forward and inference steps of a single-device block with torch.compile, see module docstring"""
+
+    def __init__(
+        self,
+        block: TensorParallel,
+        *,
+        seq_len_buckets: Sequence[int] = SEQ_LEN_BUCKETS,
+        batch_size_buckets: Sequence[int] = BATCH_SIZE_BUCKETS,
+    ):
+        assert len(block.module_shards) == 1, "torch.compile is supported only for blocks on a single device"
+        self.block, self.device = block, block.devices[0]
+        self.seq_len_buckets, self.batch_size_buckets = sorted(seq_len_buckets), sorted(batch_size_buckets)
+        self._compiled_forward = torch.compile(block.module_shards[0].forward)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Apply the block to hidden states without attention caches (as in rpc_forward)"""
+        batch_size, seq_len, _ = hidden_states.shape
+        padded_batch_size = _get_bucket(batch_size, self.batch_size_buckets) or batch_size
+        padded_seq_len = _get_bucket(seq_len, self.seq_len_buckets) or seq_len
+        padded_hidden_states = F.pad(
+            hidden_states, (0, 0, 0, padded_seq_len - seq_len, 0, padded_batch_size - batch_size)
+        )
+        outputs = self._run(padded_hidden_states)
+        return outputs[0][:batch_size, :seq_len]
+
+    def inference_step(
+        self, hidden_states: torch.Tensor, layer_past: Tuple[torch.Tensor, ...], kv_cache_position: int
+    ) -> torch.Tensor:
+        """Apply the block to new tokens, writing their keys/values into preallocated caches (see utils.kv_cache)"""
+        seq_len = hidden_states.shape[1]
+        max_length = layer_past[1].shape[1]
+        padded_seq_len = _get_bucket(seq_len, self.seq_len_buckets)
+        if padded_seq_len is None or kv_cache_position + padded_seq_len > max_length:
+            padded_seq_len = seq_len  # Padding tokens would not fit into the cache
+        padded_hidden_states = F.pad(hidden_states, (0, 0, 0, padded_seq_len - seq_len))
+        outputs = self._run(
+            padded_hidden_states, layer_past=layer_past, use_cache=True, kv_cache_position=kv_cache_position
+        )
+        return outputs[0][:, :seq_len]
+
+    def _run(self, *args, **kwargs):
+        if self._compiled_forward is not None:
+            try:
+                return self._compiled_forward(*args, **kwargs)
+            except torch._dynamo.exc.TorchDynamoException:
+                logger.warning("Failed to compile the block, it will run without torch.compile", exc_info=True)
+                self._compiled_forward = None
+        return self.block.module_shards[0].forward(*args, **kwargs)
+
+    def warmup(self, hidden_size: int, dtype: torch.dtype, layer_past: Tuple[torch.Tensor, ...]):
+        """Compile the block for a few typical shapes, using :layer_past: as temporary attention caches"""
+        with torch.inference_mode():
+            position = 0
+            for seq_len in WARMUP_SEQ_LENS:
+                dummy_inputs = torch.zeros(1, seq_len, hidden_size, dtype=dtype, device=self.device)
+                self.inference_step(dummy_inputs, layer_past, kv_cache_position=position)
+                position += seq_len
+        with torch.no_grad():
+            for batch_size, seq_len in zip(self.batch_size_buckets[:3], self.seq_len_buckets[3:6]):
+                self.forward(torch.zeros(batch_size, seq_len, hidden_size, dtype=dtype, device=self.device))
+
+
+def _get_bucket(value: int, buckets: Sequence[int]) -> Optional[int]:
+    """Return the smallest bucket that fits :value: or None if it does not fit into any of them"""
+    index = bisect.bisect_left(buckets, value)
+    return buckets[index] if index < len(buckets) else None
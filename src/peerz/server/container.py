@@ -2,23 +2,45 @@ from __future__ import annotations
 
 import multiprocessing as mp
 import threading
-from typing import Dict, List, Optional, Sequence, Union
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union
 
 import torch
 import torch.mps
-from hivemind import DHT, BatchTensorDescriptor
+import torch.nn as nn
+from hivemind import DHT, BatchTensorDescriptor, PeerID
 from hivemind.proto.runtime_pb2 import CompressionType
 from hivemind.moe.server.runtime import Runtime
 from hivemind.utils.logging import get_logger
+from tensor_parallel import TensorParallel
 from transformers import PretrainedConfig
 
 from peerz.data_structures import UID_DELIMITER, ModelInfo, ServerInfo, ServerState
+from peerz.server.activation_cache import ActivationCache
+from peerz.server.adapter_cache import AdapterCache
 from peerz.server.announcer import ModuleAnnouncerThread
-from peerz.server.backend import TransformerBackend, merge_inference_pools_inplace
+from peerz.server.backend import (
+    TransformerBackend,
+    _MergedForwardStep,
+    _MergedInferenceStep,
+    merge_forward_backward_pools_inplace,
+    merge_inference_pools_inplace,
+)
+from peerz.server.block_cache import load_quantized_block
+from peerz.server.block_weights import BlockWeightsClient, BlockWeightsSource
+from peerz.server.expert_cache import ExpertCache
 from peerz.server.from_pretrained import load_pretrained_block
 from peerz.server.handler import TransformerConnectionHandler
 from peerz.server.memory_cache import MemoryCache
 from peerz.server.reachability import validate_reachability
+from peerz.server.served_blocks import ServedBlocks
+from peerz.server.standby_blocks import StandbyBlocks
+from peerz.server.task_pool import PrioritizedTaskPool
+from peerz.server.throughput import synchronize
+from peerz.server.throughput_monitor import ThroughputMonitor
 from peerz.utils.convert_block import QuantType, convert_block
 
 logger = get_logger(__name__)
@@ -42,6 +64,19 @@ class ModuleContainer(threading.Thread):
         min_batch_size: int,
         max_batch_size: int,
         max_chunk_size_bytes: int,
+        max_backward_activation_bytes: int,
+        activation_cache_bytes: int,
+        activation_cache_timeout: float,
+        expert_cache_bytes: Optional[int],
+        max_hot_adapters: Optional[int],
+        torch_compile: bool,
+        cache_converted_blocks: bool,
+        share_block_weights: bool,
+        fetch_block_weights: bool,
+        trusted_weight_peers: Optional[Sequence[PeerID]],
+        standby_blocks: Optional[StandbyBlocks],
+        throughput_monitor: Optional[ThroughputMonitor],
+        num_loading_workers: int,
         max_alloc_timeout: float,
         torch_dtype: torch.dtype,
         cache_dir: str,
@@ -58,7 +93,17 @@ class ModuleContainer(threading.Thread):
         **kwargs,
     ) -> ModuleContainer:
         module_uids = [f"{dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
+        all_module_uids = [f"{dht_prefix}{UID_DELIMITER}{i}" for i in range(block_config.num_hidden_layers)]
         memory_cache = MemoryCache(attn_cache_bytes, max_alloc_timeout)
+        activation_cache = (
+            ActivationCache(activation_cache_bytes, activation_cache_timeout) if activation_cache_bytes > 0 else None
+        )
+        expert_cache = ExpertCache(expert_cache_bytes) if expert_cache_bytes is not None else None
+        adapter_cache = (
+            AdapterCache(max_hot_adapters, pinned_adapters=server_info.adapters, cache_dir=cache_dir)
+            if max_hot_adapters is not None
+            else None
+        )
 
         server_info.state = ServerState.JOINING
         dht_announcer = ModuleAnnouncerThread(
@@ -68,6 +113,8 @@ class ModuleContainer(threading.Thread):
             model_info,
             block_config=block_config,
             memory_cache=memory_cache,
+            adapter_cache=adapter_cache,
+            throughput_monitor=throughput_monitor,
             update_period=update_period,
             expiration=expiration,
             daemon=True,
@@ -76,40 +123,100 @@ class ModuleContainer(threading.Thread):
         logger.info(f"Announced that blocks {block_indices} are joining")
 
         assert len(tensor_parallel_devices) >= 1 and all(isinstance(d, torch.device) for d in tensor_parallel_devices)
+        block_weights_client = None
+        if fetch_block_weights:
+            block_weights_client = BlockWeightsClient(dht, dht_prefix, trusted_peers=trusted_weight_peers)
+        block_weights = None
+        if share_block_weights:
+            block_weights = BlockWeightsSource(
+                converted_model_name_or_path,
+                block_prefix=block_config.block_prefix,
+                revision=revision,
+                cache_dir=cache_dir,
+            )
 
-        blocks = {}
-        try:
-            for module_uid, block_index in zip(module_uids, block_indices):
-                block = load_pretrained_block(
+        def read_block(block_index: int) -> nn.Module:
+            if cache_converted_blocks:
+                return load_quantized_block(
                     converted_model_name_or_path,
                     block_index,
                     config=block_config,
                     torch_dtype=torch_dtype,
+                    quant_type=quant_type,
                     revision=revision,
                     token=token,
                     cache_dir=cache_dir,
                     max_disk_space=max_disk_space,
+                    block_weights_client=block_weights_client,
                 )
-                block = convert_block(
-                    block,
-                    block_index,
-                    block_config,
-                    tensor_parallel_devices,
-                    device,
-                    quant_type,
-                    adapters=server_info.adapters,
-                    freeze=True,
-                    token=token,
-                    cache_dir=cache_dir,
-                    max_disk_space=max_disk_space,
-                )
+            return load_pretrained_block(
+                converted_model_name_or_path,
+                block_index,
+                config=block_config,
+                torch_dtype=torch_dtype,
+                revision=revision,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+                expert_cache=expert_cache,
+                block_weights_client=block_weights_client,
+            )
+
+        def load_block(block_index: int) -> nn.Module:
+            if standby_blocks is not None:
+                block = standby_blocks.pop(block_index)
+                if block is not None:
+                    return block
+            return read_block(block_index)
+
+        def convert(block_index: int, block: nn.Module) -> TensorParallel:
+            block = convert_block(
+                block,
+                block_index,
+                block_config,
+                tensor_parallel_devices,
+                device,
+                quant_type,
+                adapters=server_info.adapters,
+                add_lora_layers=adapter_cache is not None,
+                merge_adapter=server_info.merged_adapter is not None,
+                freeze=True,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+            )
+            if adapter_cache is not None:
+                adapter_cache.add_block(block_index, block)
+            return block
+
+        def load_blocks(indices: Sequence[int]) -> Iterator[TensorParallel]:
+            loaded_blocks = _load_in_background(load_block, indices, num_workers=num_loading_workers)
+            try:
+                for block_index, block in zip(indices, loaded_blocks):
+                    yield convert(block_index, block)
+            finally:
+                loaded_blocks.close()  # Stops loading the next blocks if the caller exits early
+
+        blocks = {}
+        try:
+            # We load only the first block here and start serving it, while the other blocks are loaded in background
+            # (see ModuleContainer.run). We create backends for all blocks of the model, so that the container can move
+            # to other blocks without restarting connection handlers (see ModuleContainer.update_blocks). The backends
+            # of blocks that are not loaded use the first block, since they need a module with the same architecture
+            # (connection handlers refuse to process requests to them anyway)
+            first_block = convert(block_indices[0], load_block(block_indices[0]))
+            for module_uid in all_module_uids:
                 blocks[module_uid] = TransformerBackend(
                     module_uid,
-                    block,
+                    first_block,
                     config=block_config,
                     memory_cache=memory_cache,
                     backend_dtype=torch_dtype,
                     max_chunk_size_bytes=max_chunk_size_bytes,
+                    max_backward_activation_bytes=max_backward_activation_bytes,
+                    activation_cache=activation_cache,
+                    adapter_cache=adapter_cache,
+                    use_compile=torch_compile,
                     args_schema=(
                         BatchTensorDescriptor(
                             1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
@@ -125,7 +232,13 @@ class ModuleContainer(threading.Thread):
                     max_batch_size=max_batch_size,
                 )
 
+            if torch_compile:
+                start_time = time.perf_counter()
+                blocks[module_uids[0]].warmup_compiled_block()
+                logger.info(f"Compiled block {block_indices[0]} in {time.perf_counter() - start_time:.1f} sec")
+
             merge_inference_pools_inplace(blocks)
+            merge_forward_backward_pools_inplace(blocks)
 
             if should_validate_reachability:
                 validate_reachability(dht.peer_id)
@@ -142,8 +255,17 @@ class ModuleContainer(threading.Thread):
             dht,
             dht_prefix,
             blocks,
+            block_indices=block_indices,
+            loaded_block_indices=block_indices[:1],
+            load_blocks=load_blocks,
             dht_announcer=dht_announcer,
             server_info=server_info,
+            adapter_cache=adapter_cache,
+            block_weights=block_weights,
+            standby_blocks=standby_blocks,
+            read_block=read_block,
+            throughput_monitor=throughput_monitor,
+            cache_dir=cache_dir,
             update_period=update_period,
             expiration=expiration,
             **kwargs,
@@ -155,10 +277,20 @@ class ModuleContainer(threading.Thread):
         dht_prefix: str,
         module_backends: Dict[str, TransformerBackend],
         *,
+        block_indices: Sequence[int],
+        loaded_block_indices: Optional[Sequence[int]] = None,
+        load_blocks: Optional[Callable[[Sequence[int]], Iterator[TensorParallel]]] = None,
         inference_max_length: int,
+        max_short_inference_tokens: Optional[int] = None,
         num_handlers: int,
         dht_announcer: ModuleAnnouncerThread,
         server_info: ServerInfo,
+        adapter_cache: Optional[AdapterCache] = None,
+        block_weights: Optional[BlockWeightsSource] = None,
+        standby_blocks: Optional[StandbyBlocks] = None,
+        read_block: Optional[Callable[[int], nn.Module]] = None,
+        throughput_monitor: Optional[ThroughputMonitor] = None,
+        cache_dir: Optional[str],
         update_period: float,
         expiration: Optional[float] = None,
         request_timeout: float,
@@ -169,8 +301,25 @@ class ModuleContainer(threading.Thread):
     ):
         super().__init__()
 
-        self.dht, self.module_backends = dht, module_backends
+        self.dht, self.dht_prefix, self.module_backends = dht, dht_prefix, module_backends
         self.server_info, self.update_period, self.expiration = server_info, update_period, expiration
+        self.adapter_cache = adapter_cache
+        self.standby_blocks, self._read_block = standby_blocks, read_block
+
+        # We serve :block_indices: out of module_backends. By default, all of them are loaded. Otherwise, the blocks
+        # that are not in :loaded_block_indices: are loaded with :load_blocks: and served once ready, see run()
+        self.block_indices = list(block_indices)
+        if loaded_block_indices is None:
+            loaded_block_indices = block_indices
+        assert loaded_block_indices and set(loaded_block_indices) <= set(block_indices)
+        self._pending_block_indices = [i for i in block_indices if i not in loaded_block_indices]
+        assert load_blocks is not None or not self._pending_block_indices, "load_blocks is required to load blocks"
+        self._load_blocks = load_blocks
+
+        self.served_blocks = ServedBlocks(module_backends.keys())
+        self.served_blocks.set_served(self._get_uids(loaded_block_indices), True)
+        self._loading_lock = threading.Lock()
+        self._loading_stopped = self._loading_failed = False
 
         handler_event_queues = [mp.Queue() for _ in range(num_handlers)]
         self.conn_handlers = [
@@ -178,23 +327,31 @@ class ModuleContainer(threading.Thread):
                 dht,
                 self.module_backends,
                 adapters=server_info.adapters,
+                load_adapters_on_demand=adapter_cache is not None,
+                merged_adapter=server_info.merged_adapter,
+                cache_dir=cache_dir,
                 dht_prefix=dht_prefix,
                 handler_event_queues=handler_event_queues,
                 handler_index=i,
+                served_blocks=self.served_blocks,
+                block_weights=block_weights,
                 inference_max_length=inference_max_length,
                 request_timeout=request_timeout,
                 session_timeout=session_timeout,
                 step_timeout=step_timeout,
                 quant_type=QuantType[server_info.quant_type.upper()],
+                max_short_inference_tokens=max_short_inference_tokens,
             )
             for i in range(num_handlers)
         ]
 
-        self.runtime = RuntimeWithDeduplicatedPools(self.module_backends, device=None, **kwargs)
+        self.runtime = RuntimeWithDeduplicatedPools(
+            self.module_backends, device=None, throughput_monitor=throughput_monitor, **kwargs
+        )
         # note: We set device=None in runtime to avoid moving all modules to device 0 in runtime.run(). tensor_parallel has already moved it as needed.
 
-        dht_announcer.announce(ServerState.ONLINE)
         self.dht_announcer = dht_announcer
+        self._announce_blocks()
 
         if start:
             self.run_in_background(await_ready=True)
@@ -207,8 +364,99 @@ class ModuleContainer(threading.Thread):
         for handler in self.conn_handlers:
             handler.run_in_background()
 
+        if self._pending_block_indices:
+            # We start loading after forking connection handlers, so that they don't inherit the loading threads
+            self._start_updating_blocks(dropped_indices=[], added_indices=self._pending_block_indices)
+
         self.runtime.run()
 
+    def update_blocks(self, block_indices: Sequence[int]) -> bool:
+        """
+        Start serving :block_indices: instead of the current blocks without restarting the container. The blocks present
+        in both sets keep serving requests (including ongoing inference sessions), the dropped ones are unloaded once
+        their requests are finished, and the missing ones are loaded in background.
+
+        :returns: False if the current blocks can't be reused (then, the container should be restarted instead)
+        """
+        kept_indices = [i for i in block_indices if i in self.block_indices]
+        if self._load_blocks is None or not kept_indices or not self.is_fully_loaded():
+            return False
+        dropped_indices = [i for i in self.block_indices if i not in block_indices]
+        added_indices = [i for i in block_indices if i not in self.block_indices]
+        if added_indices and added_indices[0] < kept_indices[0]:
+            added_indices.reverse()  # Load blocks next to the kept ones first, so that served blocks stay contiguous
+
+        with self._loading_lock:
+            if self._loading_stopped:
+                return False
+            self.block_indices = list(block_indices)
+            self.served_blocks.set_served(self._get_uids(dropped_indices), False)
+            self._announce_blocks()
+        logger.info(f"Keeping blocks {kept_indices}, unloading {dropped_indices}, loading {added_indices}")
+
+        if dropped_indices or added_indices:
+            self._start_updating_blocks(dropped_indices=dropped_indices, added_indices=added_indices)
+        return True
+
+    def update_standby_blocks(self, block_indices: Sequence[int]):
+        """Keep :block_indices: (in the order of preference) loaded in host RAM to move to them faster later"""
+        if self.standby_blocks is None:
+            return
+        assert self._read_block is not None, "read_block is required to load standby blocks"
+        block_indices = [i for i in block_indices if i not in self.block_indices]
+        self.standby_blocks.update(block_indices, load_block=self._read_block)
+
+    def _start_updating_blocks(self, *, dropped_indices: Sequence[int], added_indices: Sequence[int]):
+        threading.Thread(
+            target=self._update_blocks, args=(dropped_indices, added_indices), name="BlockLoader", daemon=True
+        ).start()
+
+    def _update_blocks(self, dropped_indices: Sequence[int], added_indices: Sequence[int]):
+        try:
+            if dropped_indices:
+                dropped_uids = self._get_uids(dropped_indices)
+                self.served_blocks.wait_until_unused(dropped_uids)
+                # Backends of blocks that are not served (including the ones that never were) may use the dropped
+                # blocks as placeholders, so we make them use a kept block instead to free the memory
+                dropped_blocks = {id(self.module_backends[module_uid].module) for module_uid in dropped_uids}
+                placeholder = self.module_backends[self.served_blocks.served_uids[0]].module
+                for module_uid, backend in self.module_backends.items():
+                    if module_uid not in self.served_blocks and id(backend.module) in dropped_blocks:
+                        backend.replace_module(placeholder)
+                if self.adapter_cache is not None:
+                    for block_index in dropped_indices:
+                        self.adapter_cache.remove_block(block_index)
+                logger.info(f"Unloaded blocks {dropped_indices}")
+
+            loaded_blocks = self._load_blocks(added_indices)
+            try:
+                for module_uid, block in zip(self._get_uids(added_indices), loaded_blocks):
+                    backend = self.module_backends[module_uid]
+                    backend.replace_module(block)
+                    if backend.compiled_block is not None:
+                        backend.warmup_compiled_block()
+
+                    with self._loading_lock:
+                        if self._loading_stopped:
+                            break
+                        self.served_blocks.set_served([module_uid], True)
+                        self._announce_blocks()
+                    logger.info(f"Loaded {module_uid}, serving {len(self.served_blocks.served_uids)} blocks")
+            finally:
+                loaded_blocks.close()  # Stops background loading if we exited early
+        except Exception:
+            logger.exception("Failed to load blocks, the container will be restarted")
+            self._loading_failed = True
+
+    def _announce_blocks(self):
+        self.dht_announcer.update_blocks(self._get_uids(self.block_indices), online_uids=self.served_blocks.served_uids)
+
+    def _get_uids(self, block_indices: Sequence[int]) -> List[str]:
+        return [f"{self.dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
+
+    def is_fully_loaded(self) -> bool:
+        return set(self.served_blocks.served_uids) == set(self._get_uids(self.block_indices))
+
     def run_in_background(self, await_ready=True, timeout=None):
         """
         Starts ModuleContainer in a background thread. if await_ready, this method will wait until the container
@@ -232,8 +480,10 @@ class ModuleContainer(threading.Thread):
         return self.runtime.ready  # mp.Event that is true if self is ready to process batches
 
     def is_healthy(self) -> bool:
-        return all(handler.is_alive() for handler in self.conn_handlers) and all(
-            pool.is_alive() for pool in self.runtime.pools
+        return (
+            not self._loading_failed
+            and all(handler.is_alive() for handler in self.conn_handlers)
+            and all(pool.is_alive() for pool in self.runtime.pools)
         )
 
     def shutdown(self):
@@ -242,8 +492,10 @@ class ModuleContainer(threading.Thread):
         Please note that terminating container otherwise (e.g. by killing processes) may result in zombie processes.
         If you did already cause a zombie outbreak, your only option is to kill them with -9 (SIGKILL).
         """
+        with self._loading_lock:
+            self._loading_stopped = True
         self.dht_announcer.announce(ServerState.OFFLINE)
-        logger.info(f"Announced that blocks {list(self.module_backends.keys())} are offline")
+        logger.info(f"Announced that blocks {self.dht_announcer.module_uids} are offline")
 
         self.ready.clear()
 
@@ -265,9 +517,53 @@ class ModuleContainer(threading.Thread):
 
         logger.info("Module container shut down successfully")
 
+
+def _load_in_background(
+    load_fn: Callable[[int], nn.Module], block_indices: Sequence[int], *, num_workers: int
+) -> Iterator[nn.Module]:
+    """Yield blocks loaded with :load_fn: in order, while up to :num_workers: next blocks are loaded in other threads"""
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="BlockLoader") as executor:
+        block_indices = iter(block_indices)
+        futures = deque(executor.submit(load_fn, block_index) for block_index in islice(block_indices, num_workers))
+        try:
+            while futures:
+                block = futures.popleft().result()
+                futures.extend(executor.submit(load_fn, block_index) for block_index in islice(block_indices, 1))
+                yield block
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 class RuntimeWithDeduplicatedPools(Runtime):
-    """A version of hivemind.moe.server.runtime.Runtime that allows multiple backends to reuse a task pool"""
+    """
+    A version of hivemind.moe.server.runtime.Runtime that allows multiple backends to reuse a task pool
 
-    def __init__(self, *args, **kwargs):
+    :param throughput_monitor: if set, report the time spent on inference steps and forward passes to it
+    """
+
+    def __init__(self, *args, throughput_monitor: Optional[ThroughputMonitor] = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.pools = tuple(set(self.pools))
+        self.throughput_monitor = throughput_monitor
+
+    def process_batch(self, pool: PrioritizedTaskPool, batch_index: int, *batch: torch.Tensor):
+        if self.throughput_monitor is None:
+            return super().process_batch(pool, batch_index, *batch)
+
+        start_time = time.perf_counter()
+        outputs, batch_size = super().process_batch(pool, batch_index, *batch)
+        synchronize(outputs[0].device)  # GPU kernels run asynchronously, so we wait for them to measure their time
+        elapsed = time.perf_counter() - start_time
+
+        if isinstance(pool.process_func, _MergedInferenceStep):
+            hidden_states, _, inference_infos = batch[:3]
+            self.throughput_monitor.record_inference_step(
+                num_new_tokens=hidden_states.shape[1], num_blocks=len(inference_infos), elapsed=elapsed
+            )
+        elif isinstance(pool.process_func, _MergedForwardStep):
+            hidden_states, _, uids = batch[:3]
+            self.throughput_monitor.record_forward(
+                num_tokens=hidden_states.shape[0] * hidden_states.shape[1], num_blocks=len(uids), elapsed=elapsed
+            )
+        return outputs, batch_size
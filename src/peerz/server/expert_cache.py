@@ -0,0 +1,69 @@
+"""
+An LRU cache of Mixtral expert weights for servers that keep experts memory-mapped from checkpoint files.
+
+Routing in Mixtral is skewed: a few experts of each block process most tokens, while others stay cold for long
+stretches. If a server loads blocks with an ExpertCache (see load_pretrained_block), expert weights are not read
+into RAM but stay memory-mapped from safetensors files. When an expert is needed, its weights are materialized
+in the backend dtype and kept in this cache, so that only recently used experts stay resident.
+
+The cache is shared by all blocks of a server and is used only by the Runtime thread.
+"""
+from collections import OrderedDict
+from typing import Callable, Hashable, Sequence
+
+import torch
+from hivemind.utils import get_logger
+
+from peerz.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+ExpertWeights = Sequence[torch.Tensor]
+
+
+class ExpertCache:
+    """A byte-bounded LRU cache of materialized expert weights, see module docstring for details"""
+
+    def __init__(self, max_size_bytes: int):
+        self.max_size_bytes = max_size_bytes
+        self._entries: OrderedDict[Hashable, ExpertWeights] = OrderedDict()
+        self._current_size = 0
+        self._num_hits = self._num_misses = 0
+
+    @property
+    def current_size_bytes(self) -> int:
+        return self._current_size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self._num_hits + self._num_misses
+        return self._num_hits / total if total > 0 else 0.0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, load_fn: Callable[[], ExpertWeights]) -> ExpertWeights:
+        """Return weights cached for this key or load them with :load_fn:, evicting least recently used experts"""
+        weights = self._entries.get(key)
+        if weights is not None:
+            self._num_hits += 1
+            self._entries.move_to_end(key)
+            return weights
+
+        self._num_misses += 1
+        weights = tuple(load_fn())
+        size = _get_size_in_bytes(weights)
+        if size > self.max_size_bytes:
+            logger.debug(f"Expert {key} takes {size} bytes and does not fit into the cache, it won't be cached")
+            return weights
+
+        while self._current_size + size > self.max_size_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_size -= _get_size_in_bytes(evicted)
+        self._entries[key] = weights
+        self._current_size += size
+        return weights
+
+
+def _get_size_in_bytes(weights: ExpertWeights) -> int:
+    return sum(tensor.numel() * get_size_in_bytes(tensor.dtype) for tensor in weights)
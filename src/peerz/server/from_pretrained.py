@@ -7,9 +7,14 @@ If necessary, one can rewrite this to implement a different behavior, such as:
 
 """
 import json
+import mmap
+import os
+import re
+import struct
 import time
-from contextlib import suppress
-from typing import Dict, Optional, Union
+from contextlib import contextmanager, suppress
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, Optional, Union
 
 import safetensors
 import torch
@@ -17,17 +22,28 @@ import torch.nn as nn
 from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 from hivemind.utils.logging import get_logger
-from huggingface_hub import get_hf_file_metadata, hf_hub_url
-from huggingface_hub.utils import EntryNotFoundError
+from huggingface_hub import get_hf_file_metadata, get_session, hf_hub_url
+from huggingface_hub.utils import EntryNotFoundError, build_hf_headers, hf_raise_for_status
+from requests import Response
 from transformers import PretrainedConfig, PreTrainedModel
 from transformers.utils import get_file_from_repo
 
 from peerz.constants import DTYPE_MAP
 from peerz.models.mixtral import WrappedMixtralBlock
 from peerz.server.block_utils import get_model_block, resolve_block_dtype
+from peerz.server.block_weights import BlockWeightsClient, StateDict
+from peerz.server.expert_cache import ExpertCache
 from peerz.utils.auto_config import AutoDistributedConfig
-from peerz.utils.disk_cache import DEFAULT_CACHE_DIR, allow_cache_reads, allow_cache_writes, free_disk_space_for
+from peerz.utils.disk_cache import (
+    BLOCK_SLICES_DIR,
+    DEFAULT_CACHE_DIR,
+    allow_cache_reads,
+    allow_cache_writes,
+    free_disk_space_for,
+    register_cached_file,
+)
 from peerz.utils.hf_auth import always_needs_auth
+from peerz.utils.misc import get_size_in_bytes
 
 logger = get_logger(__name__)
 
@@ -42,7 +58,18 @@ def load_pretrained_block(
     token: Optional[Union[str, bool]] = None,
     cache_dir: Optional[str] = None,
     max_disk_space: Optional[int] = None,
+    expert_cache: Optional[ExpertCache] = None,
+    block_weights_client: Optional[BlockWeightsClient] = None,
 ) -> nn.Module:
+    """
+    Load one transformer block from a repo (or a local directory) with a converted model
+
+    :param expert_cache: if set, weights of Mixtral experts are not read into RAM but stay memory-mapped from
+      safetensors files in their original dtype. Experts that receive tokens are materialized in :torch_dtype:
+      and kept in this cache, see peerz.server.expert_cache for details.
+    :param block_weights_client: if set, weights that are not cached locally are downloaded from other servers that
+      share them before trying the HF Hub (not used with :expert_cache:, since received weights can't be memory-mapped)
+    """
     if config is None:
         config = AutoDistributedConfig.from_pretrained(model_name, use_auth_token=token)
     if cache_dir is None:
@@ -54,15 +81,32 @@ def load_pretrained_block(
     with init_empty_weights():
         block = get_model_block(config, layer_idx=block_index)
 
+    mmap_filter = None
+    if expert_cache is not None:
+        if not isinstance(block, WrappedMixtralBlock):
+            raise ValueError(f"Memory-mapped experts are supported only for Mixtral blocks, got {type(block)}")
+        mmap_filter = _is_expert_param
+
     block_prefix = f"{config.block_prefix}.{block_index}."
-    state_dict = _load_state_dict_from_repo(
+    load_state_dict = partial(
+        _load_state_dict_from_repo,
         model_name,
         block_prefix,
         revision=revision,
         token=token,
         cache_dir=cache_dir,
         max_disk_space=max_disk_space,
+        mmap_filter=mmap_filter,
+        torch_dtype=torch_dtype,
     )
+    state_dict = None
+    if block_weights_client is not None and expert_cache is None:
+        try:
+            state_dict = load_state_dict(local_files_only=True)
+        except FileNotFoundError:
+            state_dict = block_weights_client.get_state_dict(block_index)
+    if state_dict is None:
+        state_dict = load_state_dict()
 
     # dummy load, check that keys match
     report = block.load_state_dict(state_dict, strict=False)
@@ -71,16 +115,21 @@ def load_pretrained_block(
     for param_name, _ in block.named_parameters():
         assert param_name in state_dict, f"{param_name} not in state dict"
         param = state_dict[param_name]
-        if not str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")):
+        is_mmapped = mmap_filter is not None and mmap_filter(param_name)  # Keep the original dtype to avoid copying
+        if not str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")) and not is_mmapped:
             param = param.to(torch_dtype)
         set_module_tensor_to_device(block, param_name, "cpu", value=param, dtype=param.dtype)
 
+    if expert_cache is not None:
+        block.block_sparse_moe.set_expert_cache(expert_cache, prefix=block_index)
+
     logger.info(f"Loaded {model_name} block {block_index}")
     logger.debug(f"Details: {report}")
     return block
 
 
-StateDict = Dict[str, torch.Tensor]
+def _is_expert_param(param_name: str) -> bool:
+    return param_name.startswith("block_sparse_moe.experts.") or ".block_sparse_moe.experts." in param_name
 
 
 def _load_state_dict_from_repo(
@@ -91,13 +140,26 @@ def _load_state_dict_from_repo(
     token: Optional[Union[str, bool]] = None,
     cache_dir: str,
     max_disk_space: Optional[int] = None,
+    mmap_filter: Optional[Callable[[str], bool]] = None,
+    torch_dtype: Optional[torch.dtype] = None,
+    local_files_only: bool = False,
 ) -> StateDict:
+    """Load tensors starting with :block_prefix: (without it), raises FileNotFoundError if :local_files_only: is
+    set and they are not cached"""
     if always_needs_auth(model_name) and token is None:
         token = True
 
-    index_file = _find_index_file(model_name, revision=revision, token=token, cache_dir=cache_dir)
+    index_file = _find_index_file(
+        model_name, revision=revision, token=token, cache_dir=cache_dir, local_files_only=local_files_only
+    )
     if index_file.endswith(".index.json"):  # Sharded model
-        path = get_file_from_repo(model_name, filename=index_file, use_auth_token=token, cache_dir=cache_dir)
+        path = get_file_from_repo(
+            model_name,
+            filename=index_file,
+            use_auth_token=token,
+            cache_dir=cache_dir,
+            local_files_only=local_files_only,
+        )
         if path is None:
             # _find_index_file() told that a file exists but we can't get it (e.g., it just disappeared)
             raise ValueError(f"Failed to get file {index_file}")
@@ -123,6 +185,9 @@ def _load_state_dict_from_repo(
             token=token,
             cache_dir=cache_dir,
             max_disk_space=max_disk_space,
+            mmap_filter=mmap_filter,
+            torch_dtype=torch_dtype,
+            local_files_only=local_files_only,
         )
         shard_state_dict = {
             param_name[len(block_prefix) :]: param
@@ -137,7 +202,12 @@ INDEX_FILES = ["model.safetensors.index.json", "model.safetensors", "pytorch_mod
 
 
 def _find_index_file(
-    model_name: str, *, revision: Optional[str] = None, token: Optional[Union[str, bool]] = None, cache_dir: str
+    model_name: str,
+    *,
+    revision: Optional[str] = None,
+    token: Optional[Union[str, bool]] = None,
+    cache_dir: str,
+    local_files_only: bool = False,
 ) -> str:
     # If we have cached weights (e.g., Pickle from older peerz versions), reuse them
     for filename in INDEX_FILES:
@@ -151,6 +221,8 @@ def _find_index_file(
         )
         if path is not None:
             return filename
+    if local_files_only:
+        raise FileNotFoundError(f"Weights of {model_name} are not cached")
 
     # If we don't, prefer Safetensors when possible
     # (we don't download files here since we can't account for max_disk_space in case of large files)
@@ -173,8 +245,16 @@ def _load_state_dict_from_repo_file(
     token: Optional[Union[str, bool]] = None,
     cache_dir: str,
     max_disk_space: Optional[int] = None,
+    mmap_filter: Optional[Callable[[str], bool]] = None,
+    torch_dtype: Optional[torch.dtype] = None,
+    local_files_only: bool = False,
     delay: float = 30,
 ) -> StateDict:
+    # Safetensors files let us download only the tensors of the block we need (see _download_block_slice)
+    slice_path = None
+    if block_prefix is not None and filename.endswith(".safetensors"):
+        slice_path = _get_block_slice_path(model_name, filename, block_prefix, revision=revision, cache_dir=cache_dir)
+
     # First, try to find the weights locally
     try:
         with allow_cache_reads(cache_dir):
@@ -186,16 +266,29 @@ def _load_state_dict_from_repo_file(
                 cache_dir=cache_dir,
                 local_files_only=True,
             )
+            if path is None and slice_path is not None and os.path.exists(slice_path):
+                path = slice_path
             if path is not None:
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                return _load_state_dict_from_local_file(
+                    path, block_prefix=block_prefix, mmap_filter=mmap_filter, torch_dtype=torch_dtype
+                )
     except Exception:
         logger.warning(f"Cache for file {filename} is corrupted, it will be downloaded again", exc_info=True)
+    if local_files_only:
+        raise FileNotFoundError(f"File {filename} of {model_name} is not cached")
 
     # If not found, ensure that we have enough disk space to download them (maybe remove something)
     while True:
         try:
             with allow_cache_writes(cache_dir):
                 url = hf_hub_url(model_name, filename, revision=revision)
+                if slice_path is not None and _download_block_slice(
+                    url, slice_path, block_prefix, token=token, cache_dir=cache_dir, max_disk_space=max_disk_space
+                ):
+                    return _load_state_dict_from_local_file(
+                        slice_path, block_prefix=block_prefix, mmap_filter=mmap_filter, torch_dtype=torch_dtype
+                    )
+
                 file_size = get_hf_file_metadata(url, token=token).size
                 if file_size is not None:
                     free_disk_space_for(file_size, cache_dir=cache_dir, max_disk_space=max_disk_space)
@@ -212,18 +305,206 @@ def _load_state_dict_from_repo_file(
                 )
                 if path is None:
                     raise RuntimeError(f"File {filename} does not exist in repo {model_name}")
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                register_cached_file(path, cache_dir=cache_dir)
+                return _load_state_dict_from_local_file(
+                    path, block_prefix=block_prefix, mmap_filter=mmap_filter, torch_dtype=torch_dtype
+                )
         except Exception as e:
             logger.warning(f"Failed to load file {filename} from HF Hub (retry in {delay:.0f} sec)", exc_info=True)
             time.sleep(delay)
 
 
-def _load_state_dict_from_local_file(path: str, *, block_prefix: Optional[str] = None) -> StateDict:
+def _get_block_slice_path(
+    model_name: str, filename: str, block_prefix: str, *, revision: Optional[str], cache_dir: str
+) -> str:
+    repo_dir = re.sub(r"[^\w.-]", "--", f"{model_name.strip('/')}@{revision or 'main'}")
+    return os.path.join(cache_dir, BLOCK_SLICES_DIR, repo_dir, re.sub(r"[^\w.-]", "--", block_prefix + filename))
+
+
+DOWNLOAD_CHUNK_BYTES = 1024**2
+
+
+def _download_block_slice(
+    url: str,
+    path: str,
+    block_prefix: str,
+    *,
+    token: Optional[Union[str, bool]],
+    cache_dir: str,
+    max_disk_space: Optional[int],
+) -> bool:
+    """
+    Download tensors starting with :block_prefix: from a remote safetensors file to a smaller safetensors file at
+    :path: using HTTP range requests, so that servers do not download (and store) whole shards to load one block.
+    Returns False if the HTTP server does not support range requests. Must be called under allow_cache_writes().
+    """
+    headers = build_hf_headers(token=token)
+    with _request_range(url, 0, 8, headers=headers) as response:
+        if response is None:
+            return False
+        (header_size,) = struct.unpack("<Q", response.content)
+    with _request_range(url, 8, 8 + header_size, headers=headers) as response:
+        if response is None:
+            return False
+        header = json.loads(response.content)
+    data_start = 8 + header_size
+
+    # Tensors of a block are usually stored together, so we merge adjacent tensors into one request
+    keys = sorted(
+        (key for key in header if key != "__metadata__" and key.startswith(block_prefix)),
+        key=lambda key: header[key]["data_offsets"],
+    )
+    if not keys:
+        raise RuntimeError(f"File {url} does not contain tensors {block_prefix}*")
+    ranges, range_indices = [], {}
+    for key in keys:
+        begin, end = header[key]["data_offsets"]
+        if not ranges or ranges[-1][1] != begin:
+            ranges.append([begin, end])
+        ranges[-1][1] = end
+        range_indices[key] = len(ranges) - 1
+
+    # Safetensors requires tensors to be stored without gaps, so we put the ranges one after another. Tensors stay
+    # aligned since we keep their order (safetensors files have larger dtypes first to avoid padding)
+    shifts, data_size = [], 0
+    for begin, end in ranges:
+        shifts.append(data_size - begin)
+        data_size += end - begin
+    new_header = {
+        key: dict(
+            header[key], data_offsets=[offset + shifts[range_indices[key]] for offset in header[key]["data_offsets"]]
+        )
+        for key in keys
+    }
+    if "__metadata__" in header:
+        new_header["__metadata__"] = header["__metadata__"]
+    new_header_bytes = json.dumps(new_header).encode()
+    new_header_bytes += b" " * (-len(new_header_bytes) % 8)
+
+    free_disk_space_for(8 + len(new_header_bytes) + data_size, cache_dir=cache_dir, max_disk_space=max_disk_space)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(struct.pack("<Q", len(new_header_bytes)))
+        f.write(new_header_bytes)
+        for (begin, end), shift in zip(ranges, shifts):
+            if begin == end:
+                continue  # Only empty tensors
+            with _request_range(url, data_start + begin, data_start + end, headers=headers) as response:
+                if response is None:
+                    os.remove(path + ".tmp")
+                    return False
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    f.write(chunk)
+            if f.tell() != 8 + len(new_header_bytes) + end + shift:
+                raise RuntimeError(f"Got an incomplete response for bytes {begin}-{end} of {url}")
+    os.replace(path + ".tmp", path)  # Readers never see partially written files
+    register_cached_file(path, cache_dir=cache_dir)
+
+    logger.debug(f"Downloaded {data_size / 1024**2:.1f} MiB of tensors {block_prefix}* from {url}")
+    return True
+
+
+@contextmanager
+def _request_range(url: str, begin: int, end: int, *, headers: Dict[str, str]) -> Iterator[Optional[Response]]:
+    """Request bytes [begin, end) of a file, yields None if the server ignores the Range header"""
+    response = get_session().get(url, headers={**headers, "Range": f"bytes={begin}-{end - 1}"}, stream=True)
+    try:
+        hf_raise_for_status(response)
+        yield response if response.status_code == 206 else None
+    finally:
+        response.close()
+
+
+def _load_state_dict_from_local_file(
+    path: str,
+    *,
+    block_prefix: Optional[str] = None,
+    mmap_filter: Optional[Callable[[str], bool]] = None,
+    torch_dtype: Optional[torch.dtype] = None,
+) -> StateDict:
+    """
+    Load tensors from a local checkpoint file
+
+    Safetensors files are memory-mapped, so tensors that already have the right dtype share memory with the file
+    mapping instead of being copied, while the other ones are cast chunk by chunk (see _mmap_safetensors).
+
+    :param mmap_filter: tensors with names satisfying this predicate keep their original dtype, so that they stay
+      memory-mapped and are not read into RAM until used (supported for safetensors only)
+    :param torch_dtype: if specified, cast floating-point tensors (except for the ones selected by mmap_filter)
+    """
     if path.endswith(".bin"):
+        if mmap_filter is not None:
+            logger.warning(f"Cannot memory-map tensors from {path}, only safetensors files support that")
         return torch.load(path, map_location="cpu")
 
     if path.endswith(".safetensors"):
         with safetensors.safe_open(path, framework="pt", device="cpu") as f:
-            return {key: f.get_tensor(key) for key in f.keys() if block_prefix is None or key.startswith(block_prefix)}
+            keys = [key for key in f.keys() if block_prefix is None or key.startswith(block_prefix)]
+        mmap_keys = {key for key in keys if mmap_filter is not None and mmap_filter(key)}
+        state_dict = _mmap_safetensors(path, [key for key in keys if key not in mmap_keys], torch_dtype=torch_dtype)
+        if mmap_keys:
+            state_dict.update(_mmap_safetensors(path, mmap_keys))
+        return state_dict
 
     raise ValueError(f"Unknown weight format: {path}")
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+CAST_CHUNK_BYTES = 64 * 1024**2
+
+
+def _mmap_safetensors(path: str, keys: Iterable[str], *, torch_dtype: Optional[torch.dtype] = None) -> StateDict:
+    """
+    Create tensors that share memory with a copy-on-write mapping of a safetensors file (nothing is read yet).
+    If torch_dtype is specified, floating-point tensors of other dtypes are cast to it in chunks of CAST_CHUNK_BYTES,
+    dropping the pages that were already read, so that loading never needs a second full copy of the weights in RAM.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # The mapping stays valid after closing the file
+    data_start = 8 + header_size
+
+    state_dict = {}
+    for key in keys:
+        info = header[key]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            state_dict[key] = torch.empty(info["shape"], dtype=dtype if torch_dtype is None else torch_dtype)
+            continue
+        tensor = torch.frombuffer(
+            buffer, dtype=dtype, count=(end - begin) // get_size_in_bytes(dtype), offset=data_start + begin
+        )
+        if torch_dtype is not None and dtype.is_floating_point and dtype != torch_dtype:
+            tensor = _cast_in_chunks(tensor, torch_dtype, buffer=buffer, offset=data_start + begin)
+        state_dict[key] = tensor.view(info["shape"])
+    return state_dict
+
+
+def _cast_in_chunks(tensor: torch.Tensor, dtype: torch.dtype, *, buffer: mmap.mmap, offset: int) -> torch.Tensor:
+    """Cast a 1D tensor mapped from :buffer: at :offset:, releasing source pages as soon as they are converted"""
+    result = torch.empty(tensor.shape, dtype=dtype)
+    chunk_numel = max(1, CAST_CHUNK_BYTES // tensor.element_size())
+    for start in range(0, tensor.numel(), chunk_numel):
+        result[start : start + chunk_numel] = tensor[start : start + chunk_numel]
+        if hasattr(mmap, "MADV_DONTNEED"):
+            # These pages were never written to, so the kernel will simply read them again if they are accessed
+            chunk_begin = offset + start * tensor.element_size()
+            chunk_end = min(chunk_begin + chunk_numel * tensor.element_size(), offset + tensor.nbytes)
+            page_begin = chunk_begin - chunk_begin % mmap.PAGESIZE
+            buffer.madvise(mmap.MADV_DONTNEED, page_begin, chunk_end - page_begin)
+    return result
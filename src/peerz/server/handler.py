@@ -6,7 +6,7 @@ import multiprocessing as mp
 import sys
 from enum import Enum
 from itertools import chain
-from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import Any, AsyncIterator, ContextManager, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import torch
 from async_timeout import timeout
@@ -29,9 +29,11 @@ from hivemind.utils.logging import get_logger
 from hivemind.utils.streaming import split_for_streaming
 
 import peerz
-from peerz.data_structures import CHAIN_DELIMITER, UID_DELIMITER, Handle, ModuleUID
+from peerz.data_structures import CHAIN_DELIMITER, UID_DELIMITER, Handle, ModuleUID, parse_uid
 from peerz.server.backend import TransformerBackend
 from peerz.server.block_functions import iterate_rpc_inference, run_rpc_backward, run_rpc_forward
+from peerz.server.block_weights import BlockWeightsSource
+from peerz.server.served_blocks import ServedBlocks
 from peerz.server.task_prioritizer import DummyTaskPrioritizer, TaskPrioritizerBase
 from peerz.utils.convert_block import QuantType
 
@@ -43,6 +45,8 @@ sys.modules["runtime_pb2"] = runtime_pb2
 
 
 CACHE_TOKENS_AVAILABLE = "cache_tokens_available"
+ACTIVATION_CACHE_BYTES_LEFT = "activation_cache_bytes_left"
+MAX_STEP_ID_LENGTH = 64
 
 
 class Event(Enum):
@@ -63,33 +67,44 @@ class TransformerConnectionHandler(ConnectionHandler):
         module_backends: Dict[str, TransformerBackend],
         *,
         adapters: Optional[Sequence[str]],
+        load_adapters_on_demand: bool = False,
+        merged_adapter: Optional[str] = None,
+        cache_dir: Optional[str] = None,
         dht_prefix: str,
         handler_event_queues: Sequence[mp.Queue],
         handler_index: int,
+        served_blocks: Optional[ServedBlocks] = None,
+        block_weights: Optional[BlockWeightsSource] = None,
         inference_max_length: int,
         request_timeout: float,
         session_timeout: float,
         step_timeout: float,
         task_prioritizer: TaskPrioritizerBase = DummyTaskPrioritizer(),
         quant_type: QuantType,
+        max_short_inference_tokens: Optional[int] = None,
     ):
         super().__init__(dht, module_backends)
         for module_backend in self.module_backends.values():
             assert isinstance(module_backend, TransformerBackend)
         self.dht_prefix = dht_prefix
         self.adapters = adapters
+        self.load_adapters_on_demand, self.cache_dir = load_adapters_on_demand, cache_dir
+        self.merged_adapter = merged_adapter
         self._handler_event_queues = handler_event_queues
         self._handler_index = handler_index
         self._own_event_queue = handler_event_queues[handler_index]
         self._listener_task: Optional[asyncio.Task] = None
         self._session_queues: Dict[str, asyncio.Queue] = {}
         self._session_handlers: Dict[str, int] = {}
+        self.served_blocks = served_blocks  # if specified, only these of module_backends can be used in requests
+        self.block_weights = block_weights  # if specified, other servers may download blocks with rpc_get_block_weights
 
         self.inference_max_length = inference_max_length
         self.request_timeout = request_timeout
         self.session_timeout, self.step_timeout = session_timeout, step_timeout
         self._prioritizer = task_prioritizer
         self.quant_type = quant_type
+        self.max_short_inference_tokens = max_short_inference_tokens  # if None, the defaults for quant_type are used
 
     async def add_p2p_handlers(self, *args, **kwargs) -> None:
         if self._listener_task is None:
@@ -145,51 +160,55 @@ class TransformerConnectionHandler(ConnectionHandler):
             requested_uids = self._check_uids(request.uid)
             self._log_request("rpc_inference.open", requested_uids, context)
             try:
-                metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
-                requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
-                max_length = metadata.get("max_length")
-                points = metadata.get("points", 0)
-                session_id = metadata.get("session_id")
-                alloc_timeout = float(metadata.get("alloc_timeout", 0.0))
-                args_structure = metadata.get("args_structure")
-                if not requested_uids:
-                    raise ValueError("User must specify at least one block for inference, but got none")
-                assert isinstance(
-                    max_length, int
-                ), f"rpc_inference metadata must contain int max_length, got {max_length}"
-                assert isinstance(
-                    points, (float, int)
-                ), f"rpc_inference should have number of points as a number or None, got {points}"
-                if not 0 <= max_length <= self.inference_max_length:
-                    raise ValueError(
-                        f"Cannot allocate KV cache for {max_length} tokens, max = {self.inference_max_length}"
-                    )
+                with self._using_blocks(requested_uids):
+                    metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
+                    requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
+                    max_length = metadata.get("max_length")
+                    points = metadata.get("points", 0)
+                    session_id = metadata.get("session_id")
+                    alloc_timeout = float(metadata.get("alloc_timeout", 0.0))
+                    args_structure = metadata.get("args_structure")
+                    if not requested_uids:
+                        raise ValueError("User must specify at least one block for inference, but got none")
+                    assert isinstance(
+                        max_length, int
+                    ), f"rpc_inference metadata must contain int max_length, got {max_length}"
+                    assert isinstance(
+                        points, (float, int)
+                    ), f"rpc_inference should have number of points as a number or None, got {points}"
+                    if not 0 <= max_length <= self.inference_max_length:
+                        raise ValueError(
+                            f"Cannot allocate KV cache for {max_length} tokens, max = {self.inference_max_length}"
+                        )
 
-                batch_size = request.tensors[0].size[0] if request.tensors else 1
-
-                async with self._allocate_cache(
-                    requested_backends, batch_size=batch_size, max_length=max_length, timeout=alloc_timeout
-                ) as cache_handles:
-                    background_tasks = set()
-                    async for output_tensors, can_push, step_metadata in iterate_rpc_inference(
-                        requested_uids=requested_uids,
-                        requested_backends=requested_backends,
-                        active_adapter=self._get_active_adapter(metadata),
-                        input_iterator=self._iterate_inference_steps(
-                            request, requests, session_id, requested_uids, context
-                        ),
-                        cache_handles=cache_handles,
-                        max_length=max_length,
-                        prioritizer=self._prioritizer,
-                        points=points,
-                        quant_type=self.quant_type,
-                        args_structure=args_structure,
-                    ):
-                        if can_push:
-                            task = asyncio.create_task(self._push_outputs(request, output_tensors[0], step_metadata))
-                            background_tasks.add(task)  # Keep reference until it is done to save it from GC
-                            task.add_done_callback(background_tasks.discard)
-                        yield runtime_pb2.ExpertResponse(tensors=output_tensors)
+                    batch_size = request.tensors[0].size[0] if request.tensors else 1
+
+                    async with self._allocate_cache(
+                        requested_backends, batch_size=batch_size, max_length=max_length, timeout=alloc_timeout
+                    ) as cache_handles:
+                        background_tasks = set()
+                        async for output_tensors, can_push, step_metadata in iterate_rpc_inference(
+                            requested_uids=requested_uids,
+                            requested_backends=requested_backends,
+                            active_adapter=self._get_active_adapter(metadata),
+                            input_iterator=self._iterate_inference_steps(
+                                request, requests, session_id, requested_uids, context
+                            ),
+                            cache_handles=cache_handles,
+                            max_length=max_length,
+                            prioritizer=self._prioritizer,
+                            points=points,
+                            quant_type=self.quant_type,
+                            max_short_inference_tokens=self.max_short_inference_tokens,
+                            args_structure=args_structure,
+                        ):
+                            if can_push:
+                                task = asyncio.create_task(
+                                    self._push_outputs(request, output_tensors[0], step_metadata)
+                                )
+                                background_tasks.add(task)  # Keep reference until it is done to save it from GC
+                                task.add_done_callback(background_tasks.discard)
+                            yield runtime_pb2.ExpertResponse(tensors=output_tensors)
 
             finally:
                 self._log_request("rpc_inference.close", requested_uids, context)
@@ -356,26 +375,29 @@ class TransformerConnectionHandler(ConnectionHandler):
             requested_uids = self._check_uids(request.uid)
             self._log_request("rpc_forward", requested_uids, context)
 
-            requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
-            metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
-            active_adapter = self._get_active_adapter(metadata)
-            points = metadata.get("points", 0)
-            args_structure = metadata.get("args_structure")
-            assert isinstance(
-                points, (float, int)
-            ), f"rpc_forward should have number of points as number or None, got {points}"
-
-            hidden_states = await run_rpc_forward(
-                *flat_inputs,
-                requested_backends=requested_backends,
-                prioritizer=self._prioritizer,
-                active_adapter=active_adapter,
-                points=points,
-                args_structure=args_structure,
-            )
-            return runtime_pb2.ExpertResponse(
-                tensors=self._serialize_outputs(hidden_states, requested_backends, metadata)
-            )
+            with self._using_blocks(requested_uids):
+                requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
+                metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
+                active_adapter = self._get_active_adapter(metadata)
+                points = metadata.get("points", 0)
+                args_structure = metadata.get("args_structure")
+                assert isinstance(
+                    points, (float, int)
+                ), f"rpc_forward should have number of points as number or None, got {points}"
+                step_id = self._get_step_id(metadata)
+
+                hidden_states = await run_rpc_forward(
+                    *flat_inputs,
+                    requested_backends=requested_backends,
+                    prioritizer=self._prioritizer,
+                    active_adapter=active_adapter,
+                    points=points,
+                    args_structure=args_structure,
+                    step_id=step_id,
+                )
+                return runtime_pb2.ExpertResponse(
+                    tensors=self._serialize_outputs(hidden_states, requested_backends, metadata)
+                )
 
     async def rpc_forward_stream(
         self, requests: AsyncIterator[runtime_pb2.ExpertRequest], context: P2PContext
@@ -386,27 +408,30 @@ class TransformerConnectionHandler(ConnectionHandler):
             requested_uids = self._check_uids(uid_str)
             self._log_request("rpc_forward_stream", requested_uids, context)
 
-            requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
-            active_adapter = self._get_active_adapter(metadata)
-            points = metadata.get("points", 0)
-            args_structure = metadata.get("args_structure")
-            assert isinstance(
-                points, (float, int)
-            ), f"rpc_forward_stream should have number of points as number or None, got {points}"
-
-            hidden_states = await run_rpc_forward(
-                *flat_inputs,
-                requested_backends=requested_backends,
-                prioritizer=self._prioritizer,
-                active_adapter=active_adapter,
-                points=points,
-                args_structure=args_structure,
-            )
-
-            # Split the serialized_output for streaming and respond to client
-            for tensor in self._serialize_outputs(hidden_states, requested_backends, metadata):
-                for part in split_for_streaming(tensor, DEFAULT_MAX_MSG_SIZE):
-                    yield runtime_pb2.ExpertResponse(tensors=[part])
+            with self._using_blocks(requested_uids):
+                requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
+                active_adapter = self._get_active_adapter(metadata)
+                points = metadata.get("points", 0)
+                args_structure = metadata.get("args_structure")
+                assert isinstance(
+                    points, (float, int)
+                ), f"rpc_forward_stream should have number of points as number or None, got {points}"
+                step_id = self._get_step_id(metadata)
+
+                hidden_states = await run_rpc_forward(
+                    *flat_inputs,
+                    requested_backends=requested_backends,
+                    prioritizer=self._prioritizer,
+                    active_adapter=active_adapter,
+                    points=points,
+                    args_structure=args_structure,
+                    step_id=step_id,
+                )
+
+                # Split the serialized_output for streaming and respond to client
+                for tensor in self._serialize_outputs(hidden_states, requested_backends, metadata):
+                    for part in split_for_streaming(tensor, DEFAULT_MAX_MSG_SIZE):
+                        yield runtime_pb2.ExpertResponse(tensors=[part])
 
     def _serialize_outputs(
         self,
@@ -438,25 +463,28 @@ class TransformerConnectionHandler(ConnectionHandler):
             requested_uids = self._check_uids(request.uid)
             self._log_request("rpc_backward", requested_uids, context)
 
-            requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
-            metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
-            active_adapter = self._get_active_adapter(metadata)
-            points = metadata.get("points", 0)
-            args_structure = metadata.get("args_structure")
-            assert isinstance(
-                points, (float, int)
-            ), f"rpc_backward should have number of points as number or None, got {points}"
-
-            grads = await run_rpc_backward(
-                *flat_tensors,
-                requested_backends=requested_backends,
-                prioritizer=self._prioritizer,
-                active_adapter=active_adapter,
-                points=points,
-                args_structure=args_structure,
-            )
+            with self._using_blocks(requested_uids):
+                requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
+                metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
+                active_adapter = self._get_active_adapter(metadata)
+                points = metadata.get("points", 0)
+                args_structure = metadata.get("args_structure")
+                assert isinstance(
+                    points, (float, int)
+                ), f"rpc_backward should have number of points as number or None, got {points}"
+                step_id = self._get_step_id(metadata)
+
+                grads = await run_rpc_backward(
+                    *flat_tensors,
+                    requested_backends=requested_backends,
+                    prioritizer=self._prioritizer,
+                    active_adapter=active_adapter,
+                    points=points,
+                    args_structure=args_structure,
+                    step_id=step_id,
+                )
 
-            return runtime_pb2.ExpertResponse(tensors=self._serialize_grads(grads, requested_backends, metadata))
+                return runtime_pb2.ExpertResponse(tensors=self._serialize_grads(grads, requested_backends, metadata))
 
     async def rpc_backward_stream(
         self, requests: AsyncIterator[runtime_pb2.ExpertRequest], context: P2PContext
@@ -466,33 +494,62 @@ class TransformerConnectionHandler(ConnectionHandler):
             requested_uids = self._check_uids(uids_header)
             self._log_request("rpc_backward_stream", requested_uids, context)
 
-            requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
-            active_adapter = self._get_active_adapter(metadata)
-            points = metadata.get("points", 0)
-            args_structure = metadata.get("args_structure")
-            assert isinstance(
-                points, (float, int)
-            ), f"rpc_backward_stream should have number of points as number or None, got {points}"
-
-            grads = await run_rpc_backward(
-                *flat_tensors,
-                requested_backends=requested_backends,
-                prioritizer=self._prioritizer,
-                active_adapter=active_adapter,
-                points=points,
-                args_structure=args_structure,
-            )
-            # Split the serialized_grad_inputs for streaming and respond
-            for tensor in self._serialize_grads(grads, requested_backends, metadata):
-                for part in split_for_streaming(tensor, DEFAULT_MAX_MSG_SIZE):
-                    yield runtime_pb2.ExpertResponse(tensors=[part])
-
-    def _get_active_adapter(self, metadata: dict) -> str:
+            with self._using_blocks(requested_uids):
+                requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
+                active_adapter = self._get_active_adapter(metadata)
+                points = metadata.get("points", 0)
+                args_structure = metadata.get("args_structure")
+                assert isinstance(
+                    points, (float, int)
+                ), f"rpc_backward_stream should have number of points as number or None, got {points}"
+                step_id = self._get_step_id(metadata)
+
+                grads = await run_rpc_backward(
+                    *flat_tensors,
+                    requested_backends=requested_backends,
+                    prioritizer=self._prioritizer,
+                    active_adapter=active_adapter,
+                    points=points,
+                    args_structure=args_structure,
+                    step_id=step_id,
+                )
+                # Split the serialized_grad_inputs for streaming and respond
+                for tensor in self._serialize_grads(grads, requested_backends, metadata):
+                    for part in split_for_streaming(tensor, DEFAULT_MAX_MSG_SIZE):
+                        yield runtime_pb2.ExpertResponse(tensors=[part])
+
+    def _get_active_adapter(self, metadata: dict) -> Union[str, Tuple[str, ...]]:
+        """Get the adapter name or, if rows of the batch use different adapters, a tuple with one name per row"""
         active_adapter = metadata.get("active_adapter", "")
-        if active_adapter and (active_adapter not in self.adapters):
-            raise KeyError(f"adapter {active_adapter} not found")
+        if self.merged_adapter is not None:
+            requested = set(active_adapter) if isinstance(active_adapter, (list, tuple)) else {active_adapter}
+            if requested != {self.merged_adapter}:
+                raise KeyError(f"this server only serves adapter {self.merged_adapter} merged into its weights")
+        if isinstance(active_adapter, (list, tuple)):
+            for adapter in set(active_adapter):
+                self._check_adapter(adapter)
+            return tuple(active_adapter)
+        self._check_adapter(active_adapter)
         return active_adapter
 
+    def _check_adapter(self, adapter: str):
+        if not adapter or adapter in self.adapters:
+            return
+        if self.load_adapters_on_demand:
+            # Delay import of peerz.utils.peft to avoid unnecessary import of bitsandbytes
+            from peerz.utils.peft import is_adapter_cached
+
+            if is_adapter_cached(adapter, cache_dir=self.cache_dir):
+                return  # the Runtime will load it before running the request, see AdapterCache
+        raise KeyError(f"adapter {adapter} not found")
+
+    @staticmethod
+    def _get_step_id(metadata: dict) -> Optional[str]:
+        step_id = metadata.get("step_id")
+        if step_id is not None and not (isinstance(step_id, str) and len(step_id) <= MAX_STEP_ID_LENGTH):
+            raise ValueError(f"step_id must be a string of at most {MAX_STEP_ID_LENGTH} characters, got {step_id}")
+        return step_id
+
     def _serialize_grads(
         self,
         grads: Sequence[torch.Tensor],
@@ -529,6 +586,10 @@ class TransformerConnectionHandler(ConnectionHandler):
                 raise RuntimeError(f"Remote peer does not serve {uid}")
         return tuple(uids)
 
+    def _using_blocks(self, uids: Sequence[ModuleUID]) -> ContextManager:
+        """Mark blocks as used while a request is processed, so that the container does not unload them meanwhile"""
+        return self.served_blocks.use(uids) if self.served_blocks is not None else contextlib.nullcontext()
+
     @contextlib.asynccontextmanager
     async def _allocate_cache(
         self,
@@ -572,6 +633,27 @@ class TransformerConnectionHandler(ConnectionHandler):
         else:
             logger.info(message)
 
+    async def rpc_get_block_weights(
+        self, request: runtime_pb2.ExpertRequest, context: P2PContext
+    ) -> AsyncIterator[runtime_pb2.ExpertResponse]:
+        """Send weights of a block from this server's disk cache to another server that loads it"""
+        if self.block_weights is None:
+            raise RuntimeError("This server does not share block weights")
+        requested_uids = self._check_uids(request.uid)
+        if len(requested_uids) != 1:
+            raise ValueError(f"rpc_get_block_weights expects one block, got {requested_uids}")
+        self._log_request("rpc_get_block_weights", requested_uids, context)
+
+        metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
+        _, block_index = parse_uid(requested_uids[0])
+        async for response in self.block_weights.iterate_responses(
+            block_index,
+            torch_dtype=metadata.get("torch_dtype"),
+            quant_type=metadata.get("quant_type"),
+            hash_only=bool(metadata.get("hash_only", False)),
+        ):
+            yield response
+
     async def rpc_info(self, request: runtime_pb2.ExpertUID, context: P2PContext) -> runtime_pb2.ExpertInfo:
         """Return metadata about stored block uids and current load"""
 
@@ -581,6 +663,8 @@ class TransformerConnectionHandler(ConnectionHandler):
             "dht_client_mode": self.dht.client_mode,
             CACHE_TOKENS_AVAILABLE: backend.memory_cache.bytes_left // max(backend.cache_bytes_per_token.values()),
         }
+        if backend.activation_cache is not None:
+            result[ACTIVATION_CACHE_BYTES_LEFT] = backend.activation_cache.bytes_left
 
         if request.uid:
             block_info = self.module_backends[request.uid].get_info()
@@ -0,0 +1,59 @@
+import contextlib
+import ctypes
+import multiprocessing as mp
+import time
+from typing import Iterable, Sequence, Tuple
+
+from peerz.data_structures import ModuleUID
+
+
+class ServedBlocks:
+    """
+    Tracks which blocks of a ModuleContainer are served and how many requests use each of them.
+
+    The state is kept in shared memory, so that connection handlers (forked processes) see the blocks that the container
+    starts or stops serving while it runs (e.g., once a block is loaded or when the server moves to other blocks).
+    """
+
+    def __init__(self, uids: Sequence[ModuleUID]):
+        self.uids = tuple(uids)
+        self._indices = {uid: i for i, uid in enumerate(self.uids)}
+        self._is_served = mp.Array(ctypes.c_bool, len(self.uids))
+        self._num_requests = mp.Array(ctypes.c_int64, len(self.uids))
+
+    def __contains__(self, uid: ModuleUID) -> bool:
+        index = self._indices.get(uid)
+        return index is not None and self._is_served[index]
+
+    @property
+    def served_uids(self) -> Tuple[ModuleUID, ...]:
+        return tuple(uid for uid, is_served in zip(self.uids, self._is_served[:]) if is_served)
+
+    def set_served(self, uids: Iterable[ModuleUID], is_served: bool):
+        with self._is_served.get_lock():
+            for uid in uids:
+                self._is_served[self._indices[uid]] = is_served
+
+    @contextlib.contextmanager
+    def use(self, uids: Sequence[ModuleUID]):
+        """Count a request to :uids: while it is processed, fail if some of them are not served"""
+        indices = [self._indices[uid] for uid in uids]
+        self._add_requests(indices, 1)  # We count the request before checking, see wait_until_unused()
+        try:
+            for uid, index in zip(uids, indices):
+                if not self._is_served[index]:
+                    raise RuntimeError(f"Remote peer does not serve {uid}")
+            yield
+        finally:
+            self._add_requests(indices, -1)
+
+    def wait_until_unused(self, uids: Sequence[ModuleUID], poll_interval: float = 1.0):
+        """Wait until all requests to :uids: are finished, assuming that these blocks are not served anymore"""
+        indices = [self._indices[uid] for uid in uids]
+        while any(self._num_requests[index] > 0 for index in indices):
+            time.sleep(poll_interval)
+
+    def _add_requests(self, indices: Sequence[int], delta: int):
+        with self._num_requests.get_lock():
+            for index in indices:
+                self._num_requests[index] += delta
@@ -12,23 +12,30 @@ from typing import List, Optional, Sequence, Union
 import psutil
 import torch
 import torch.mps
-from hivemind import DHT, MAX_DHT_TIME_DISCREPANCY_SECONDS
+from hivemind import DHT, MAX_DHT_TIME_DISCREPANCY_SECONDS, PeerID
 from hivemind.moe.server.layers import add_custom_models_from_file
 from hivemind.proto.runtime_pb2 import CompressionType
 from hivemind.utils.logging import get_logger
 
 import peerz
 from peerz.constants import DTYPE_MAP, PUBLIC_INITIAL_PEERS
-from peerz.data_structures import CHAIN_DELIMITER, UID_DELIMITER, ModelInfo, ServerInfo, ServerState
+from peerz.data_structures import CHAIN_DELIMITER, UID_DELIMITER, ModelInfo, RemoteModuleInfo, ServerInfo, ServerState
+from peerz.models.mixtral import WrappedMixtralBlock
 from peerz.server import block_selection
-from peerz.server.block_utils import get_block_size, resolve_block_dtype
+from peerz.server.autotune import get_autotuned_settings
+from peerz.server.block_cache import CACHEABLE_QUANT_TYPES
+from peerz.server.block_utils import get_block_size, get_expert_params_per_block, resolve_block_dtype
+from peerz.server.compiled_block import enable_compile_cache
+from peerz.server.container import ModuleContainer
 from peerz.server.reachability import ReachabilityProtocol, check_direct_reachability
+from peerz.server.standby_blocks import StandbyBlocks
 from peerz.server.throughput import get_dtype_name, get_server_throughput
+from peerz.server.throughput_monitor import ThroughputMonitor
 from peerz.utils.auto_config import AutoDistributedConfig
 from peerz.utils.convert_block import QuantType, check_device_balance
 from peerz.utils.dht import get_remote_module_infos
+from peerz.utils.disk_cache import DEFAULT_CACHE_DIR
 from peerz.utils.misc import get_size_in_bytes
-from peerz.server.container import ModuleContainer
 
 logger = get_logger(__name__)
 
@@ -47,6 +54,7 @@ class Server:
         converted_model_name_or_path: str,
         public_name: Optional[str] = None,
         throughput: Union[float, str],
+        profile_inference: bool = False,
         num_blocks: Optional[int] = None,
         block_indices: Optional[str] = None,
         num_handlers: int = 8,
@@ -54,6 +62,19 @@ class Server:
         min_batch_size: int = 1,
         max_batch_size: Optional[int] = None,
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
+        autotune: bool = False,
+        max_backward_activation_bytes: int = 0,
+        activation_cache_bytes: int = 0,
+        activation_cache_timeout: float = 60,
+        expert_cache_bytes: Optional[int] = None,
+        torch_compile: bool = False,
+        cache_converted_blocks: bool = False,
+        share_block_weights: bool = False,
+        fetch_block_weights: bool = False,
+        trusted_weight_peers: Sequence[str] = (),
+        allow_untrusted_weight_peers: bool = False,
+        standby_cache_bytes: Optional[int] = None,
+        num_loading_workers: int = 2,
         max_alloc_timeout: float = 600,
         attn_cache_tokens: Optional[int] = None,
         torch_dtype: str = "auto",
@@ -82,6 +103,8 @@ class Server:
         use_relay: bool = True,
         use_auto_relay: bool = True,
         adapters: Sequence[str] = (),
+        max_hot_adapters: Optional[int] = None,
+        merge_adapter: bool = False,
         **kwargs,
     ):
         """Create a server with one or more bloom blocks. See run_server.py for documentation."""
@@ -177,9 +200,51 @@ class Server:
 
         if quant_type is None:
             quant_type = QuantType.NF4 if device.type == "cuda" else QuantType.NONE
+        if quant_type == QuantType.CPU_INT8 and any(d.type != "cpu" for d in self.tensor_parallel_devices):
+            raise ValueError("--quant_type cpu_int8 is supported only on CPU, please use int8 or nf4 for GPUs")
         self.quant_type = quant_type
         logger.info(f"Model weights are loaded in {get_dtype_name(torch_dtype, quant_type)} format")
 
+        if expert_cache_bytes is not None:
+            if self.block_config.block_class != WrappedMixtralBlock:
+                raise ValueError("--expert_cache_bytes is supported only for Mixtral models")
+            if device.type != "cpu" or len(self.tensor_parallel_devices) > 1 or quant_type != QuantType.NONE:
+                raise ValueError(
+                    "--expert_cache_bytes is supported only on CPU without tensor parallelism and quantization, "
+                    "since memory-mapped experts would be copied to other devices or formats anyway"
+                )
+            logger.info(f"Expert weights will stay memory-mapped, up to {expert_cache_bytes} bytes of them in RAM")
+        self.expert_cache_bytes = expert_cache_bytes
+
+        if torch_compile and len(self.tensor_parallel_devices) > 1:
+            raise ValueError("--compile is not supported with tensor parallelism")
+        if torch_compile and not hasattr(torch, "compile"):
+            raise ValueError(f"--compile requires torch>=2.0, but you have torch=={torch.__version__}")
+        self.torch_compile = torch_compile
+
+        if cache_converted_blocks and (
+            quant_type not in CACHEABLE_QUANT_TYPES or len(self.tensor_parallel_devices) > 1 or expert_cache_bytes
+        ):
+            raise ValueError(
+                "--cache_converted_blocks is supported only for --quant_type none or cpu_int8, "
+                "without tensor parallelism and --expert_cache_bytes"
+            )
+        self.cache_converted_blocks = cache_converted_blocks
+        self.share_block_weights = share_block_weights
+        if (trusted_weight_peers or allow_untrusted_weight_peers) and not fetch_block_weights:
+            raise ValueError("--trusted_weight_peers and --allow_untrusted_weight_peers require --fetch_block_weights")
+        if fetch_block_weights and not trusted_weight_peers and not allow_untrusted_weight_peers:
+            raise ValueError(
+                "--fetch_block_weights requires --trusted_weight_peers, since hashes reported by untrusted peers "
+                "can't verify weights in a public swarm. Use --allow_untrusted_weight_peers to override this"
+            )
+        self.fetch_block_weights = fetch_block_weights
+        self.trusted_weight_peers = [PeerID.from_base58(peer_id) for peer_id in trusted_weight_peers] or None
+
+        if num_loading_workers <= 0:
+            raise ValueError(f"--num_loading_workers must be positive, got {num_loading_workers}")
+        self.num_loading_workers = num_loading_workers
+
         is_multiquery_attn = self.block_config.num_key_value_groups > 1
         if max_batch_size is None:
             max_batch_size = 8192 if is_multiquery_attn else 2048
@@ -188,6 +253,8 @@ class Server:
         self.min_batch_size, self.max_batch_size = min_batch_size, max_batch_size
         self.inference_max_length = inference_max_length
         self.max_chunk_size_bytes = max_chunk_size_bytes
+        self.max_backward_activation_bytes = max_backward_activation_bytes
+        self.activation_cache_bytes, self.activation_cache_timeout = activation_cache_bytes, activation_cache_timeout
         self.max_alloc_timeout = max_alloc_timeout
 
         # For attention cache in GPU or RAM
@@ -201,6 +268,15 @@ class Server:
         self.cache_dir = cache_dir
         self.max_disk_space = max_disk_space
         self.adapters = adapters
+        if max_hot_adapters is not None and max_hot_adapters <= 0:
+            raise ValueError(f"--max_hot_adapters must be positive, got {max_hot_adapters}")
+        self.max_hot_adapters = max_hot_adapters
+        if merge_adapter and (len(adapters) != 1 or quant_type != QuantType.NONE or max_hot_adapters is not None):
+            raise ValueError(
+                "--merge_adapter requires exactly one adapter in --adapters, --quant_type none, "
+                "and no --max_hot_adapters"
+            )
+        self.merge_adapter = merge_adapter
 
         assert num_blocks is None or block_indices is None, "Please specify num_blocks or block_indices, not both"
         if num_blocks is None and block_indices is None:
@@ -216,11 +292,42 @@ class Server:
             num_blocks = len(block_indices)
         self.strict_block_indices, self.num_blocks = block_indices, num_blocks
 
+        if standby_cache_bytes is not None:
+            if standby_cache_bytes <= 0:
+                raise ValueError(f"--standby_cache_bytes must be positive, got {standby_cache_bytes}")
+            if block_indices is not None or expert_cache_bytes is not None:
+                raise ValueError(
+                    "--standby_cache_bytes is not supported with --block_indices (the server never moves) "
+                    "and --expert_cache_bytes"
+                )
+            logger.info(f"Blocks the server may move to will be kept in RAM, up to {standby_cache_bytes} bytes")
+        self.standby_blocks = StandbyBlocks(standby_cache_bytes) if standby_cache_bytes is not None else None
+
+        if torch_compile:
+            enable_compile_cache(cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR, num_blocks)
+
         gib = 1024**3
         self.attn_cache_bytes = self._cache_bytes_per_block * num_blocks
         logger.info(f"Attention cache for all blocks will consume up to {self.attn_cache_bytes / gib:.2f} GiB")
 
         assert isinstance(throughput, float) or throughput in ["auto", "eval", "dry_run"]
+        self.max_short_inference_tokens = None  # Use the defaults from block_functions.py
+        if autotune:
+            autotuned_settings = get_autotuned_settings(
+                converted_model_name_or_path,
+                self.block_config,
+                device,
+                torch_dtype,
+                quant_type=quant_type,
+                tensor_parallel_devices=self.tensor_parallel_devices,
+                max_chunk_size_bytes=max_chunk_size_bytes,
+                prefill_length=min(inference_max_length, 2048),
+                force_eval=throughput in ["eval", "dry_run"],
+                cache_dir=cache_dir,
+            )
+            self.max_short_inference_tokens = autotuned_settings["max_short_inference_tokens"]
+            self.max_chunk_size_bytes = autotuned_settings["max_chunk_size_bytes"]
+
         if throughput in ["auto", "eval", "dry_run"]:
             force_eval = throughput in ["eval", "dry_run"]
             throughput_info = get_server_throughput(
@@ -233,21 +340,29 @@ class Server:
                 tensor_parallel_devices=self.tensor_parallel_devices,
                 reachable_via_relay=reachable_via_relay,
                 force_eval=force_eval,
+                profile_inference=profile_inference,
                 cache_dir=cache_dir,
             )
             if throughput == "dry_run":
                 logger.info("Finished estimating throughput, exiting")
                 sys.exit(0)
+            # The throughput is re-estimated from the requests processed by the server, see ThroughputMonitor
+            self.throughput_monitor = ThroughputMonitor(
+                throughput_info, num_blocks=num_blocks, reachable_via_relay=reachable_via_relay
+            )
         else:
             throughput_info = {"throughput": throughput}
+            self.throughput_monitor = None
         self.server_info = ServerInfo(
             state=ServerState.JOINING,
             public_name=public_name,
             version=peerz.__version__,
             adapters=tuple(adapters),
+            merged_adapter=adapters[0] if merge_adapter else None,
             torch_dtype=str(torch_dtype).replace("torch.", ""),
             quant_type=quant_type.name.lower(),
             using_relay=reachable_via_relay,
+            shares_block_weights=share_block_weights,
             **throughput_info,
         )
         self.model_info = ModelInfo(num_blocks=self.block_config.num_hidden_layers)
@@ -262,7 +377,7 @@ class Server:
         self.stop = threading.Event()
 
     def _choose_num_blocks(self) -> int:
-        assert self.device.type in ("cuda", "mps"), (
+        assert self.device.type in ("cuda", "mps") or self.expert_cache_bytes is not None, (
             "GPU is not available. If you want to run a CPU-only server, please specify --num_blocks. "
             "CPU-only servers in the public swarm are discouraged since they are much slower"
         )
@@ -288,22 +403,47 @@ class Server:
         gib = 1024**3
         # Estimate of GPU memory used in rpc_backward (2 GiB for BLOOM, proportional for other models)
         autograd_memory = 2 * gib * num_devices / 14336 * self.block_config.hidden_size
+        # Activations kept by single-pass backward over a span and by the activation cache if they are enabled
+        # (see _MergedBackwardStep), both are opt-in since servers used only for inference don't need them
+        autograd_memory += self.max_backward_activation_bytes + self.activation_cache_bytes
 
         block_size = get_block_size(self.block_config, "memory", dtype=self.torch_dtype, quant_type=self.quant_type)
+        if self.expert_cache_bytes is not None:
+            # Memory-mapped experts are not resident, except for the ones in the expert cache shared by all blocks
+            block_size -= get_expert_params_per_block(self.block_config) * get_size_in_bytes(self.torch_dtype)
+            autograd_memory += self.expert_cache_bytes
         total_memory_per_block = block_size + self._cache_bytes_per_block
-        if self.adapters:
+        if (self.adapters and not self.merge_adapter) or self.max_hot_adapters is not None:
             # Delay import of peerz.utils.peft to avoid unnecessary import of bitsandbytes
-            from peerz.utils.peft import estimate_adapter_memory_per_block
-
-            total_memory_per_block += estimate_adapter_memory_per_block(
-                self.block_config,
-                self.torch_dtype,
-                self.adapters,
-                token=self.token,
-                cache_dir=self.cache_dir,
-                max_disk_space=self.max_disk_space,
+            from peerz.utils.peft import (
+                HOT_ADAPTER_LORA_RANK,
+                estimate_adapter_memory_per_block,
+                estimate_lora_memory_per_block,
             )
 
+            adapter_memory_per_block = 0
+            if self.adapters and not self.merge_adapter:
+                adapter_memory_per_block = estimate_adapter_memory_per_block(
+                    self.block_config,
+                    self.torch_dtype,
+                    self.adapters,
+                    token=self.token,
+                    cache_dir=self.cache_dir,
+                    max_disk_space=self.max_disk_space,
+                )
+            if self.max_hot_adapters is not None:
+                # Adapters loaded on demand are unknown at startup, so we reserve memory for the largest of
+                # a typical LoRA adapter and an average adapter from --adapters for each of them
+                hot_adapter_memory_per_block = estimate_lora_memory_per_block(
+                    self.block_config, self.torch_dtype, lora_rank=HOT_ADAPTER_LORA_RANK
+                )
+                if self.adapters:
+                    hot_adapter_memory_per_block = max(
+                        hot_adapter_memory_per_block, adapter_memory_per_block // len(self.adapters)
+                    )
+                adapter_memory_per_block += self.max_hot_adapters * hot_adapter_memory_per_block
+            total_memory_per_block += adapter_memory_per_block
+
         num_blocks = math.floor((total_memory - autograd_memory) / total_memory_per_block)
         assert num_blocks >= 1, "Your GPU does not have enough memory to serve at least one block"
 
@@ -315,8 +455,11 @@ class Server:
         return num_blocks
 
     def run(self):
+        block_indices = None
         while True:
-            block_indices = self._choose_blocks()
+            if block_indices is None:
+                block_indices = self._choose_blocks()
+            self.server_info.adapters = tuple(self.adapters)  # Forget adapters loaded on demand by previous containers
             self.module_container = ModuleContainer.create(
                 dht=self.dht,
                 dht_prefix=self.dht_prefix,
@@ -330,8 +473,22 @@ class Server:
                 min_batch_size=self.min_batch_size,
                 max_batch_size=self.max_batch_size,
                 max_chunk_size_bytes=self.max_chunk_size_bytes,
+                max_backward_activation_bytes=self.max_backward_activation_bytes,
+                activation_cache_bytes=self.activation_cache_bytes,
+                activation_cache_timeout=self.activation_cache_timeout,
+                expert_cache_bytes=self.expert_cache_bytes,
+                max_hot_adapters=self.max_hot_adapters,
+                torch_compile=self.torch_compile,
+                cache_converted_blocks=self.cache_converted_blocks,
+                share_block_weights=self.share_block_weights,
+                fetch_block_weights=self.fetch_block_weights,
+                trusted_weight_peers=self.trusted_weight_peers,
+                standby_blocks=self.standby_blocks,
+                throughput_monitor=self.throughput_monitor,
+                num_loading_workers=self.num_loading_workers,
                 max_alloc_timeout=self.max_alloc_timeout,
                 inference_max_length=self.inference_max_length,
+                max_short_inference_tokens=self.max_short_inference_tokens,
                 torch_dtype=self.torch_dtype,
                 cache_dir=self.cache_dir,
                 max_disk_space=self.max_disk_space,
@@ -352,6 +509,7 @@ class Server:
                 should_validate_reachability=self.should_validate_reachability,
                 start=True,
             )
+            block_indices = None
             try:
                 self.module_container.ready.wait()
 
@@ -364,8 +522,21 @@ class Server:
                         logger.warning("One of subprocesses crashed, restarting the server")
                         break
 
-                    if self._should_choose_other_blocks():
+                    if not self.module_container.is_fully_loaded():
+                        continue  # The DHT shows only a part of our span until all blocks are loaded
+
+                    module_infos = get_remote_module_infos(self.dht, self.module_uids, latest=True)
+                    if self.standby_blocks is not None:
+                        self.module_container.update_standby_blocks(
+                            block_selection.choose_standby_blocks(self.dht.peer_id, module_infos)
+                        )
+
+                    if self._should_choose_other_blocks(module_infos):
                         logger.info("Swarm is imbalanced, server will load other blocks")
+                        block_indices = self._choose_blocks()
+                        if self.module_container.update_blocks(block_indices):
+                            block_indices = None
+                            continue  # The container keeps the blocks it already has and loads the missing ones
                         break  # Stop serving this set of modules
             finally:
                 self.module_container.shutdown()
@@ -397,13 +568,14 @@ class Server:
         # this delay decreases the probability of a race condition while choosing the best blocks to serve.
         time.sleep(random.random() * 2 * self.mean_block_selection_delay)
         module_infos = get_remote_module_infos(self.dht, self.module_uids, latest=True)
+        for module_info in module_infos:
+            module_info.servers.pop(self.dht.peer_id, None)  # Ignore the blocks we're serving now (if any)
         return block_selection.choose_best_blocks(self.num_blocks, module_infos)
 
-    def _should_choose_other_blocks(self) -> bool:
+    def _should_choose_other_blocks(self, module_infos: List[RemoteModuleInfo]) -> bool:
         if self.strict_block_indices is not None:
             return False
 
-        module_infos = get_remote_module_infos(self.dht, self.module_uids, latest=True)
         return block_selection.should_choose_other_blocks(self.dht.peer_id, module_infos, self.balance_quality)
 
     def shutdown(self, timeout: Optional[float] = 5):
@@ -411,6 +583,8 @@ class Server:
         if self.module_container is not None and self.module_container.is_alive():
             self.module_container.join(timeout)
 
+        if self.standby_blocks is not None:
+            self.standby_blocks.shutdown()
         if self.reachability_protocol is not None:
             self.reachability_protocol.shutdown()
         self.dht.shutdown()
@@ -0,0 +1,108 @@
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+import torch.nn as nn
+from hivemind.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class StandbyBlocks:
+    """
+    Keeps blocks that the server would likely move to after rebalancing (see choose_standby_blocks) loaded in host RAM,
+    so that moving to them only needs convert_block() instead of reading and casting weights again.
+
+    A background thread loads the preferred blocks in order, as long as their total size fits into :max_bytes:.
+    The blocks are taken from here by ModuleContainer when it loads them (see pop).
+    """
+
+    def __init__(self, max_bytes: int):
+        assert max_bytes > 0, "max_bytes must be positive"
+        self.max_bytes = max_bytes
+        self.num_hits = self.num_misses = 0
+        self._blocks: Dict[int, nn.Module] = {}
+        self._block_size = 0  # The largest size of a loaded block, used to estimate sizes of the ones not loaded yet
+        self._preferred_indices: List[int] = []
+        self._load_block: Optional[Callable[[int], nn.Module]] = None
+        self._lock = threading.Lock()
+        self._preferences_changed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    @property
+    def block_indices(self) -> List[int]:
+        with self._lock:
+            return list(self._blocks)
+
+    def update(self, preferred_indices: Sequence[int], *, load_block: Callable[[int], nn.Module]):
+        """Keep the first of :preferred_indices: that fit into the budget (loading them with :load_block:)"""
+        with self._lock:
+            self._preferred_indices, self._load_block = list(preferred_indices), load_block
+            self._preferences_changed.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="StandbyBlocks", daemon=True)
+                self._thread.start()
+
+    def pop(self, block_index: int) -> Optional[nn.Module]:
+        """Take a block if it is loaded. The hits and misses are counted once standby blocks are used"""
+        with self._lock:
+            if self._load_block is None:
+                return None  # update() was never called, so misses are expected
+            block = self._blocks.pop(block_index, None)
+            if block is not None:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+            num_hits, num_misses = self.num_hits, self.num_misses
+
+        logger.info(
+            f"Block {block_index} was {'taken from' if block is not None else 'not found in'} standby blocks "
+            f"(hit rate: {num_hits}/{num_hits + num_misses})"
+        )
+        return block
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            self._blocks.clear()
+            self._preferences_changed.set()
+
+    def _run(self):
+        while True:
+            self._preferences_changed.wait()
+            with self._lock:
+                if self._stopped:
+                    return
+                kept_indices = self._choose_kept_indices()
+                for index in list(self._blocks):
+                    if index not in kept_indices:
+                        del self._blocks[index]
+                missing_indices = [index for index in kept_indices if index not in self._blocks]
+                if not missing_indices:
+                    self._preferences_changed.clear()
+                    continue
+                index, load_block = missing_indices[0], self._load_block
+
+            try:
+                block = load_block(index)
+            except Exception:
+                logger.warning(f"Failed to load standby block {index}", exc_info=True)
+                with self._lock:
+                    self._preferred_indices = [i for i in self._preferred_indices if i != index]
+                continue
+
+            with self._lock:
+                # We keep the block even if preferences changed meanwhile, the next iteration unloads it if needed
+                self._blocks[index] = block
+                self._block_size = max(self._block_size, _get_size_in_bytes(block))
+            logger.info(f"Loaded standby block {index}, keeping blocks {sorted(self._blocks)} in RAM")
+
+    def _choose_kept_indices(self) -> List[int]:
+        """Choose the first preferred blocks that fit into max_bytes (assuming that blocks have similar sizes)"""
+        if self._block_size == 0:
+            return self._preferred_indices[:1]  # We need to load one block to know the size
+        return self._preferred_indices[: self.max_bytes // self._block_size]
+
+
+def _get_size_in_bytes(block: nn.Module) -> int:
+    return sum(tensor.numel() * tensor.element_size() for tensor in block.state_dict().values())
@@ -1,18 +1,23 @@
 import fcntl
+import itertools
 import json
 import math
 import multiprocessing as mp
 import os
 import time
 from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Optional, Sequence, Union
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
 
+import numpy as np
 import torch
 import torch.mps
+import torch.nn as nn
 from hivemind.utils.logging import get_logger
 from transformers import PretrainedConfig
 
+from peerz.server.backend import get_shard_num_heads, make_inference_cache_descriptors, select_layer_past
 from peerz.server.block_utils import get_model_block, resolve_block_dtype
 from peerz.utils.convert_block import QuantType, convert_block
 from peerz.utils.disk_cache import DEFAULT_CACHE_DIR
@@ -46,10 +51,67 @@ def get_server_throughput(
     reachable_via_relay: bool,
     relay_penalty: float = 0.2,
     force_eval: bool = False,
+    profile_inference: bool = False,
     cache_dir: Optional[str] = None,
-) -> Dict[str, float]:
+) -> Dict[str, Any]:
+    """
+    Measure the server throughput (or load it from the cache), return the ServerInfo fields describing it
+
+    :param profile_inference: if True, also measure inference step times for a grid of batch sizes, numbers of new
+      tokens, and prefix lengths (unless they are cached), see measure_inference_profile(). The cached profile is
+      announced as ServerInfo.inference_profile even if this is False
+    """
     dtype = resolve_block_dtype(config, dtype)
 
+    cache_key = get_throughput_cache_key(model_name, device, dtype, quant_type, tensor_parallel_devices)
+    logger.info("Loading throughput info")
+    with locked_throughput_cache(cache_dir) as cache:
+        if force_eval:
+            cache.pop(cache_key, None)
+        if cache_key not in cache:
+            cache[cache_key] = measure_throughput_info(
+                config, device, dtype, quant_type=quant_type, tensor_parallel_devices=tensor_parallel_devices
+            )
+        if profile_inference and "inference_profile" not in cache[cache_key]:
+            cache[cache_key]["inference_profile"] = measure_inference_profile(
+                config, device, dtype, quant_type=quant_type, tensor_parallel_devices=tensor_parallel_devices
+            )
+
+    throughput_info = dict(cache[cache_key])
+    if "inference_profile" in throughput_info:
+        throughput_info["inference_profile"] = summarize_inference_profile(throughput_info["inference_profile"])
+    throughput = get_throughput(
+        throughput_info["forward_rps"],
+        throughput_info["network_rps"],
+        num_blocks=num_blocks,
+        reachable_via_relay=reachable_via_relay,
+        relay_penalty=relay_penalty,
+    )
+    throughput_info["throughput"] = throughput
+    logger.info(f"Reporting throughput: {throughput:.1f} tokens/sec for {num_blocks} blocks")
+
+    return throughput_info
+
+
+def get_throughput_cache_key(
+    model_name: str,
+    device: torch.device,
+    dtype: torch.dtype,
+    quant_type: QuantType,
+    tensor_parallel_devices: Sequence[torch.device],
+) -> str:
+    cache_key = f"model_{model_name}"
+    cache_key += f"_device_{get_device_name(device).replace(' ', '_')}"
+    cache_key += f"_dtype_{get_dtype_name(dtype, quant_type)}"
+    if len(tensor_parallel_devices) > 1:
+        for i, device_i in enumerate(tensor_parallel_devices):
+            cache_key += f"_tp{i}_{get_device_name(device_i).replace(' ', '_')}"
+    return cache_key
+
+
+@contextmanager
+def locked_throughput_cache(cache_dir: Optional[str]) -> Iterator[Dict[str, Any]]:
+    """Load the throughput cache, hold the host-wide lock while the caller measures missing entries, save changes"""
     if cache_dir is None:
         cache_dir = DEFAULT_CACHE_DIR
     lock_path = Path(cache_dir, "throughput.lock")
@@ -58,32 +120,23 @@ def get_server_throughput(
     # We use the system-wide lock since only one process at a time can measure the host throughput
     os.makedirs(lock_path.parent, exist_ok=True)
     with open(lock_path, "wb+") as lock_fd:
-        logger.info("Loading throughput info")
         fcntl.flock(lock_fd.fileno(), fcntl.LOCK_EX)
         # The OS will release the lock when lock_fd is closed or the process is killed
 
-        cache_key = f"model_{model_name}"
-        cache_key += f"_device_{get_device_name(device).replace(' ', '_')}"
-        cache_key += f"_dtype_{get_dtype_name(dtype, quant_type)}"
-        if len(tensor_parallel_devices) > 1:
-            for i, device_i in enumerate(tensor_parallel_devices):
-                cache_key += f"_tp{i}_{get_device_name(device_i).replace(' ', '_')}"
-
         cache = {}
         try:
-            if not force_eval and os.path.exists(cache_path):
+            if os.path.exists(cache_path):
                 with open(cache_path) as cache_fd:
                     cache = json.load(cache_fd)
                 assert isinstance(cache, dict)
         except Exception:
             logger.exception(f"Failed to read throughput info from {cache_path}")
             cache = {}
+        original_contents = json.dumps(cache, sort_keys=True)
 
-        if cache_key not in cache:
-            cache[cache_key] = measure_throughput_info(
-                config, device, dtype, quant_type=quant_type, tensor_parallel_devices=tensor_parallel_devices
-            )
+        yield cache
 
+        if json.dumps(cache, sort_keys=True) != original_contents:
             try:
                 os.makedirs(cache_path.parent, exist_ok=True)
                 with open(cache_path, "w") as cache_fd:
@@ -91,21 +144,25 @@ def get_server_throughput(
             except Exception:
                 logger.exception(f"Failed to save throughput info in {cache_path}")
 
-    throughput_info = cache[cache_key]
+
+def get_throughput(
+    forward_rps: float,
+    network_rps: float,
+    *,
+    num_blocks: int,
+    reachable_via_relay: bool,
+    relay_penalty: float = 0.2,
+) -> float:
+    """The throughput announced by a server, given its per-block compute throughput and its network throughput"""
 
     # Most requests start at some block hosted by a server, then use all next blocks hosted on this server.
     # Assuming the start block index is distributed uniformly, the average number of blocks used per request is
     # E[Uniform{1, 2, ..., num_blocks}] = (num_blocks + 1) / 2
     average_blocks_used = (num_blocks + 1) / 2
-    throughput = throughput_info["forward_rps"] / average_blocks_used
-
-    network_rps = throughput_info["network_rps"] * (relay_penalty if reachable_via_relay else 1)
-    throughput = min(throughput, network_rps)
-
-    throughput_info["throughput"] = throughput
-    logger.info(f"Reporting throughput: {throughput:.1f} tokens/sec for {num_blocks} blocks")
+    throughput = forward_rps / average_blocks_used
 
-    return throughput_info
+    network_rps = network_rps * (relay_penalty if reachable_via_relay else 1)
+    return min(throughput, network_rps)
 
 
 def measure_throughput_info(
@@ -199,13 +256,8 @@ def measure_compute_rps(
     inference: bool,
 ) -> float:
     device = torch.device(device)
-    if not tensor_parallel_devices:
-        tensor_parallel_devices = (device,)
     with torch.inference_mode():
-        block = get_model_block(config)
-        block = block.to(dtype)
-        block = convert_block(block, 0, config, tensor_parallel_devices, device, quant_type=quant_type, freeze=True)
-
+        block = _create_benchmark_block(config, device, dtype, quant_type, tensor_parallel_devices)
         cache = (DUMMY_KEY_PAST.to(dtype=dtype, device=device), DUMMY_KEY_PAST.to(dtype=dtype, device=device))
         elapsed = 0
         dummy_input = torch.randn(1, n_tokens, config.hidden_size, device=device, dtype=dtype)
@@ -237,6 +289,101 @@ def measure_compute_rps(
     return device_rps
 
 
+def measure_inference_profile(
+    config: PretrainedConfig,
+    device: torch.device,
+    dtype: torch.dtype,
+    *,
+    quant_type: QuantType,
+    tensor_parallel_devices: Sequence[torch.device],
+    batch_sizes: Sequence[int] = (1, 8),
+    num_new_tokens: Sequence[int] = (1, 16),
+    prefix_lengths: Sequence[int] = (0, 512, 2048),
+    n_steps: int = 5,
+) -> List[Dict[str, float]]:
+    """Measure the time of an inference step through one block for each combination of the given parameters"""
+    logger.info("Measuring inference step times for different batch sizes and prefix lengths")
+    device = torch.device(device)
+    profile = []
+    with torch.inference_mode():
+        block = _create_benchmark_block(config, device, dtype, quant_type, tensor_parallel_devices)
+        for batch_size, prefix_length in itertools.product(batch_sizes, prefix_lengths):
+            # Step times do not depend on the cache contents, so we don't need to compute the prefix
+            layer_past = _create_benchmark_caches(
+                block, config, dtype, batch_size=batch_size, max_length=prefix_length + max(num_new_tokens)
+            )
+
+            for n_tokens in num_new_tokens:
+                dummy_input = torch.randn(batch_size, n_tokens, config.hidden_size, device=device, dtype=dtype)
+
+                # Like TransformerBackend.inference_step, all steps write new tokens into the cache after the prefix
+                def step():
+                    block.forward(dummy_input, use_cache=True, layer_past=layer_past, kv_cache_position=prefix_length)
+
+                step()  # Skip the 1st step (initialization)
+                synchronize(device)
+
+                start_time = time.perf_counter()
+                for _ in range(n_steps):
+                    step()
+                synchronize(device)
+                step_time = (time.perf_counter() - start_time) / n_steps
+                profile.append(
+                    dict(
+                        batch_size=batch_size, num_new_tokens=n_tokens, prefix_length=prefix_length, step_time=step_time
+                    )
+                )
+                logger.debug(f"Inference step time: {step_time * 1000:.1f} ms ({profile[-1]})")
+    return profile
+
+
+def summarize_inference_profile(profile: List[Dict[str, float]]) -> Dict[str, float]:
+    """
+    Fit the step time to base + per_new_token * batch_size * num_new_tokens + per_cached_token * batch_size *
+    prefix_length (announced in ServerInfo.inference_profile, see RemoteSequenceManager._estimate_step_time)
+    """
+    features = np.array(
+        [
+            [1, point["batch_size"] * point["num_new_tokens"], point["batch_size"] * point["prefix_length"]]
+            for point in profile
+        ],
+        dtype=np.float64,
+    )
+    step_times = np.array([point["step_time"] for point in profile], dtype=np.float64)
+    coefs, *_ = np.linalg.lstsq(features, step_times, rcond=None)
+    base, per_new_token, per_cached_token = np.maximum(coefs, 0).tolist()  # Negative values can only be noise
+    return dict(base=base, per_new_token=per_new_token, per_cached_token=per_cached_token)
+
+
+def _create_benchmark_block(
+    config: PretrainedConfig,
+    device: torch.device,
+    dtype: torch.dtype,
+    quant_type: QuantType,
+    tensor_parallel_devices: Sequence[torch.device],
+) -> nn.Module:
+    if not tensor_parallel_devices:
+        tensor_parallel_devices = (device,)
+    block = get_model_block(config)
+    block = block.to(dtype)
+    return convert_block(block, 0, config, tensor_parallel_devices, device, quant_type=quant_type, freeze=True)
+
+
+def _create_benchmark_caches(
+    block: nn.Module, config: PretrainedConfig, dtype: torch.dtype, *, batch_size: int, max_length: int
+) -> Sequence[torch.Tensor]:
+    """Preallocate attention caches for :block: in the layout used by TransformerBackend.inference_step"""
+    descriptors = make_inference_cache_descriptors(
+        config,
+        dtype,
+        block.devices,
+        get_shard_num_heads(block, config),
+        batch_size=batch_size,
+        max_length=max_length,
+    )
+    return select_layer_past(block, [descr.make_zeros() for descr in descriptors])
+
+
 def synchronize(device: torch.device):
     if device.type == "cuda":
         torch.cuda.synchronize(device)
@@ -0,0 +1,103 @@
+"""
+Online re-estimation of the throughput announced by a server (used with --throughput auto or eval).
+
+get_server_throughput() measures inference_rps and forward_rps once with a synthetic block and caches them forever,
+so they do not reflect thermal throttling, co-tenants on the host, or the actual mix of requests. ThroughputMonitor
+keeps exponential moving averages of the same quantities observed by the Runtime while it processes real requests:
+
+- inference_rps: inference steps per second per block, for steps where each sequence gets one new token
+  (as in measure_compute_rps(); steps that process prefixes do not represent the latency of generating tokens);
+- forward_rps: tokens per second per block, for forward batches of at least :min_forward_tokens: tokens
+  (smaller batches underutilize the device, so they do not show its capacity).
+
+The announced values follow these averages with damping: they change only if an average deviates from them by more
+than :tolerance:, and by at most :max_change: per announcement, so that noise does not make routing and
+should_choose_other_blocks() oscillate.
+"""
+import math
+import threading
+from typing import Dict
+
+from hivemind.utils.logging import get_logger
+
+from peerz.data_structures import ServerInfo
+from peerz.server.throughput import get_throughput
+
+logger = get_logger(__name__)
+
+MONITORED_KEYS = ("inference_rps", "forward_rps")
+
+
+class ThroughputMonitor:
+    """
+    Tracks the throughput observed by the Runtime and periodically updates the announced one (see the module docstring)
+
+    :param throughput_info: the throughput measured by get_server_throughput(), used as the initial estimate
+    :param num_blocks: the number of blocks served, used to convert forward_rps into the announced throughput
+    :param time_constant: the averages forget older observations after this many seconds of processing time
+    """
+
+    def __init__(
+        self,
+        throughput_info: Dict[str, float],
+        *,
+        num_blocks: int,
+        reachable_via_relay: bool,
+        time_constant: float = 60,
+        min_forward_tokens: int = 256,
+        tolerance: float = 0.1,
+        max_change: float = 0.25,
+    ):
+        assert time_constant > 0 and tolerance >= 0 and max_change > 0
+        self.network_rps, self.num_blocks = throughput_info["network_rps"], num_blocks
+        self.reachable_via_relay = reachable_via_relay
+        self.time_constant, self.min_forward_tokens = time_constant, min_forward_tokens
+        self.tolerance, self.max_change = tolerance, max_change
+
+        self.announced = {key: throughput_info[key] for key in MONITORED_KEYS}
+        self._averages = dict(self.announced)
+        self._lock = threading.Lock()
+
+    @property
+    def averages(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._averages)
+
+    def record_inference_step(self, *, num_new_tokens: int, num_blocks: int, elapsed: float):
+        """Record an inference step processed by the Runtime, :num_new_tokens: is the number of tokens per sequence"""
+        if num_new_tokens == 1:
+            self._record("inference_rps", num_blocks / elapsed, elapsed)
+
+    def record_forward(self, *, num_tokens: int, num_blocks: int, elapsed: float):
+        """Record a forward pass processed by the Runtime, :num_tokens: is the total number of tokens in the batch"""
+        if num_tokens >= self.min_forward_tokens:
+            self._record("forward_rps", num_tokens * num_blocks / elapsed, elapsed)
+
+    def _record(self, key: str, rps: float, elapsed: float):
+        if elapsed <= 0:
+            return
+        weight = 1 - math.exp(-elapsed / self.time_constant)
+        with self._lock:
+            self._averages[key] += weight * (rps - self._averages[key])
+
+    def update_server_info(self, server_info: ServerInfo):
+        """Move the announced throughput towards the observed one (with damping) and write it to :server_info:"""
+        averages = self.averages
+        for key in MONITORED_KEYS:
+            average, announced = averages[key], self.announced[key]
+            if abs(average / announced - 1) > self.tolerance:
+                self.announced[key] = min(
+                    max(average, announced / (1 + self.max_change)), announced * (1 + self.max_change)
+                )
+                logger.info(
+                    f"Observed {key}={average:.1f}, announcing {key}={self.announced[key]:.1f} (was {announced:.1f})"
+                )
+
+        server_info.inference_rps = self.announced["inference_rps"]
+        server_info.forward_rps = self.announced["forward_rps"]
+        server_info.throughput = get_throughput(
+            self.announced["forward_rps"],
+            self.network_rps,
+            num_blocks=self.num_blocks,
+            reachable_via_relay=self.reachable_via_relay,
+        )
@@ -20,6 +20,7 @@ class QuantType(Enum):
     NONE = 0
     INT8 = 1  # 8-bit as in the LLM.int8() paper
     NF4 = 2  # 4-bit as in the QLoRA paper
+    CPU_INT8 = 3  # 8-bit weights with per-channel scales and dynamically quantized inputs, runs on CPU without bnb
 
 
 def convert_block(
@@ -31,6 +32,8 @@ def convert_block(
     quant_type: QuantType,
     freeze: bool = True,
     adapters: Optional[Sequence[str]] = None,
+    add_lora_layers: bool = False,
+    merge_adapter: bool = False,
     **kwargs,
 ) -> tp.TensorParallel:
     """
@@ -44,6 +47,9 @@ def convert_block(
     :param output_device: if tensor_parallel_devices is True, output
     :param quant_type: quantization type
     :param freeze: if True (default), make all module parameters non-trainable
+    :param adapters: names of LoRA adapters to load into the block
+    :param add_lora_layers: if True, create LoRA layers even without :adapters:, so that adapters can be loaded later
+    :param merge_adapter: if True, fold the only adapter in :adapters: into base weights (for non-quantized blocks)
     :return: a module that acts like the original block, but runs with all specified optimizations
 
     """
@@ -58,11 +64,11 @@ def convert_block(
     for shard, device in zip(block.module_shards, block.devices):
         shard.to(device)
 
-    if adapters:
-        from peerz.utils.peft import add_adapter_to_block, create_lora_adapter, load_peft
+    if adapters or add_lora_layers:
+        from peerz.utils.peft import add_adapter_to_block, create_lora_adapter, load_peft, merge_adapter_into_block
 
         create_lora_adapter(block, quant_type=quant_type)
-        for adapter_name in adapters:
+        for adapter_name in adapters or ():
             adapter_config, adapter_state_dict = load_peft(
                 adapter_name,
                 block_idx=block_index,
@@ -70,12 +76,17 @@ def convert_block(
             )
             add_adapter_to_block(block, block_index, adapter_name, adapter_config, adapter_state_dict)
 
+        if merge_adapter:
+            assert quant_type == QuantType.NONE and len(adapters) == 1, "only one non-quantized adapter can be merged"
+            merge_adapter_into_block(block, adapters[0])
+
     return block
 
 
 def quantize_module(model: nn.Module, *, quant_type: QuantType) -> nn.Module:
-    # Import bitsandbytes only when necessary, so peerz runs on platforms not supported by bitsandbytes
-    import bitsandbytes as bnb
+    if quant_type != QuantType.CPU_INT8:
+        # Import bitsandbytes only when necessary, so peerz runs on platforms not supported by bitsandbytes
+        import bitsandbytes as bnb
 
     for n, module in model.named_children():
         if len(list(module.children())) > 0:
@@ -83,7 +94,9 @@ def quantize_module(model: nn.Module, *, quant_type: QuantType) -> nn.Module:
 
         if isinstance(module, torch.nn.Linear) and n not in ["lm_head", "score"]:
             assert module.weight.device.type == "cpu", f"expected linear layers on CPU, got {module.weight.device}"
-            if quant_type == QuantType.INT8:
+            if quant_type == QuantType.CPU_INT8:
+                model._modules[n] = CpuInt8Linear.from_linear(module)
+            elif quant_type == QuantType.INT8:
                 model._modules[n] = bnb.nn.Linear8bitLt(
                     module.in_features,
                     module.out_features,
@@ -115,6 +128,80 @@ def quantize_module(model: nn.Module, *, quant_type: QuantType) -> nn.Module:
     return model
 
 
+class CpuInt8Linear(nn.Module):
+    """
+    A linear layer with int8 weights (symmetric, one scale per output channel) that runs on CPU without bitsandbytes.
+
+    Inputs are quantized to 8 bits on the fly and multiplied with torch's dynamically quantized linear kernels
+    (fbgemm/onednn), so the layer reads 4x fewer bytes of weights than a float32 layer. Outputs are cast back to
+    the input dtype. Backward passes w.r.t. inputs use dequantized weights, weights themselves are always frozen.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True):
+        super().__init__()
+        self.in_features, self.out_features = in_features, out_features
+        self.packed_params = None  # torch.ops.quantized linear params, not a tensor (not moved with .to())
+        self.register_buffer("weight_scale", torch.ones(out_features))
+        self.bias = nn.Parameter(torch.zeros(out_features), requires_grad=False) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear) -> "CpuInt8Linear":
+        layer = cls(linear.in_features, linear.out_features, bias=False)
+        weight = linear.weight.detach().float()
+        scale = (weight.abs().amax(dim=1) / 127).clamp_min(torch.finfo(torch.float32).tiny)
+        int8_weight = torch.quantize_per_channel(
+            weight, scale.double(), torch.zeros_like(scale, dtype=torch.long), axis=0, dtype=torch.qint8
+        )
+        layer.packed_params = torch.ops.quantized.linear_prepack(int8_weight, None)
+        layer.weight_scale = scale
+        layer.bias = linear.bias
+        return layer
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        if self.packed_params is not None:
+            int8_weight, _ = torch.ops.quantized.linear_unpack(self.packed_params)
+            destination[prefix + "weight"] = int8_weight.int_repr()
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, *args, **kwargs):
+        int8_weight = state_dict.pop(prefix + "weight", None)  # note: nn.Module.load_state_dict() passes a copy
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, *args, **kwargs)
+        if int8_weight is None:
+            missing_keys.append(prefix + "weight")
+            return
+        scale = self.weight_scale.double()
+        int8_weight = torch._make_per_channel_quantized_tensor(
+            int8_weight, scale, torch.zeros_like(scale, dtype=torch.long), axis=0
+        )
+        self.packed_params = torch.ops.quantized.linear_prepack(int8_weight, None)
+
+    def dequantize_weight(self, dtype: torch.dtype) -> torch.Tensor:
+        int8_weight, _ = torch.ops.quantized.linear_unpack(self.packed_params)
+        return int8_weight.dequantize().to(dtype)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        output = _CpuInt8LinearFunction.apply(input, self)
+        if self.bias is not None:
+            output = output + self.bias.to(output.dtype)
+        return output
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class _CpuInt8LinearFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input: torch.Tensor, layer: CpuInt8Linear) -> torch.Tensor:
+        ctx.layer = layer
+        # reduce_range=True avoids overflows in fbgemm kernels on CPUs without VNNI instructions
+        output = torch.ops.quantized.linear_dynamic(input.float(), layer.packed_params, True)
+        return output.to(input.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        return grad_output @ ctx.layer.dequantize_weight(grad_output.dtype), None
+
+
 def make_tensor_parallel(
     block: nn.Module, model_config: PretrainedConfig, devices: Sequence[torch.device], output_device: torch.device
 ) -> nn.Module:
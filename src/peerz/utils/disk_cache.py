@@ -1,9 +1,11 @@
 import fcntl
+import json
 import os
 import shutil
-from contextlib import contextmanager
+import sqlite3
+from contextlib import contextmanager, suppress
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 import huggingface_hub
 from hivemind.utils.logging import get_logger
@@ -13,6 +15,27 @@ logger = get_logger(__name__)
 DEFAULT_CACHE_DIR = os.getenv("PEERZ_CACHE", Path(Path.home(), ".cache", "peerz"))
 
 BLOCKS_LOCK_FILE = "blocks.lock"
+CONVERTED_BLOCKS_DIR = "converted_blocks"  # see peerz.server.block_cache
+BLOCK_SLICES_DIR = "block_slices"  # see peerz.server.from_pretrained._download_block_slice
+INDEX_FILE = "disk_cache_index.sqlite3"
+INDEX_VERSION = 1  # Increase this when the index schema changes, so that old indices are rebuilt
+
+_INDEX_SCHEMA = """
+DROP TABLE IF EXISTS files;
+DROP TABLE IF EXISTS total;
+CREATE TABLE files (
+    blob_path TEXT PRIMARY KEY,
+    link_paths TEXT NOT NULL,  -- JSON list of symlinks to the blob (for files in the HF cache)
+    size INTEGER NOT NULL,
+    last_accessed REAL NOT NULL
+);
+CREATE INDEX files_by_last_accessed ON files (last_accessed);
+CREATE TABLE total (size INTEGER NOT NULL);
+INSERT INTO total VALUES (0);
+CREATE TRIGGER files_inserted AFTER INSERT ON files BEGIN UPDATE total SET size = size + NEW.size; END;
+CREATE TRIGGER files_deleted AFTER DELETE ON files BEGIN UPDATE total SET size = size - OLD.size; END;
+CREATE TRIGGER files_resized AFTER UPDATE OF size ON files BEGIN UPDATE total SET size = size - OLD.size + NEW.size; END;
+"""
 
 
 @contextmanager
@@ -38,6 +61,29 @@ def allow_cache_writes(cache_dir: Optional[str]):
     return _blocks_lock(cache_dir, fcntl.LOCK_EX)
 
 
+def register_cached_file(path: str, *, cache_dir: Optional[str]):
+    """
+    Add a file that was just saved to the cache (e.g., downloaded from the HF Hub) to the index used by
+    free_disk_space_for(). For files in the HF cache, :path: is the snapshot symlink (as returned by hf_hub_download).
+    Must be called under allow_cache_writes().
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    blob_path = Path(path).resolve()
+    link_paths = [_resolve_link(path)] if os.path.islink(path) else []
+    stat = blob_path.stat()
+    with _open_index(cache_dir) as index, index:
+        _add_to_index(index, blob_path, link_paths, size=stat.st_size, last_accessed=stat.st_atime)
+
+
+def unregister_cached_file(path: str, *, cache_dir: Optional[str]):
+    """Remove a file from the index used by free_disk_space_for(). Must be called under allow_cache_writes()"""
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    with _open_index(cache_dir) as index, index:
+        index.execute("DELETE FROM files WHERE blob_path = ?", (str(Path(path).resolve()),))
+
+
 def free_disk_space_for(
     size: int,
     *,
@@ -45,39 +91,152 @@ def free_disk_space_for(
     max_disk_space: Optional[int],
     os_quota: int = 1024**3,  # Minimal space we should leave to keep OS function normally
 ):
+    """
+    Remove the least recently used cached files until there is enough space to save a file of :size: bytes.
+    Must be called under allow_cache_writes().
+
+    Instead of scanning the cache each time, this function uses a persistent index of cached files (see _open_index),
+    so that each step of choosing files to remove takes O(log n). The index is rebuilt from a full scan only if it
+    is missing or if it does not have enough files to remove (e.g., if files were added to the cache bypassing it).
+    """
     if cache_dir is None:
         cache_dir = DEFAULT_CACHE_DIR
-    cache_info = huggingface_hub.scan_cache_dir(cache_dir)
 
+    with _open_index(cache_dir) as index:
+        removed_paths, freed_space, missing_space = _remove_least_recently_used(
+            index, size, cache_dir=cache_dir, max_disk_space=max_disk_space, os_quota=os_quota
+        )
+        if missing_space > 0:
+            logger.debug("Not enough files to remove in the disk cache index, rebuilding it")
+            _rebuild_index(index, cache_dir)
+            more_removed_paths, more_freed_space, missing_space = _remove_least_recently_used(
+                index, size, cache_dir=cache_dir, max_disk_space=max_disk_space, os_quota=os_quota
+            )
+            removed_paths += more_removed_paths
+            freed_space += more_freed_space
+
+    gib = 1024**3
+    if removed_paths:
+        logger.info(f"Removed {len(removed_paths)} files to free {freed_space / gib:.1f} GiB of disk space")
+        logger.debug(f"Removed paths: {removed_paths}")
+
+    if missing_space > 0:
+        raise RuntimeError(
+            f"Insufficient disk space to load a block. Please free {missing_space / gib:.1f} GiB "
+            f"on the volume for {cache_dir} or increase --max_disk_space if you set it manually"
+        )
+
+
+def _remove_least_recently_used(
+    index: sqlite3.Connection, size: int, *, cache_dir: str, max_disk_space: Optional[int], os_quota: int
+) -> Tuple[List[str], int, int]:
+    """Remove as few least recently used files as possible, return (removed paths, freed space, missing space)"""
+    ((size_on_disk,),) = index.execute("SELECT size FROM total")
     available_space = shutil.disk_usage(cache_dir).free - os_quota
     if max_disk_space is not None:
-        available_space = min(available_space, max_disk_space - cache_info.size_on_disk)
+        available_space = min(available_space, max_disk_space - size_on_disk)
 
     gib = 1024**3
     logger.debug(f"Disk space: required {size / gib:.1f} GiB, available {available_space / gib:.1f} GiB")
-    if size <= available_space:
-        return
-
-    cached_files = [file for repo in cache_info.repos for revision in repo.revisions for file in revision.files]
 
-    # Remove as few least recently used files as possible
-    removed_files = []
+    removed_paths = []
     freed_space = 0
     extra_space_needed = size - available_space
-    for file in sorted(cached_files, key=lambda file: file.blob_last_accessed):
-        os.remove(file.file_path)  # Remove symlink
-        os.remove(file.blob_path)  # Remove contents
-
-        removed_files.append(file)
-        freed_space += file.size_on_disk
-        if freed_space >= extra_space_needed:
+    while freed_space < extra_space_needed:
+        row = index.execute(
+            "SELECT blob_path, link_paths, size, last_accessed FROM files ORDER BY last_accessed LIMIT 1"
+        ).fetchone()
+        if row is None:
             break
-    if removed_files:
-        logger.info(f"Removed {len(removed_files)} files to free {freed_space / gib:.1f} GiB of disk space")
-        logger.debug(f"Removed paths: {[str(file.file_path) for file in removed_files]}")
+        blob_path, link_paths, file_size, last_accessed = row
+
+        try:
+            blob_stat = os.stat(blob_path)
+        except FileNotFoundError:
+            blob_stat = None  # Removed bypassing the index, so we can't count it as freed space
+        if blob_stat is not None and blob_stat.st_atime > last_accessed:
+            # The file was read after it was indexed, so we move it to its actual place in the LRU order
+            with index:
+                index.execute("UPDATE files SET last_accessed = ? WHERE blob_path = ?", (blob_stat.st_atime, blob_path))
+            continue
+
+        # We remove the symlinks first and the contents second
+        paths = json.loads(link_paths) + [blob_path]
+        for path in paths:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+        with index:
+            index.execute("DELETE FROM files WHERE blob_path = ?", (blob_path,))
+
+        if blob_stat is not None:
+            removed_paths.append(paths[0])
+            freed_space += file_size
+    return removed_paths, freed_space, max(extra_space_needed - freed_space, 0)
 
-    if freed_space < extra_space_needed:
-        raise RuntimeError(
-            f"Insufficient disk space to load a block. Please free {(extra_space_needed - freed_space) / gib:.1f} GiB "
-            f"on the volume for {cache_dir} or increase --max_disk_space if you set it manually"
+
+@contextmanager
+def _open_index(cache_dir: str) -> Iterator[sqlite3.Connection]:
+    """
+    Open the index of files that free_disk_space_for() may remove (files in the HF cache, converted blocks, etc.),
+    building it from a full scan of the cache if needed. All writes to the index are made under allow_cache_writes().
+    """
+    index_path = Path(cache_dir, INDEX_FILE)
+    index = sqlite3.connect(index_path)
+    try:
+        try:
+            ((version,),) = index.execute("PRAGMA user_version")
+        except sqlite3.DatabaseError:
+            logger.warning(f"Disk cache index {index_path} is corrupted, it will be rebuilt", exc_info=True)
+            index.close()
+            os.remove(index_path)
+            index = sqlite3.connect(index_path)
+            version = None
+        if version != INDEX_VERSION:
+            _rebuild_index(index, cache_dir)
+        yield index
+    finally:
+        index.close()
+
+
+def _rebuild_index(index: sqlite3.Connection, cache_dir: str):
+    index.executescript(_INDEX_SCHEMA)
+    with index:
+        cache_info = huggingface_hub.scan_cache_dir(cache_dir)
+        for repo in cache_info.repos:
+            for revision in repo.revisions:
+                for file in revision.files:
+                    _add_to_index(
+                        index,
+                        file.blob_path,
+                        [file.file_path],
+                        size=file.size_on_disk,
+                        last_accessed=file.blob_last_accessed,
+                    )
+
+        for dirname in [CONVERTED_BLOCKS_DIR, BLOCK_SLICES_DIR]:
+            for path in Path(cache_dir, dirname).rglob("*.safetensors"):
+                stat = path.stat()
+                _add_to_index(index, path.resolve(), [], size=stat.st_size, last_accessed=stat.st_atime)
+        index.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+
+def _add_to_index(
+    index: sqlite3.Connection, blob_path: Path, link_paths: Sequence[Path], *, size: int, last_accessed: float
+):
+    row = index.execute("SELECT link_paths FROM files WHERE blob_path = ?", (str(blob_path),)).fetchone()
+    if row is None:
+        index.execute(
+            "INSERT INTO files VALUES (?, ?, ?, ?)",
+            (str(blob_path), json.dumps(list(map(str, link_paths))), size, last_accessed),
         )
+    else:  # Several revisions may link to the same blob
+        link_paths = sorted(set(json.loads(row[0])) | set(map(str, link_paths)))
+        index.execute(
+            "UPDATE files SET link_paths = ?, size = ?, last_accessed = ? WHERE blob_path = ?",
+            (json.dumps(link_paths), size, last_accessed, str(blob_path)),
+        )
+
+
+def _resolve_link(path: str) -> Path:
+    """Resolve the directories of a symlink, but not the symlink itself (like the file paths in HFCacheInfo)"""
+    return Path(path).parent.resolve() / Path(path).name
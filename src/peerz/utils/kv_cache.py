@@ -0,0 +1,73 @@
+"""
+Helpers for blocks that write attention caches in place.
+
+During inference, TransformerBackend keeps attention caches preallocated for the whole session in MemoryCache.
+Keys are stored as [batch_size * num_kv_heads, head_dim, max_length] and values as
+[batch_size * num_kv_heads, max_length, head_dim]. Instead of concatenating the past with new keys/values on
+every step, blocks receive these tensors together with the number of tokens already written (kv_cache_position),
+write new keys/values right after them, and attend to views of the cache without copying it.
+"""
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+
+
+def update_kv_cache_inplace(
+    key_cache: torch.Tensor,
+    value_cache: torch.Tensor,
+    new_keys: torch.Tensor,
+    new_values: torch.Tensor,
+    position: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Write keys and values of new tokens into preallocated cache tensors, starting from :position:
+
+    :param key_cache: keys of shape [batch_size * num_kv_heads, head_dim, max_length]
+    :param value_cache: values of shape [batch_size * num_kv_heads, max_length, head_dim]
+    :param new_keys: keys of shape [..., new_length, head_dim], where leading dims multiply to batch * num_kv_heads
+    :param new_values: values of the same shape as new_keys
+    :param position: the number of tokens that are already in the cache
+    :returns: keys and values for all tokens so far, [..., position + new_length, head_dim], as views of the cache
+    """
+    *leading_dims, new_length, head_dim = new_keys.shape
+    end = position + new_length
+    if end > value_cache.shape[1]:
+        raise ValueError(
+            f"Cannot write {new_length} tokens at position {position}, cache length is {value_cache.shape[1]}"
+        )
+
+    key_cache = key_cache.view(*leading_dims, head_dim, -1).transpose(-1, -2)
+    value_cache = value_cache.view(*leading_dims, -1, head_dim)
+    key_cache[..., position:end, :] = new_keys
+    value_cache[..., position:end, :] = new_values
+    return key_cache[..., :end, :], value_cache[..., :end, :]
+
+
+def causal_attention_with_past(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    """
+    Run F.scaled_dot_product_attention for new tokens that go after the past ones, without repeating key/value heads
+
+    :param query: [batch_size, num_heads, q_length, head_dim]
+    :param key: [batch_size, num_kv_heads, kv_length, head_dim], may be a non-contiguous view of the cache
+    :param value: [batch_size, num_kv_heads, kv_length, head_dim]
+    :returns: attention outputs of shape [batch_size, num_heads, q_length, head_dim]
+    """
+    batch_size, num_heads, q_length, head_dim = query.shape
+    num_kv_heads, kv_length = key.shape[1], key.shape[2]
+    num_groups = num_heads // num_kv_heads
+
+    if q_length == kv_length:
+        # There is no past, so the mask is a plain causal one and copying key/value heads is cheap
+        key, value = [x.repeat_interleave(num_groups, dim=1) if num_groups > 1 else x for x in (key, value)]
+        return F.scaled_dot_product_attention(query, key, value, is_causal=True)
+
+    # Query heads that share a key/value head are stacked along the sequence dimension, so that we can attend to
+    # the cache as is. is_causal=True aligns the mask to the top-left corner, so we build it explicitly
+    query = query.reshape(batch_size, num_kv_heads, num_groups * q_length, head_dim)
+    causal_mask = None
+    if q_length > 1:
+        causal_mask = torch.ones(q_length, kv_length, dtype=torch.bool, device=query.device).tril(kv_length - q_length)
+        causal_mask = causal_mask.repeat(num_groups, 1)
+    attn_output = F.scaled_dot_product_attention(query, key, value, attn_mask=causal_mask)
+    return attn_output.reshape(batch_size, num_heads, q_length, head_dim)
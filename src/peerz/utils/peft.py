@@ -1,15 +1,16 @@
 import contextlib
+import dataclasses
+import functools
 import re
 import time
-from typing import Optional, Sequence, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
-import bitsandbytes as bnb
 import torch
 import torch.nn as nn
 import transformers
 from accelerate import init_empty_weights
 from hivemind.utils.logging import get_logger
-from huggingface_hub import HfFileSystem, get_hf_file_metadata, hf_hub_url
+from huggingface_hub import HfFileSystem, get_hf_file_metadata, hf_hub_url, try_to_load_from_cache
 from peft.config import PeftConfig
 from peft.tuners import lora
 from peft.utils import COMMON_LAYERS_PATTERN, CONFIG_NAME, SAFETENSORS_WEIGHTS_NAME
@@ -18,17 +19,28 @@ from safetensors.torch import load_file
 from transformers.utils import get_file_from_repo
 
 from peerz.server.block_utils import get_model_block, resolve_block_dtype
-from peerz.utils.convert_block import QuantType
-from peerz.utils.disk_cache import allow_cache_reads, allow_cache_writes, free_disk_space_for
+from peerz.utils.convert_block import CpuInt8Linear, QuantType
+from peerz.utils.disk_cache import allow_cache_reads, allow_cache_writes, free_disk_space_for, register_cached_file
 from peerz.utils.misc import get_size_in_bytes
 
 logger = get_logger(__name__)
 
+# LoRA rank assumed for adapters loaded on demand (--max_hot_adapters) when estimating their memory at startup
+HOT_ADAPTER_LORA_RANK = 16
+
 
 def check_peft_repository(repo_id: str) -> bool:
     return HfFileSystem().exists(f"{repo_id}/{SAFETENSORS_WEIGHTS_NAME}")
 
 
+def is_adapter_cached(repo_id: str, *, cache_dir: Optional[str] = None) -> bool:
+    """Check if an adapter can be loaded from the local HF cache without accessing the network"""
+    return all(
+        isinstance(try_to_load_from_cache(repo_id, filename, cache_dir=cache_dir), str)
+        for filename in (CONFIG_NAME, SAFETENSORS_WEIGHTS_NAME)
+    )
+
+
 def load_specific_module(block_idx: int, filepath: str, framework: str = "pt", device: Optional[int] = None):
     tensors = dict()
     is_tensors_found = dict()
@@ -110,7 +122,7 @@ def load_peft(
                 else:
                     logger.warning(f"Failed to fetch size from peft repo {repo_id}")
 
-                return get_adapter_from_repo(
+                adapter = get_adapter_from_repo(
                     repo_id,
                     block_idx,
                     device,
@@ -119,6 +131,10 @@ def load_peft(
                     cache_dir=cache_dir,
                     local_files_only=False,
                 )
+                for filename in (CONFIG_NAME, SAFETENSORS_WEIGHTS_NAME):
+                    path = try_to_load_from_cache(repo_id, filename, cache_dir=cache_dir, revision=revision)
+                    register_cached_file(path, cache_dir=cache_dir)
+                return adapter
         except Exception as e:
             logger.warning(
                 f"Failed to load peft weights {repo_id} from HF Hub (retry in {delay:.0f} sec)", exc_info=True
@@ -126,6 +142,23 @@ def load_peft(
             time.sleep(delay)
 
 
+@dataclasses.dataclass(frozen=True)
+class PerRowAdapters:
+    """Adapters for a batch with different adapters in different rows, as set by using_adapter([...])"""
+
+    batch_size: int
+    groups: Tuple[Tuple[str, torch.Tensor], ...]  # (adapter name, indices of rows that use it), base model rows omitted
+
+    @classmethod
+    def from_sequence(cls, adapters: Sequence[Optional[str]]) -> "PerRowAdapters":
+        rows_by_adapter: Dict[str, List[int]] = {}
+        for row, adapter in enumerate(adapters):
+            if adapter:
+                rows_by_adapter.setdefault(adapter, []).append(row)
+        groups = tuple((adapter, torch.tensor(rows)) for adapter, rows in rows_by_adapter.items())
+        return cls(batch_size=len(adapters), groups=groups)
+
+
 class AdapterContextMixin:
     """A mixin that makes LoRA-wrapped linear layers obey an adapter set from context"""
 
@@ -134,7 +167,17 @@ class AdapterContextMixin:
 
     @staticmethod
     @contextlib.contextmanager
-    def using_adapter(active_adapter: Optional[str]):
+    def using_adapter(active_adapter: Optional[Union[str, Sequence[str]]]):
+        """
+        Run LoRA layers with a given adapter (or without adapters if None or ""). To process a batch where rows
+        use different adapters, pass a sequence with an adapter name (or "" for the base model) for each row:
+        the layers will compute base weights once and add each adapter's low-rank delta to its own rows only.
+        """
+        if active_adapter is not None and not isinstance(active_adapter, str):
+            if len(set(active_adapter)) == 1:
+                active_adapter = active_adapter[0]  # all rows share the same adapter, no need to split them
+            else:
+                active_adapter = PerRowAdapters.from_sequence(active_adapter)
         prev, AdapterContextMixin._context_active_adapter = AdapterContextMixin._context_active_adapter, active_adapter
         try:
             yield
@@ -151,6 +194,30 @@ class AdapterContextMixin:
     def active_adapter(self, value: Optional[str]):
         assert value == self.ADAPTER_NOT_SET, "active adapter can only be changed via .using_adapter" ""
 
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        per_row_adapters = self._context_active_adapter
+        if not isinstance(per_row_adapters, PerRowAdapters):
+            return super().forward(x)
+        if x.shape[0] != per_row_adapters.batch_size:
+            raise ValueError(
+                f"Layer {self} got inputs with {x.shape[0]} rows, but adapters were set for "
+                f"{per_row_adapters.batch_size} rows (per-row adapters need inputs with batch as the first dimension)"
+            )
+
+        with self.using_adapter(None):
+            result = super().forward(x)
+        if self.disable_adapters:
+            return result
+        for adapter, rows in per_row_adapters.groups:
+            if adapter not in self.lora_A.keys() or self.r[adapter] == 0:
+                continue
+            lora_A, lora_B = self.lora_A[adapter], self.lora_B[adapter]
+            rows = rows.to(x.device)
+            x_rows = x.index_select(0, rows).to(lora_A.weight.dtype)
+            output = lora_B(lora_A(self.lora_dropout[adapter](x_rows))) * self.scaling[adapter]
+            result.index_add_(0, rows, output.to(result.dtype))
+        return result
+
 
 using_adapter = AdapterContextMixin.using_adapter
 
@@ -159,21 +226,69 @@ class LoraLinear(AdapterContextMixin, lora.Linear):
     """LoRA linear layer that uses adapter selected via using_adapter"""
 
 
-class LoraLinear8bitLt(AdapterContextMixin, lora.Linear8bitLt):
-    """LoRA linear 8-bit with outliers that uses adapter selected via using_adapter"""
+@functools.lru_cache(maxsize=None)
+def _get_bnb_lora_classes() -> Tuple[type, type]:
+    """Define LoRA layers over bitsandbytes layers (peft defines their base classes only if bitsandbytes is installed)"""
+
+    class LoraLinear8bitLt(AdapterContextMixin, lora.Linear8bitLt):
+        """LoRA linear 8-bit with outliers that uses adapter selected via using_adapter"""
+
+    class LoraLinear4bit(AdapterContextMixin, lora.Linear4bit):
+        """LoRA linear 4-bit that uses adapter selected via using_adapter"""
+
+    return LoraLinear8bitLt, LoraLinear4bit
+
+
+class LoraCpuInt8Linear(AdapterContextMixin, lora.LoraLayer, CpuInt8Linear):
+    """LoRA over CpuInt8Linear that uses adapter selected via using_adapter"""
+
+    def __init__(self, adapter_name: str, in_features: int, out_features: int, bias: bool = True):
+        CpuInt8Linear.__init__(self, in_features, out_features, bias=bias)
+        lora.LoraLayer.__init__(self, in_features=in_features, out_features=out_features)
 
+    def update_layer(self, adapter_name, r, lora_alpha, lora_dropout, init_lora_weights):
+        # The same as LoraLayer.update_layer(), but this layer has no self.weight (int8 weights are packed separately),
+        # so we place adapters on the device of the weight scales instead
+        self.r[adapter_name], self.lora_alpha[adapter_name] = r, lora_alpha
+        self.lora_dropout[adapter_name] = nn.Dropout(p=lora_dropout) if lora_dropout > 0.0 else nn.Identity()
+        if r > 0:
+            device = self.weight_scale.device
+            self.lora_A[adapter_name] = nn.Linear(self.in_features, r, bias=False, device=device)
+            self.lora_B[adapter_name] = nn.Linear(r, self.out_features, bias=False, device=device)
+            self.scaling[adapter_name] = lora_alpha / r
+        if init_lora_weights:
+            self.reset_lora_parameters(adapter_name)
 
-class LoraLinear4bit(AdapterContextMixin, lora.Linear4bit):
-    """LoRA linear 4-bit that uses adapter selected via using_adapter"""
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        adapter = self.active_adapter
+        if isinstance(adapter, PerRowAdapters):
+            return super().forward(x)  # see AdapterContextMixin.forward
+        result = CpuInt8Linear.forward(self, x)
+
+        if self.disable_adapters or adapter not in self.lora_A.keys() or self.r[adapter] == 0:
+            return result
+        lora_A, lora_B = self.lora_A[adapter], self.lora_B[adapter]
+        output = lora_B(lora_A(self.lora_dropout[adapter](x.to(lora_A.weight.dtype)))) * self.scaling[adapter]
+        return result + output.to(result.dtype)
 
 
 def create_lora_adapter(block, quant_type: QuantType):
+    if quant_type in (QuantType.INT8, QuantType.NF4):
+        LoraLinear8bitLt, LoraLinear4bit = _get_bnb_lora_classes()
+
     for _, module in block.named_modules():
         for child_name, child in module.named_children():
             lora_wrapped_child = None
-            if not isinstance(child, (nn.Linear, bnb.nn.Linear8bitLt, bnb.nn.Linear4bit)):
+            if not isinstance(child, (nn.Linear, CpuInt8Linear)):  # bitsandbytes layers subclass nn.Linear
                 continue
-            if quant_type == QuantType.INT8:
+            if quant_type == QuantType.CPU_INT8:
+                lora_wrapped_child = LoraCpuInt8Linear(
+                    AdapterContextMixin.ADAPTER_NOT_SET,
+                    child.in_features,
+                    child.out_features,
+                    bias=child.bias is not None,
+                )
+            elif quant_type == QuantType.INT8:
                 kwargs = {
                     "has_fp16_weights": False,
                     "threshold": 6.0,
@@ -208,7 +323,11 @@ def create_lora_adapter(block, quant_type: QuantType):
                     bias=bias,
                 )
             if lora_wrapped_child:
-                lora_wrapped_child.weight = child.weight
+                if quant_type == QuantType.CPU_INT8:
+                    lora_wrapped_child.packed_params = child.packed_params
+                    lora_wrapped_child.weight_scale = child.weight_scale
+                else:
+                    lora_wrapped_child.weight = child.weight
                 lora_wrapped_child.bias = child.bias
                 for p in lora_wrapped_child.parameters():
                     p.requires_grad = False
@@ -222,7 +341,7 @@ def add_adapter_to_block(block, block_index, adapter_name, peft_config, peft_sta
 
     for _, module in block.named_modules():
         for child_name, child in module.named_children():
-            if not isinstance(child, (lora.Linear, lora.Linear8bitLt, lora.Linear4bit)):
+            if not isinstance(child, (lora.Linear, lora.Linear8bitLt, lora.Linear4bit, LoraCpuInt8Linear)):
                 continue
 
             if child_name in peft_config["target_modules"] or (
@@ -265,6 +384,36 @@ def add_adapter_to_block(block, block_index, adapter_name, peft_config, peft_sta
     logger.info(f"Loaded adapter {adapter_name} for block {block_index}")
 
 
+def merge_adapter_into_block(block, adapter_name: str):
+    """Fold a loaded adapter into base weights, replacing LoRA layers with regular linear layers"""
+    for _, module in block.named_modules():
+        for child_name, child in module.named_children():
+            if not isinstance(child, AdapterContextMixin):
+                continue
+            assert isinstance(child, LoraLinear), f"adapters can only be merged into non-quantized layers, got {child}"
+
+            weight = child.weight
+            if adapter_name in child.lora_A.keys() and child.r[adapter_name] > 0:
+                lora_A, lora_B = child.lora_A[adapter_name].weight, child.lora_B[adapter_name].weight
+                delta_weight = (lora_B.float() @ lora_A.float()) * child.scaling[adapter_name]
+                weight = nn.Parameter((weight.float() + delta_weight).to(weight.dtype), requires_grad=False)
+            merged_child = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None, device="meta")
+            merged_child.weight, merged_child.bias = weight, child.bias
+            setattr(module, child_name, merged_child)
+    logger.info(f"Merged adapter {adapter_name} into base weights")
+
+
+def remove_adapter_from_block(block, adapter_name):
+    """Unload an adapter previously loaded with add_adapter_to_block, freeing its weights"""
+    for module in block.modules():
+        if isinstance(module, AdapterContextMixin):
+            for adapter_params in (module.lora_A, module.lora_B, module.lora_dropout):
+                if adapter_name in adapter_params:
+                    del adapter_params[adapter_name]
+            for adapter_values in (module.r, module.lora_alpha, module.scaling):
+                adapter_values.pop(adapter_name, None)
+
+
 def estimate_adapter_memory_per_block(
     block_config: transformers.PretrainedConfig,
     torch_dtype: Optional[torch.dtype],
@@ -286,3 +435,18 @@ def estimate_adapter_memory_per_block(
         adapter_parameters = sum(p.numel() for p in block.parameters()) - base_block_parameters
     bytes_per_parameter = get_size_in_bytes(resolve_block_dtype(block_config, torch_dtype))
     return adapter_parameters * bytes_per_parameter
+
+
+def estimate_lora_memory_per_block(
+    block_config: transformers.PretrainedConfig, torch_dtype: Optional[torch.dtype], *, lora_rank: int
+) -> int:
+    """Get the number of extra bytes used by a LoRA adapter of a given rank applied to all linear layers of a block"""
+    with init_empty_weights(include_buffers=True):
+        block = get_model_block(block_config)
+        adapter_parameters = sum(
+            lora_rank * (module.in_features + module.out_features)
+            for module in block.modules()
+            if isinstance(module, nn.Linear)
+        )
+    bytes_per_parameter = get_size_in_bytes(resolve_block_dtype(block_config, torch_dtype))
+    return adapter_parameters * bytes_per_parameter
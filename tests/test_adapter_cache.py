@@ -0,0 +1,100 @@
+import json
+import os
+
+import pytest
+import torch
+import torch.nn as nn
+from safetensors.torch import save_file
+
+from peerz.server.adapter_cache import AdapterCache
+from peerz.server.block_utils import get_model_block
+from peerz.utils.auto_config import AutoDistributedConfig
+from peerz.utils.convert_block import QuantType, convert_block
+from peerz.utils.peft import (
+    AdapterContextMixin,
+    estimate_adapter_memory_per_block,
+    estimate_lora_memory_per_block,
+    is_adapter_cached,
+    using_adapter,
+)
+from test_utils import MODEL_NAME
+
+
+def _save_adapter_to_hf_cache(cache_dir: str, repo_id: str, target_module: str, config, block_index: int):
+    """Create an adapter in the HF cache layout, as if it was downloaded by load_peft()"""
+    commit_hash = "0" * 40
+    repo_dir = os.path.join(cache_dir, "models--" + repo_id.replace("/", "--"))
+    snapshot_dir = os.path.join(repo_dir, "snapshots", commit_hash)
+    os.makedirs(snapshot_dir)
+    os.makedirs(os.path.join(repo_dir, "refs"))
+    with open(os.path.join(repo_dir, "refs", "main"), "w") as f:
+        f.write(commit_hash)
+
+    rank, child_name = 4, target_module.split(".")[-1]
+    peft_config = dict(peft_type="LORA", r=rank, lora_alpha=8, lora_dropout=0.0, init_lora_weights=True)
+    with open(os.path.join(snapshot_dir, "adapter_config.json"), "w") as f:
+        json.dump(dict(peft_config, target_modules=[child_name]), f)
+    module = get_model_block(config, layer_idx=0).get_submodule(target_module)
+    prefix = f"base_model.model.model.layers.{block_index}.{target_module}"
+    save_file(
+        {
+            f"{prefix}.lora_A.weight": torch.randn(rank, module.in_features),
+            f"{prefix}.lora_B.weight": torch.randn(module.out_features, rank),
+        },
+        os.path.join(snapshot_dir, "adapter_model.safetensors"),
+    )
+
+
+@pytest.mark.forked
+def test_adapter_cache(tmp_path):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device = torch.device("cpu")
+    block = get_model_block(config, layer_idx=0).to(torch.float32)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, add_lora_layers=True)
+    target_module = next(
+        name for name, module in block.module_shards[0].named_modules() if isinstance(module, AdapterContextMixin)
+    )
+
+    cache_dir = str(tmp_path)
+    for repo_id in ["test/first", "test/second"]:
+        _save_adapter_to_hf_cache(cache_dir, repo_id, target_module, config, block_index=0)
+    assert is_adapter_cached("test/first", cache_dir=cache_dir)
+    assert not is_adapter_cached("test/missing", cache_dir=cache_dir)
+
+    adapter_cache = AdapterCache(1, cache_dir=cache_dir)
+    adapter_cache.add_block(0, block)
+    lora_module = block.module_shards[0].get_submodule(target_module)
+    dummy_input = torch.randn(1, 3, config.hidden_size)
+    with torch.inference_mode(), using_adapter(None):
+        base_output = block(dummy_input)[0]
+
+    adapter_cache.ensure_loaded("test/first")
+    assert adapter_cache.adapters == ("test/first",) and "test/first" in lora_module.lora_A
+    with torch.inference_mode(), using_adapter("test/first"):
+        assert not torch.allclose(block(dummy_input)[0], base_output)
+
+    adapter_cache.ensure_loaded(("", "test/second"))
+    assert adapter_cache.adapters == ("test/second",), "the least recently used adapter should be unloaded"
+    assert "test/first" not in lora_module.lora_A and "test/first" not in lora_module.scaling
+    with pytest.raises(ValueError):
+        adapter_cache.ensure_loaded(("test/first", "test/second"))
+    with pytest.raises(RuntimeError):
+        adapter_cache.ensure_loaded("test/missing")
+    assert adapter_cache.adapters == ("test/second",)
+
+
+@pytest.mark.forked
+def test_lora_memory_estimate(tmp_path, monkeypatch):
+    monkeypatch.setattr("peerz.utils.peft.check_peft_repository", lambda repo_id: True)  # Avoid accessing the Hub
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    cache_dir = str(tmp_path)
+    target_modules = [name for name, module in get_model_block(config).named_modules() if isinstance(module, nn.Linear)]
+    for i, target_module in enumerate(target_modules):
+        _save_adapter_to_hf_cache(cache_dir, f"test/adapter{i}", target_module, config, block_index=0)
+
+    # The rank of test adapters is 4, so an adapter of this rank applied to all linear layers has the same size
+    expected = sum(
+        estimate_adapter_memory_per_block(config, torch.float32, [f"test/adapter{i}"], cache_dir=cache_dir)
+        for i in range(len(target_modules))
+    )
+    assert estimate_lora_memory_per_block(config, torch.float32, lora_rank=4) == expected
@@ -1,12 +1,26 @@
+import multiprocessing as mp
 import subprocess
 import sys
+import threading
+import time
+from types import SimpleNamespace
 
 import pytest
 import torch
-from hivemind import nested_compare, nested_flatten
+import torch.nn as nn
+from hivemind import PeerID, nested_compare, nested_flatten
 
 from peerz import AutoDistributedConfig
-from peerz.server.throughput import measure_compute_rps
+from peerz.client.routing.sequence_info import RemoteSequenceInfo
+from peerz.client.routing.sequence_manager import RemoteSequenceManager, SequenceManagerState
+from peerz.data_structures import RemoteModuleInfo, ServerInfo, ServerState
+from peerz.server import autotune, throughput
+from peerz.server.block_selection import choose_standby_blocks
+from peerz.server.container import ModuleContainer, _load_in_background
+from peerz.server.served_blocks import ServedBlocks
+from peerz.server.standby_blocks import StandbyBlocks
+from peerz.server.throughput import measure_compute_rps, measure_inference_profile, summarize_inference_profile
+from peerz.server.throughput_monitor import ThroughputMonitor
 from peerz.utils.convert_block import QuantType
 from peerz.utils.misc import DUMMY, is_dummy
 from peerz.utils.packaging import pack_args_kwargs, unpack_args_kwargs
@@ -26,11 +40,18 @@ def test_bnb_not_imported_when_unnecessary():
     subprocess.check_call([sys.executable, "-c", "import peerz, sys; assert 'bitsandbytes' not in sys.modules"])
 
 
+def test_peft_utils_imported_without_bnb():
+    # peft defines LoRA layers for bitsandbytes only if it is installed, so we must not need them at import time
+    code = "import sys; sys.modules['bitsandbytes'] = None; import peerz.utils.peft"
+    subprocess.check_call([sys.executable, "-c", code])
+
+
 @pytest.mark.forked
 @pytest.mark.parametrize("inference", [False, True])
 @pytest.mark.parametrize("n_tokens", [1, 16])
 @pytest.mark.parametrize("tensor_parallel", [False, True])
-def test_compute_throughput(inference: bool, n_tokens: int, tensor_parallel: bool):
+@pytest.mark.parametrize("quant_type", [QuantType.NONE, QuantType.CPU_INT8])
+def test_compute_throughput(inference: bool, n_tokens: int, tensor_parallel: bool, quant_type: QuantType):
     config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
     if tensor_parallel and config.model_type != "bloom":
         pytest.skip("Tensor parallelism is implemented only for BLOOM for now")
@@ -40,7 +61,7 @@ def test_compute_throughput(inference: bool, n_tokens: int, tensor_parallel: boo
         config,
         device=torch.device("cpu"),
         dtype=torch.bfloat16,
-        quant_type=QuantType.NONE,
+        quant_type=quant_type,
         tensor_parallel_devices=tensor_parallel_devices,
         n_tokens=n_tokens,
         n_steps=5,
@@ -49,6 +70,148 @@ def test_compute_throughput(inference: bool, n_tokens: int, tensor_parallel: boo
     assert isinstance(compute_rps, float) and compute_rps > 0
 
 
+@pytest.mark.forked
+def test_inference_profile(monkeypatch):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    create_benchmark_block, kv_cache_positions = throughput._create_benchmark_block, set()
+
+    def create_block_with_spy(*args, **kwargs):
+        block = create_benchmark_block(*args, **kwargs)
+        forward = block.forward
+
+        def forward_with_spy(*args, kv_cache_position=None, **kwargs):
+            kv_cache_positions.add(kv_cache_position)
+            return forward(*args, kv_cache_position=kv_cache_position, **kwargs)
+
+        block.forward = forward_with_spy
+        return block
+
+    monkeypatch.setattr(throughput, "_create_benchmark_block", create_block_with_spy)
+    profile = measure_inference_profile(
+        config,
+        device=torch.device("cpu"),
+        dtype=torch.float32,
+        quant_type=QuantType.NONE,
+        tensor_parallel_devices=(),
+        batch_sizes=(1, 2),
+        num_new_tokens=(1, 4),
+        prefix_lengths=(0, 16),
+        n_steps=2,
+    )
+    assert len(profile) == 8 and all(point["step_time"] > 0 for point in profile)
+    assert kv_cache_positions == {0, 16}, "steps should write to preallocated caches like TransformerBackend does"
+
+    # The fitted model reproduces step times that grow linearly, and the summary can be announced in ServerInfo
+    for point in profile:
+        num_tokens = point["batch_size"] * point["num_new_tokens"]
+        point["step_time"] = 0.01 + 1e-3 * num_tokens + 1e-5 * point["batch_size"] * point["prefix_length"]
+    summary = summarize_inference_profile(profile)
+    assert summary == pytest.approx(dict(base=0.01, per_new_token=1e-3, per_cached_token=1e-5))
+    server_info = ServerInfo.from_tuple(ServerInfo(ServerState.ONLINE, 1.0, inference_profile=summary).to_tuple())
+
+    step_time = RemoteSequenceManager._estimate_step_time(
+        server_info, batch_size=2, prefix_length=1000, default_inference_rps=300
+    )
+    assert step_time == pytest.approx(0.01 + 2e-3 + 2e-2)
+    step_time = RemoteSequenceManager._estimate_step_time(
+        ServerInfo(ServerState.ONLINE, 1.0, inference_rps=50.0),
+        batch_size=2,
+        prefix_length=1000,
+        default_inference_rps=300,
+    )
+    assert step_time == pytest.approx(1 / 50), "servers without a profile are expected to use inference_rps"
+
+
+@pytest.mark.forked
+def test_autotune(tmp_path, monkeypatch):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    kwargs = dict(
+        quant_type=QuantType.NONE,
+        tensor_parallel_devices=(),
+        max_chunk_size_bytes=20 * 1024**2,
+        prefill_length=64,
+        cache_dir=str(tmp_path),
+    )
+    device = torch.device("cpu")
+    settings = autotune.get_autotuned_settings(MODEL_NAME, config, device, torch.float32, **kwargs)
+    assert settings["max_short_inference_tokens"] in autotune.SHORT_INFERENCE_TOKENS_CANDIDATES
+    assert settings["max_chunk_size_bytes"] in (16 * 1024**2, 20 * 1024**2)
+
+    # The measurements are cached, only the ones for new candidate sizes are taken
+    measured_chunk_sizes = []
+    measure_prefill_times = autotune.measure_prefill_times
+
+    def measure_and_record(*args, chunk_size_candidates, **kwargs):
+        measured_chunk_sizes.extend(chunk_size_candidates)
+        return measure_prefill_times(*args, chunk_size_candidates=chunk_size_candidates, **kwargs)
+
+    monkeypatch.setattr(autotune, "measure_prefill_times", measure_and_record)
+    assert autotune.get_autotuned_settings(MODEL_NAME, config, device, torch.float32, **kwargs) == settings
+    assert measured_chunk_sizes == []
+    kwargs["max_chunk_size_bytes"] = 32 * 1024**2
+    settings = autotune.get_autotuned_settings(MODEL_NAME, config, device, torch.float32, **kwargs)
+    assert measured_chunk_sizes == [32 * 1024**2] and settings["max_chunk_size_bytes"] <= 32 * 1024**2
+
+    # Like TransformerBackend.inference_step, benchmarks write new tokens into preallocated caches in place
+    block = throughput._create_benchmark_block(config, device, torch.float32, QuantType.NONE, ())
+    forward, kv_cache_positions = block.forward, []
+
+    def forward_with_spy(*args, kv_cache_position=None, **kwargs):
+        kv_cache_positions.append(kv_cache_position)
+        return forward(*args, kv_cache_position=kv_cache_position, **kwargs)
+
+    block.forward = forward_with_spy
+    autotune.measure_short_inference_step_times(
+        block, config, device, torch.float32, num_tokens_candidates=[1, 4], prefix_length=16, n_steps=1
+    )
+    assert set(kv_cache_positions) == {16}
+    kv_cache_positions.clear()
+    chunk_size_bytes = config.num_attention_heads * 4 * 64 * 16  # Prefills 64 tokens in chunks of 16 tokens
+    autotune.measure_prefill_times(
+        block, config, device, torch.float32, chunk_size_candidates=[chunk_size_bytes], prefill_length=64, n_repeats=1
+    )
+    assert kv_cache_positions == [0, 16, 32, 48] * 2
+
+    step_times = {1: 0.010, 2: 0.011, 4: 0.012, 8: 0.015, 16: 0.025, 32: 0.045}
+    assert autotune.choose_max_short_inference_tokens(step_times, max_slowdown=2.0) == 8
+    prefill_times = {16: 0.30, 32: 0.22, 64: 0.20, 128: 0.21}
+    assert autotune.choose_max_chunk_size_bytes(prefill_times, tolerance=0.05) == 64
+    assert autotune.choose_max_chunk_size_bytes(prefill_times, tolerance=0.15) == 32
+
+
+def test_routing_with_and_without_inference_profiles():
+    # The profiled server takes 1.1 ms per step for one sequence without a prefix, the other one takes 1.5 ms.
+    # Step times of both servers should grow with the batch size and the prefix length, so the first one stays faster
+    profiled_server_info = ServerInfo(
+        ServerState.ONLINE, 1.0, inference_profile=dict(base=1e-3, per_new_token=1e-4, per_cached_token=1e-7)
+    )
+    unprofiled_server_info = ServerInfo(ServerState.ONLINE, 1.0, inference_rps=1 / 1.5e-3)
+    profiled_peer_id, unprofiled_peer_id = PeerID(b"profiled"), PeerID(b"unprofiled")
+    block_uids = [f"model.{i}" for i in range(4)]
+    module_infos = [
+        RemoteModuleInfo(uid, {profiled_peer_id: profiled_server_info, unprofiled_peer_id: unprofiled_server_info})
+        for uid in block_uids
+    ]
+
+    sequence_manager = RemoteSequenceManager.__new__(RemoteSequenceManager)  # Avoids connecting to a swarm
+    sequence_manager.state = SequenceManagerState(sequence_info=RemoteSequenceInfo.make_empty(block_uids))
+    sequence_manager.state.sequence_info.update_(module_infos)
+    sequence_manager.ping_aggregator = SimpleNamespace(to_dict=dict)
+    sequence_manager.lock_changes = threading.Lock()
+
+    for batch_size, cache_tokens_needed in [(1, None), (8, 2048)]:
+        spans = sequence_manager._make_sequence_with_min_latency(
+            0, len(block_uids), cache_tokens_needed=cache_tokens_needed, batch_size=batch_size
+        )
+        assert [span.peer_id for span in spans] == [profiled_peer_id], batch_size
+
+    # Before, the unprofiled server was costed 1.5 ms regardless of the batch and was preferred for large batches
+    step_time_growth = RemoteSequenceManager._estimate_step_time_growth(
+        [profiled_server_info, unprofiled_server_info], batch_size=8, prefix_length=1024
+    )
+    assert step_time_growth == pytest.approx((1e-3 + 8e-4 + 8 * 1024 * 1e-7) / 1.1e-3)
+
+
 @pytest.mark.forked
 def test_pack_inputs():
     x = torch.ones(3)
@@ -73,3 +236,191 @@ def test_pack_inputs():
             assert torch.all(original == restored)
         else:
             assert original == restored
+
+
+def test_load_in_background():
+    num_running, max_running, loaded = 0, 0, []
+    lock = threading.Lock()
+
+    def load_fn(block_index: int) -> int:
+        nonlocal num_running, max_running
+        with lock:
+            num_running += 1
+            max_running = max(max_running, num_running)
+        time.sleep(0.05 if block_index % 2 else 0.01)  # Later blocks may be loaded before earlier ones
+        with lock:
+            num_running -= 1
+            loaded.append(block_index)
+        return block_index
+
+    assert list(_load_in_background(load_fn, range(10), num_workers=3)) == list(range(10))
+    assert 1 < max_running <= 3
+
+    loaded.clear()
+    blocks = _load_in_background(load_fn, range(10), num_workers=2)
+    assert next(blocks) == 0
+    blocks.close()
+    assert len(loaded) <= 3, "blocks that were not started yet should not be loaded after close()"
+
+
+@pytest.mark.forked
+def test_served_blocks():
+    served_blocks = ServedBlocks(["model.0", "model.1", "model.2"])
+    served_blocks.set_served(["model.0", "model.1"], True)
+    assert served_blocks.served_uids == ("model.0", "model.1") and "model.2" not in served_blocks
+    with pytest.raises(RuntimeError):
+        with served_blocks.use(["model.1", "model.2"]):
+            pass
+
+    request_started = mp.Event()
+
+    def process_request():
+        with served_blocks.use(["model.0", "model.1"]):
+            request_started.set()
+            time.sleep(1)
+
+    process = mp.get_context("fork").Process(target=process_request)
+    process.start()
+    request_started.wait()
+    served_blocks.set_served(["model.1"], False)
+    with pytest.raises(RuntimeError):
+        with served_blocks.use(["model.1"]):
+            pass
+
+    start_time = time.perf_counter()
+    served_blocks.wait_until_unused(["model.2"])
+    assert time.perf_counter() - start_time < 0.5
+    served_blocks.wait_until_unused(["model.1"], poll_interval=0.01)
+    assert time.perf_counter() - start_time > 0.5, "wait_until_unused() should wait for the request to finish"
+    process.join()
+
+
+@pytest.mark.forked
+def test_container_update_blocks():
+    class _StubBackend:
+        def __init__(self, module: nn.Module):
+            self.module, self.compiled_block = module, None
+
+        def replace_module(self, module: nn.Module):
+            self.module = module
+
+    loaded_indices, load_started = [], threading.Event()
+
+    def load_blocks(indices):
+        load_started.set()
+        for block_index in indices:
+            loaded_indices.append(block_index)
+            yield nn.Linear(1, 1)
+
+    # Blocks 0 and 1 are served, while the backends of blocks 2 and 3 use block 0 as a placeholder
+    blocks = [nn.Linear(1, 1), nn.Linear(1, 1)]
+    uids = [f"model.{i}" for i in range(4)]
+    container = ModuleContainer.__new__(ModuleContainer)
+    container.dht_prefix, container.adapter_cache = "model", None
+    container.module_backends = {uid: _StubBackend(blocks[i] if i < 2 else blocks[0]) for i, uid in enumerate(uids)}
+    container.block_indices, container._load_blocks = [0, 1], load_blocks
+    container.served_blocks = ServedBlocks(uids)
+    container.served_blocks.set_served(uids[:2], True)
+    container._loading_lock, container._loading_stopped, container._loading_failed = threading.Lock(), False, False
+    container.dht_announcer = SimpleNamespace(update_blocks=lambda *args, **kwargs: None)
+
+    with container.served_blocks.use(uids[:2]):  # An in-flight request
+        assert container.update_blocks([1, 2])
+        assert container.served_blocks.served_uids == ("model.1",), "the dropped block should not accept new requests"
+        assert not load_started.wait(timeout=0.5)
+        assert container.module_backends["model.0"].module is blocks[0], "the dropped block is still in use"
+
+    deadline = time.monotonic() + 10
+    while not container.is_fully_loaded() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert container.is_fully_loaded() and not container._loading_failed
+    assert container.served_blocks.served_uids == ("model.1", "model.2")
+    assert loaded_indices == [2], "the kept block should not be reloaded"
+    assert container.module_backends["model.1"].module is blocks[1]
+    assert all(container.module_backends[uid].module is blocks[1] for uid in ["model.0", "model.3"])
+
+
+def test_choose_standby_blocks():
+    local_peer_id, other_peer_id = PeerID(b"local"), PeerID(b"other")
+    spans = {local_peer_id: (2, 4, 1.0), other_peer_id: (0, 4, 2.0)}
+    module_infos = [
+        RemoteModuleInfo(
+            uid=f"model.{i}",
+            servers={
+                peer_id: ServerInfo(ServerState.ONLINE, throughput, start_block=start, end_block=end)
+                for peer_id, (start, end, throughput) in spans.items()
+                if start <= i < end
+            },
+        )
+        for i in range(8)
+    ]
+    # Without this server, blocks 4:8 have the lowest throughput, so blocks 4:6 are the most likely to be loaded
+    assert choose_standby_blocks(local_peer_id, module_infos) == [4, 5, 1, 0, 6, 7]
+    assert choose_standby_blocks(PeerID(b"unknown"), module_infos) == []
+
+
+def test_standby_blocks():
+    loaded = []
+
+    def load_block(block_index: int) -> nn.Module:
+        if block_index == 3:
+            raise RuntimeError("Failed to load block")
+        loaded.append(block_index)
+        return nn.Linear(4, 4, bias=False)  # 64 bytes
+
+    standby_blocks = StandbyBlocks(max_bytes=150)
+    assert standby_blocks.pop(0) is None and standby_blocks.num_misses == 0, "misses are not counted before update()"
+
+    standby_blocks.update([3, 1, 2, 0], load_block=load_block)
+    _wait_for(lambda: sorted(standby_blocks.block_indices) == [1, 2])
+    assert loaded == [1, 2], "blocks that do not fit into max_bytes should not be loaded"
+
+    block = standby_blocks.pop(1)
+    assert isinstance(block, nn.Linear) and standby_blocks.pop(1) is None
+    assert standby_blocks.num_hits == 1 and standby_blocks.num_misses == 1
+
+    standby_blocks.update([0, 4], load_block=load_block)
+    _wait_for(lambda: sorted(standby_blocks.block_indices) == [0, 4])
+    assert loaded == [1, 2, 0, 4], "block 2 should be unloaded to free space for the new preferred blocks"
+
+    standby_blocks.shutdown()
+    assert standby_blocks.block_indices == []
+
+
+def _wait_for(condition, timeout: float = 5):
+    start_time = time.perf_counter()
+    while not condition():
+        assert time.perf_counter() - start_time < timeout, "condition was not met in time"
+        time.sleep(0.01)
+
+
+def test_throughput_monitor():
+    throughput_info = dict(inference_rps=100.0, forward_rps=1000.0, network_rps=1e6, throughput=1000.0 / 2)
+    monitor = ThroughputMonitor(throughput_info, num_blocks=3, reachable_via_relay=False, time_constant=10)
+    server_info = ServerInfo(ServerState.ONLINE, **throughput_info)
+
+    # Steps that process prefixes and small forward batches don't show the capacity of the device, so they are ignored
+    monitor.record_inference_step(num_new_tokens=16, num_blocks=2, elapsed=1)
+    monitor.record_forward(num_tokens=8, num_blocks=2, elapsed=1)
+    assert monitor.averages == dict(inference_rps=100.0, forward_rps=1000.0)
+
+    for _ in range(2000):
+        monitor.record_inference_step(num_new_tokens=1, num_blocks=2, elapsed=0.04)  # 50 steps/sec per block
+        monitor.record_forward(num_tokens=1024, num_blocks=2, elapsed=1.0)  # 2048 tokens/sec per block
+    assert monitor.averages["inference_rps"] == pytest.approx(50, rel=0.01)
+    assert monitor.averages["forward_rps"] == pytest.approx(2048, rel=0.01)
+
+    # The announced values move towards the observed ones by at most max_change per update
+    monitor.update_server_info(server_info)
+    assert server_info.inference_rps == pytest.approx(100 / 1.25) and server_info.forward_rps == pytest.approx(1250)
+    assert server_info.throughput == pytest.approx(1250 / 2)
+    for _ in range(10):
+        monitor.update_server_info(server_info)
+    assert server_info.inference_rps == pytest.approx(50, rel=0.1)
+    assert server_info.forward_rps == pytest.approx(2048, rel=0.1)
+
+    # Small fluctuations don't change the announced values
+    announced_forward_rps = server_info.forward_rps
+    monitor.record_forward(num_tokens=1024, num_blocks=2, elapsed=0.9)
+    monitor.update_server_info(server_info)
+    assert server_info.forward_rps == announced_forward_rps
@@ -0,0 +1,355 @@
+import asyncio
+import http.server
+import multiprocessing as mp
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import hivemind
+import huggingface_hub
+import pytest
+import torch
+from hivemind import DHT, PeerID, get_dht_time
+from huggingface_hub.utils import reset_sessions
+from safetensors.torch import save_file
+
+from peerz.data_structures import RemoteModuleInfo, ServerInfo, ServerState
+from peerz.server import block_cache, block_weights
+from peerz.server.backend import TransformerBackend
+from peerz.server.block_cache import get_converted_block_path, load_quantized_block
+from peerz.server.block_weights import BlockWeightsClient, BlockWeightsSource, get_weights_hash, receive_block_weights
+from peerz.server.from_pretrained import _download_block_slice, _load_state_dict_from_repo_file, load_pretrained_block
+from peerz.server.handler import TransformerConnectionHandler
+from peerz.server.memory_cache import MemoryCache
+from peerz.utils.auto_config import AutoDistributedConfig
+from peerz.utils.convert_block import QuantType, convert_block
+from peerz.utils.dht import declare_active_modules
+from peerz.utils.disk_cache import (
+    BLOCK_SLICES_DIR,
+    CONVERTED_BLOCKS_DIR,
+    DEFAULT_CACHE_DIR,
+    free_disk_space_for,
+    register_cached_file,
+)
+from test_utils import MODEL_NAME
+
+requires_p2pd = pytest.mark.skipif(
+    not os.path.exists(os.path.join(os.path.dirname(hivemind.__file__), "hivemind_cli", "p2pd")),
+    reason="p2pd is not installed (it is built while installing hivemind)",
+)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("quant_type", [QuantType.NONE, QuantType.CPU_INT8])
+def test_converted_block_cache(tmp_path, quant_type: QuantType):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    cache_dir, device, torch_dtype = str(tmp_path), torch.device("cpu"), torch.float32
+    path = get_converted_block_path(
+        MODEL_NAME, 0, revision=None, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+    )
+    ref_block = load_pretrained_block(MODEL_NAME, 0, config=config, torch_dtype=torch_dtype)
+    ref_block = convert_block(ref_block, 0, config, (device,), device, quant_type=quant_type)
+
+    dummy_input = torch.randn(2, 5, config.hidden_size)
+    for _ in range(2):  # The first call converts the block and caches it, the second one loads it from the cache
+        block = load_quantized_block(
+            MODEL_NAME, 0, config=config, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+        )
+        assert os.path.exists(path)
+        block = convert_block(block, 0, config, (device,), device, quant_type=quant_type)
+        with torch.inference_mode():
+            assert torch.equal(block(dummy_input)[0], ref_block(dummy_input)[0])
+
+    # Converted blocks are evicted like other cached files
+    free_disk_space_for(1, cache_dir=cache_dir, max_disk_space=os.path.getsize(path))
+    assert not os.path.exists(path)
+
+
+@pytest.mark.forked
+def test_converted_blocks_share_memory(tmp_path, monkeypatch):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    cache_dir, torch_dtype, quant_type = str(tmp_path), torch.float32, QuantType.NONE
+    path = get_converted_block_path(
+        MODEL_NAME, 0, revision=None, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+    )
+
+    num_conversions = 0
+    orig_load_pretrained_block = block_cache.load_pretrained_block
+
+    def load_pretrained_block_slowly(*args, **kwargs):
+        nonlocal num_conversions
+        num_conversions += 1
+        time.sleep(0.5)
+        return orig_load_pretrained_block(*args, **kwargs)
+
+    monkeypatch.setattr(block_cache, "load_pretrained_block", load_pretrained_block_slowly)
+
+    # Servers loading the same block at the same time (here, threads) convert it once and both map the saved file
+    blocks = [None, None]
+
+    def load_block(i: int):
+        blocks[i] = load_quantized_block(
+            MODEL_NAME, 0, config=config, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+        )
+
+    threads = [threading.Thread(target=load_block, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert num_conversions == 1
+
+    mapped_ranges = []
+    with open("/proc/self/maps") as f:
+        for line in f:
+            if line.rstrip().endswith(os.path.realpath(path)):
+                begin, end = line.split()[0].split("-")
+                mapped_ranges.append((int(begin, 16), int(end, 16)))
+    for block in blocks:
+        for tensor in block.state_dict().values():
+            if tensor.numel() > 0:
+                assert any(begin <= tensor.data_ptr() < end for begin, end in mapped_ranges)
+
+
+def test_disk_cache_index(tmp_path):
+    cache_dir = str(tmp_path)
+    blocks_dir = tmp_path / CONVERTED_BLOCKS_DIR
+    blocks_dir.mkdir()
+
+    paths = [blocks_dir / f"block{i}.safetensors" for i in range(4)]
+    now = time.time()
+    for i, path in enumerate(paths):
+        path.write_bytes(b"0" * 100)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+        if i < 3:
+            register_cached_file(str(path), cache_dir=cache_dir)  # paths[3] is saved after the index is built
+
+    os.utime(paths[0])  # Files read after they were indexed are not the least recently used ones anymore
+    free_disk_space_for(100, cache_dir=cache_dir, max_disk_space=300)
+    assert [path.exists() for path in paths] == [True, False, True, True]
+
+    # The index is rebuilt if it lacks files to remove, so paths[3] is accounted for and removed too
+    with pytest.raises(RuntimeError):
+        free_disk_space_for(450, cache_dir=cache_dir, max_disk_space=400)
+    assert not any(path.exists() for path in paths)
+
+
+class _RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in for the HF Hub that serves files from memory and supports range requests only"""
+
+    def do_GET(self):
+        data = self.server.files[self.path]
+        if getattr(self.server, "max_range_requests", None) is not None:
+            if self.server.max_range_requests == 0:  # Starts ignoring the Range header
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.server.max_range_requests -= 1
+        begin, end = map(int, re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups())
+        chunk = data[begin : end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {begin}-{begin + len(chunk) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(chunk)))
+        self.end_headers()
+        self.wfile.write(chunk)
+        self.server.bytes_sent += len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.forked
+def test_block_slice_download(tmp_path, monkeypatch):
+    tensors = {}
+    for i in range(4):
+        tensors[f"model.layers.{i}.weight"] = torch.randn(64, 64)
+        tensors[f"model.layers.{i}.bias"] = torch.randn(3).half()  # Tests alignment of tensors with other dtypes
+        tensors[f"model.layers.{i}.empty"] = torch.empty(0)
+    shard_path = str(tmp_path / "model.safetensors")
+    save_file(tensors, shard_path, metadata={"format": "pt"})
+    with open(shard_path, "rb") as f:
+        shard = f.read()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeRequestHandler)
+    server.files, server.bytes_sent = {"/test/repo/resolve/main/model.safetensors": shard}, 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        huggingface_hub.file_download,
+        "HUGGINGFACE_CO_URL_TEMPLATE",
+        f"http://127.0.0.1:{server.server_port}/{{repo_id}}/resolve/{{revision}}/{{filename}}",
+    )
+    monkeypatch.setattr(huggingface_hub.constants, "HF_HUB_OFFLINE", False)
+    reset_sessions()
+
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(2):  # The first call downloads the block's tensors, the second one loads them from the cache
+        state_dict = _load_state_dict_from_repo_file(
+            "test/repo", "model.safetensors", block_prefix="model.layers.1.", cache_dir=cache_dir, delay=0
+        )
+        assert state_dict.keys() == {key for key in tensors if key.startswith("model.layers.1.")}
+        for key, tensor in state_dict.items():
+            assert tensor.dtype == tensors[key].dtype and torch.equal(tensor, tensors[key])
+        assert server.bytes_sent < len(shard) / 3, "the server should send only the tensors of one block"
+    server.shutdown()
+
+    slice_paths = list((tmp_path / "cache" / BLOCK_SLICES_DIR).rglob("*.safetensors"))
+    assert [path.name for path in slice_paths] == ["model.layers.1.model.safetensors"]
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("max_range_requests", [1, 2])
+def test_block_slice_download_without_range_support(tmp_path, monkeypatch, max_range_requests: int):
+    save_file({"model.layers.0.weight": torch.randn(8, 8)}, str(tmp_path / "model.safetensors"))
+    with open(tmp_path / "model.safetensors", "rb") as f:
+        shard = f.read()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RangeRequestHandler)
+    server.files, server.bytes_sent = {"/model.safetensors": shard}, 0
+    server.max_range_requests = max_range_requests  # The server ignores the Range header after that many requests
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(huggingface_hub.constants, "HF_HUB_OFFLINE", False)
+    reset_sessions()
+
+    path = str(tmp_path / "slice.safetensors")
+    url = f"http://127.0.0.1:{server.server_port}/model.safetensors"
+    downloaded = _download_block_slice(
+        url, path, "model.layers.0.", token=None, cache_dir=str(tmp_path), max_disk_space=None
+    )
+    server.shutdown()
+    assert not downloaded, "the caller should fall back to downloading the whole file"
+    assert not os.path.exists(path) and not os.path.exists(path + ".tmp")
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("torch_dtype", [None, torch.bfloat16])
+def test_block_weights_transfer(tmp_path, torch_dtype):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    cache_dir, quant_type = DEFAULT_CACHE_DIR, None
+    if torch_dtype is not None:  # Test sending a converted block
+        cache_dir, quant_type = str(tmp_path), QuantType.NONE
+        load_quantized_block(
+            MODEL_NAME, 0, config=config, torch_dtype=torch_dtype, quant_type=quant_type, cache_dir=cache_dir
+        )
+    else:
+        load_pretrained_block(MODEL_NAME, 0, config=config)  # Makes sure that the original weights are cached
+
+    source = BlockWeightsSource(MODEL_NAME, block_prefix=config.block_prefix, revision=None, cache_dir=cache_dir)
+    kwargs = {}
+    if torch_dtype is not None:
+        kwargs = dict(torch_dtype=str(torch_dtype).replace("torch.", ""), quant_type=quant_type.name.lower())
+    ref_state_dict = source.load_state_dict(0, **kwargs)
+
+    state_dict, expected_hash = asyncio.run(receive_block_weights(source.iterate_responses(0, **kwargs)))
+    assert state_dict.keys() == ref_state_dict.keys()
+    for key, tensor in state_dict.items():
+        assert tensor.dtype == ref_state_dict[key].dtype and torch.equal(tensor, ref_state_dict[key])
+    assert get_weights_hash(state_dict) == expected_hash
+
+    state_dict[next(iter(state_dict))].view(-1)[0] += 1
+    assert get_weights_hash(state_dict) != expected_hash
+
+    with pytest.raises(FileNotFoundError):
+        source.load_state_dict(1, torch_dtype="float16", quant_type="none")
+
+
+@pytest.mark.forked
+def test_block_weights_verification(monkeypatch):
+    good_weights, poisoned_weights = {"weight": torch.ones(2, 2)}, {"weight": torch.zeros(2, 2)}
+    good_peers, evil_peer = [PeerID(b"good1"), PeerID(b"good2")], PeerID(b"evil")
+
+    def get_state_dict(weights_by_peer, hash_by_peer=None, **kwargs):
+        hash_by_peer = hash_by_peer or {
+            peer_id: get_weights_hash(weights) for peer_id, weights in weights_by_peer.items()
+        }
+        server_info = ServerInfo(ServerState.ONLINE, 1.0, shares_block_weights=True)
+        module_info = RemoteModuleInfo(uid="test.0", servers={peer_id: server_info for peer_id in weights_by_peer})
+        monkeypatch.setattr(block_weights, "get_remote_module_infos", lambda *args, **kwargs: [module_info])
+
+        client = BlockWeightsClient(SimpleNamespace(peer_id=PeerID(b"local")), "test", **kwargs)
+
+        async def get_hash(peer_id, uid, metadata):
+            return hash_by_peer[peer_id]
+
+        async def download(peer_id, uid, metadata):
+            return weights_by_peer[peer_id], hash_by_peer[peer_id]
+
+        client._get_hash, client._download = get_hash, download
+        return client.get_state_dict(0)
+
+    for _ in range(5):  # Peers are shuffled, so we try several times
+        weights_by_peer = {**{peer_id: good_weights for peer_id in good_peers}, evil_peer: poisoned_weights}
+        assert get_state_dict(weights_by_peer) is good_weights
+    assert get_state_dict({good_peers[0]: good_weights, evil_peer: poisoned_weights}) is None  # No agreement
+    assert get_state_dict({good_peers[0]: good_weights}) is None
+
+    # Trusted peers are used without asking other peers, but the hash still protects from corruption in transfer
+    weights_by_peer = {good_peers[0]: good_weights, evil_peer: poisoned_weights}
+    assert get_state_dict(weights_by_peer, trusted_peers=[good_peers[0]]) is good_weights
+    hash_by_peer = {good_peers[0]: get_weights_hash(poisoned_weights), evil_peer: get_weights_hash(poisoned_weights)}
+    assert get_state_dict(weights_by_peer, hash_by_peer, trusted_peers=[good_peers[0]]) is None
+
+
+@requires_p2pd
+@pytest.mark.forked
+def test_block_weights_loopback():
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device, dht_prefix = torch.device("cpu"), "test_block_weights"
+    uid = f"{dht_prefix}.0"
+    block = load_pretrained_block(MODEL_NAME, 0, config=config, torch_dtype=torch.float32)
+    block = convert_block(block, 0, config, (device,), device, QuantType.NONE, freeze=True)
+    schema = hivemind.BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=torch.float32)
+    backend = TransformerBackend(
+        uid,
+        block,
+        config=config,
+        memory_cache=MemoryCache(max_size_bytes=2**20, max_alloc_timeout=1),
+        backend_dtype=torch.float32,
+        max_chunk_size_bytes=2**30,
+        args_schema=(schema,),
+        kwargs_schema={},
+        outputs_schema=(schema,),
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+    source = BlockWeightsSource(
+        MODEL_NAME, block_prefix=config.block_prefix, revision=None, cache_dir=DEFAULT_CACHE_DIR
+    )
+    ref_state_dict = source.load_state_dict(0)
+
+    sharing_dht = DHT(start=True)
+    handler = TransformerConnectionHandler(
+        sharing_dht,
+        {uid: backend},
+        adapters=(),
+        dht_prefix=dht_prefix,
+        handler_event_queues=[mp.Queue()],
+        handler_index=0,
+        block_weights=source,
+        inference_max_length=2048,
+        request_timeout=60,
+        session_timeout=60,
+        step_timeout=60,
+        quant_type=QuantType.NONE,
+    )
+    handler.run_in_background(await_ready=True)
+    server_info = ServerInfo(ServerState.ONLINE, 1.0, shares_block_weights=True)
+    declare_active_modules(sharing_dht, [uid], server_info, expiration_time=get_dht_time() + 60)
+
+    loading_dht = DHT(initial_peers=sharing_dht.get_visible_maddrs(), client_mode=True, start=True)
+    try:
+        # A single untrusted peer is not enough to verify the weights
+        assert BlockWeightsClient(loading_dht, dht_prefix).get_state_dict(0) is None
+
+        client = BlockWeightsClient(loading_dht, dht_prefix, trusted_peers=[sharing_dht.peer_id])
+        state_dict = client.get_state_dict(0)
+        assert state_dict is not None and state_dict.keys() == ref_state_dict.keys()
+        for key, tensor in state_dict.items():
+            assert torch.equal(tensor, ref_state_dict[key]), key
+    finally:
+        handler.terminate()
+        loading_dht.shutdown()
+        sharing_dht.shutdown()
@@ -0,0 +1,80 @@
+import random
+
+import numpy as np
+import pytest
+from hivemind import PeerID
+
+from peerz.data_structures import RemoteModuleInfo, ServerInfo, ServerState
+from peerz.server import block_selection
+
+
+def _choose_best_start_reference(throughputs: np.ndarray, num_blocks: int) -> int:
+    # The straightforward implementation that _choose_best_start() must be equivalent to
+    options = ((sorted(throughputs[i : i + num_blocks]), i) for i in range(0, len(throughputs) - num_blocks + 1))
+    return min(options)[-1]
+
+
+def _make_module_infos(spans: dict, *, total_blocks: int):
+    return [
+        RemoteModuleInfo(
+            uid=f"model.{i}",
+            servers={
+                peer_id: ServerInfo(ServerState.ONLINE, throughput, start_block=start, end_block=end)
+                for peer_id, (start, end, throughput) in spans.items()
+                if start <= i < end
+            },
+        )
+        for i in range(total_blocks)
+    ]
+
+
+def test_sliding_window_min():
+    rng = np.random.default_rng(0)
+    for length in range(1, 30):
+        values = rng.integers(0, 5, size=length)
+        for window_size in range(1, length + 1):
+            expected = [values[i : i + window_size].min() for i in range(length - window_size + 1)]
+            assert block_selection._sliding_window_min(values, window_size).tolist() == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_choose_best_start_matches_reference(seed: int):
+    rng = np.random.default_rng(seed)
+    for _ in range(200):
+        total_blocks = int(rng.integers(1, 40))
+        num_blocks = int(rng.integers(1, total_blocks + 1))
+        if rng.random() < 0.5:
+            throughputs = rng.integers(0, 4, size=total_blocks).astype(np.float64)  # Many ties
+        else:
+            throughputs = rng.random(total_blocks) * rng.integers(0, 2, size=total_blocks)
+        assert block_selection._choose_best_start(throughputs, num_blocks) == _choose_best_start_reference(
+            throughputs, num_blocks
+        )
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_block_selection_matches_reference(seed: int, monkeypatch):
+    rng = random.Random(seed)
+    for _ in range(20):
+        total_blocks = rng.randint(4, 30)
+        spans = {}
+        for i in range(rng.randint(1, 15)):
+            length = rng.randint(1, total_blocks)
+            start = rng.randint(0, total_blocks - length)
+            spans[PeerID(f"peer{i}".encode())] = (start, start + length, float(rng.choice([1, 2, 3, rng.random()])))
+        module_infos = _make_module_infos(spans, total_blocks=total_blocks)
+        local_peer_id = rng.choice(list(spans))
+        num_blocks = rng.randint(1, total_blocks)
+
+        results = []
+        for choose_best_start in [block_selection._choose_best_start, _choose_best_start_reference]:
+            monkeypatch.setattr(block_selection, "_choose_best_start", choose_best_start)
+            np.random.seed(seed)  # should_choose_other_blocks() shuffles servers in its simulation
+            results.append(
+                (
+                    block_selection.choose_best_blocks(num_blocks, module_infos),
+                    block_selection.choose_standby_blocks(local_peer_id, module_infos),
+                    block_selection.should_choose_other_blocks(local_peer_id, module_infos, balance_quality=0.75),
+                )
+            )
+        assert results[0] == results[1]
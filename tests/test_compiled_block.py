@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from peerz.server.block_utils import get_model_block
+from peerz.server.compiled_block import CompiledBlock, _get_bucket, enable_compile_cache
+from peerz.utils.auto_config import AutoDistributedConfig
+from peerz.utils.convert_block import QuantType, convert_block
+from test_utils import MODEL_NAME
+
+
+def test_get_bucket():
+    buckets = (1, 2, 4, 8)
+    assert [_get_bucket(value, buckets) for value in [1, 2, 3, 5, 8, 9]] == [1, 2, 4, 8, 8, None]
+
+
+@pytest.mark.forked
+def test_compiled_block(tmp_path):
+    enable_compile_cache(str(tmp_path), num_blocks=1)
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device = torch.device("cpu")
+    block = get_model_block(config, layer_idx=0).to(torch.float32)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+    compiled_block = CompiledBlock(block, seq_len_buckets=(1, 4, 16), batch_size_buckets=(1, 4))
+
+    head_dim = config.hidden_size // config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads // config.num_key_value_groups)
+    batch_size, max_length = 2, 24
+    caches = [
+        (
+            torch.zeros(batch_size * num_kv_heads, head_dim, max_length),
+            torch.zeros(batch_size * num_kv_heads, max_length, head_dim),
+        )
+        for _ in range(2)
+    ]
+
+    position = 0
+    with torch.inference_mode():
+        for length in [3, 1, 1, 12, 1]:
+            dummy_input = torch.randn(batch_size, length, config.hidden_size)
+            output = compiled_block.inference_step(dummy_input, caches[0], kv_cache_position=position)
+            ref_output, _ = block(dummy_input, layer_past=caches[1], use_cache=True, kv_cache_position=position)
+            position += length
+            assert output.shape == ref_output.shape
+            assert torch.allclose(output, ref_output, atol=1e-5), length
+            (key_cache, value_cache), (ref_key_cache, ref_value_cache) = caches
+            assert torch.allclose(key_cache[:, :, :position], ref_key_cache[:, :, :position], atol=1e-5)
+            assert torch.allclose(value_cache[:, :position], ref_value_cache[:, :position], atol=1e-5)
+
+    with torch.no_grad():
+        for batch_size, length in [(3, 5), (1, 20)]:
+            dummy_input = torch.randn(batch_size, length, config.hidden_size)
+            output = compiled_block.forward(dummy_input)
+            (ref_output,) = block(dummy_input)
+            assert output.shape == ref_output.shape
+            assert torch.allclose(output, ref_output, atol=1e-5)
+
+
+@pytest.mark.forked
+def test_compiled_block_fallback():
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device = torch.device("cpu")
+    block = get_model_block(config, layer_idx=0).to(torch.float32)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+    compiled_block = CompiledBlock(block, seq_len_buckets=(1, 4, 16), batch_size_buckets=(1, 4))
+
+    def failing_forward(*args, **kwargs):
+        raise torch._dynamo.exc.Unsupported("test failure")
+
+    compiled_block._compiled_forward = failing_forward
+    with torch.no_grad():
+        for _ in range(2):
+            dummy_input = torch.randn(3, 5, config.hidden_size)
+            (ref_output,) = block(dummy_input)
+            assert torch.allclose(compiled_block.forward(dummy_input), ref_output, atol=1e-5)
+    assert compiled_block._compiled_forward is None, "the block should run eagerly after a compile failure"
@@ -1,6 +1,8 @@
 import pytest
 import torch
+from safetensors.torch import save_file
 
+from peerz.server import from_pretrained
 from peerz.server.block_utils import resolve_block_dtype
 from peerz.server.from_pretrained import load_pretrained_block
 from peerz.utils.auto_config import AutoDistributedConfig
@@ -14,3 +16,25 @@ def test_block_dtype(torch_dtype):
     block = load_pretrained_block(MODEL_NAME, 0, config=config, torch_dtype=torch_dtype)
     expected_dtype = resolve_block_dtype(config, torch_dtype)
     assert all(param.dtype == expected_dtype for param in block.parameters())
+
+
+@pytest.mark.parametrize("torch_dtype", [torch.float32, torch.bfloat16])
+def test_mmapped_state_dict(tmp_path, monkeypatch, torch_dtype: torch.dtype):
+    monkeypatch.setattr(from_pretrained, "CAST_CHUNK_BYTES", 1000)  # Cast large tensors in several chunks
+    ref_state_dict = {
+        "h.0.large": torch.randn(5000),
+        "h.0.bf16": torch.randn(3, 7).to(torch.bfloat16),
+        "h.0.int": torch.arange(10),
+        "h.0.empty": torch.zeros(0, 4),
+        "h.1.other_block": torch.randn(4),
+    }
+    path = str(tmp_path / "model.safetensors")
+    save_file(ref_state_dict, path)
+
+    state_dict = from_pretrained._load_state_dict_from_local_file(path, block_prefix="h.0.", torch_dtype=torch_dtype)
+    assert state_dict.keys() == {key for key in ref_state_dict if key.startswith("h.0.")}
+    for key, tensor in state_dict.items():
+        ref_tensor = ref_state_dict[key]
+        expected_dtype = torch_dtype if ref_tensor.dtype.is_floating_point else ref_tensor.dtype
+        assert tensor.dtype == expected_dtype and tensor.shape == ref_tensor.shape, key
+        assert torch.equal(tensor, ref_tensor.to(expected_dtype)), key
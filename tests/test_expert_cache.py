@@ -0,0 +1,58 @@
+import pytest
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors.torch import save_file
+from transformers import MixtralConfig
+
+from peerz.models.mixtral.block import OptimizedMixtralSparseMoeBlock
+from peerz.server.expert_cache import ExpertCache
+from peerz.server.from_pretrained import _load_state_dict_from_local_file
+
+
+def test_expert_cache_lru():
+    cache = ExpertCache(max_size_bytes=3 * 1024)
+    make_weights = lambda: [torch.zeros(256)]  # 1 KiB
+
+    for key in [0, 1, 2, 0, 3]:
+        cache.get(key, make_weights)
+    assert 0 in cache and 2 in cache and 3 in cache and 1 not in cache, "expert 1 is the least recently used one"
+    assert cache.current_size_bytes == 3 * 1024
+    assert cache.hit_rate == 1 / 5
+
+    weights = cache.get("large", lambda: [torch.zeros(1024)])
+    assert weights[0].shape == (1024,) and "large" not in cache, "entries larger than the budget are not cached"
+    assert cache.current_size_bytes == 3 * 1024
+
+
+@pytest.mark.parametrize("checkpoint_dtype", [torch.float32, torch.bfloat16])
+def test_mmapped_experts(tmp_path, checkpoint_dtype: torch.dtype):
+    torch.manual_seed(0)
+    config = MixtralConfig(hidden_size=32, intermediate_size=48, num_local_experts=8, num_experts_per_tok=2)
+    ref_moe = OptimizedMixtralSparseMoeBlock(config).to(checkpoint_dtype)
+    path = str(tmp_path / "model.safetensors")
+    save_file({key: value.contiguous() for key, value in ref_moe.state_dict().items()}, path)
+
+    is_expert_param = lambda param_name: param_name.startswith("experts.")
+    state_dict = _load_state_dict_from_local_file(path, mmap_filter=is_expert_param)
+    state_dict = {key: value if is_expert_param(key) else value.float() for key, value in state_dict.items()}
+    with init_empty_weights():
+        moe = OptimizedMixtralSparseMoeBlock(config)
+    for param_name, param in state_dict.items():
+        set_module_tensor_to_device(moe, param_name, "cpu", value=param, dtype=param.dtype)
+    cache = ExpertCache(max_size_bytes=3 * 3 * config.hidden_size * config.intermediate_size * 4)
+    moe.set_expert_cache(cache, prefix=0)
+    assert moe.experts[0].w1.weight.dtype == checkpoint_dtype
+
+    hidden_states = torch.randn(2, 16, config.hidden_size)
+    ref_moe = ref_moe.float()
+    for _ in range(2):
+        with torch.inference_mode():
+            output, _ = moe(hidden_states)
+            ref_output, _ = ref_moe(hidden_states)
+        assert torch.allclose(output, ref_output, atol=1e-5)
+    assert 0 < cache.current_size_bytes <= cache.max_size_bytes
+
+    hidden_states.requires_grad_(True)
+    moe(hidden_states)[0].sum().backward()
+    assert hidden_states.grad is not None
@@ -0,0 +1,153 @@
+import time
+
+import pytest
+import torch
+from hivemind import BatchTensorDescriptor
+
+from peerz.server.activation_cache import ActivationCache
+from peerz.server.backend import TransformerBackend, _MergedBackwardStep, _MergedForwardStep
+from peerz.server.from_pretrained import load_pretrained_block
+from peerz.server.memory_cache import MemoryCache
+from peerz.utils.auto_config import AutoDistributedConfig
+from peerz.utils.convert_block import QuantType, convert_block
+from peerz.utils.misc import DUMMY
+from peerz.utils.peft import AdapterContextMixin
+from test_utils import MODEL_NAME
+
+
+def _make_backends(num_blocks: int, *, add_lora_layers: bool = False, **kwargs):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    memory_cache = MemoryCache(max_size_bytes=2**20, max_alloc_timeout=1)
+    devices = [torch.device("cpu")]
+    schema = BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=torch.float32)
+
+    backends = {}
+    for block_index in range(min(num_blocks, config.num_hidden_layers)):
+        block = load_pretrained_block(MODEL_NAME, block_index, config=config, torch_dtype=torch.float32)
+        block = convert_block(
+            block,
+            block_index,
+            config,
+            devices,
+            devices[0],
+            QuantType.NONE,
+            freeze=True,
+            add_lora_layers=add_lora_layers,
+        )
+        uid = f"test.{block_index}"
+        backends[uid] = TransformerBackend(
+            uid,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=torch.float32,
+            args_schema=(schema,),
+            kwargs_schema={},
+            outputs_schema=(schema,),
+            min_batch_size=1,
+            max_batch_size=2048,
+            **kwargs,
+        )
+    return config, backends
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("max_chunk_size_bytes", [2**30, 1])
+@pytest.mark.parametrize("max_backward_activation_bytes", [2**30, 1, 0])
+@pytest.mark.parametrize("step_id", [None, "step"])
+def test_merged_span_steps(max_chunk_size_bytes: int, max_backward_activation_bytes: int, step_id: str):
+    torch.manual_seed(0)
+    activation_cache = ActivationCache(max_size_bytes=2**30, timeout=60)
+    config, backends = _make_backends(
+        3,
+        max_chunk_size_bytes=max_chunk_size_bytes,
+        max_backward_activation_bytes=max_backward_activation_bytes,
+        activation_cache=activation_cache,
+    )
+    uids = tuple(backends.keys())
+    batch_size, seq_length, pre_seq_length = 3, 7, 2
+
+    inputs = torch.randn(batch_size, seq_length, config.hidden_size)
+    prompts = torch.randn(len(uids), batch_size, pre_seq_length, config.hidden_size)
+    grad_outputs = torch.randn(batch_size, seq_length, config.hidden_size)
+
+    inputs_ref = inputs.clone().requires_grad_(True)
+    prompts_ref = prompts.clone().requires_grad_(True)
+    hidden_states = inputs_ref
+    for i, backend in enumerate(backends.values()):
+        hidden_states = torch.cat(
+            [hidden_states[:, :pre_seq_length] + prompts_ref[i], hidden_states[:, pre_seq_length:]], dim=1
+        )
+        hidden_states = backend.forward_with_grad(hidden_states, "")
+    hidden_states.backward(grad_outputs)
+
+    split_prompts = [p.squeeze(0) for p in prompts.split(1, dim=0)]
+    (outputs,) = _MergedForwardStep(backends)(inputs.clone(), "", uids, step_id, *split_prompts)
+    assert torch.allclose(outputs, hidden_states, atol=1e-5)
+
+    grad_inputs, grad_prompts = _MergedBackwardStep(backends)(
+        inputs.clone(), grad_outputs, "", uids, step_id, *split_prompts
+    )
+    assert torch.allclose(grad_inputs, inputs_ref.grad, atol=1e-5)
+    assert torch.allclose(grad_prompts, prompts_ref.grad, atol=1e-5)
+    assert activation_cache.current_size_bytes == 0
+    assert activation_cache.hit_rate == (1.0 if step_id is not None else 0.0)
+
+
+@pytest.mark.forked
+@pytest.mark.parametrize("max_backward_activation_bytes", [2**30, 0])
+def test_merged_span_steps_with_per_row_adapters(max_backward_activation_bytes: int):
+    torch.manual_seed(0)
+    # max_chunk_size_bytes=1 splits the batch into chunks of one row each
+    config, backends = _make_backends(
+        2, add_lora_layers=True, max_chunk_size_bytes=1, max_backward_activation_bytes=max_backward_activation_bytes
+    )
+    for backend in backends.values():
+        for module in backend.module.modules():
+            if isinstance(module, AdapterContextMixin):
+                for adapter in ["first", "second"]:
+                    module.update_layer(adapter, r=4, lora_alpha=8, lora_dropout=0.0, init_lora_weights=True)
+                    torch.nn.init.normal_(module.lora_B[adapter].weight, std=0.1)
+    uids = tuple(backends.keys())
+    adapters = ("first", "", "second")
+    inputs = torch.randn(len(adapters), 5, config.hidden_size)
+    grad_outputs = torch.randn(len(adapters), 5, config.hidden_size)
+    dummy_prompts = [DUMMY] * len(uids)
+
+    (outputs,) = _MergedForwardStep(backends)(inputs.clone(), adapters, uids, None, *dummy_prompts)
+    grad_inputs, _ = _MergedBackwardStep(backends)(inputs.clone(), grad_outputs, adapters, uids, None, *dummy_prompts)
+    for i, adapter in enumerate(adapters):
+        inputs_ref = inputs[i : i + 1].clone().requires_grad_(True)
+        hidden_states = inputs_ref
+        for backend in backends.values():
+            hidden_states = backend.forward_with_grad(hidden_states, adapter)
+        hidden_states.backward(grad_outputs[i : i + 1])
+        assert torch.allclose(outputs[i : i + 1], hidden_states, atol=1e-5), adapter
+        assert torch.allclose(grad_inputs[i : i + 1], inputs_ref.grad, atol=1e-5), adapter
+
+
+def test_activation_cache():
+    cache = ActivationCache(max_size_bytes=3 * 4 * 100, timeout=0.5)
+    block_inputs = [torch.randn(1, 10, 10) for _ in range(2)]
+    prompts = [torch.randn(1, 2, 10), torch.randn(1, 2, 10)]
+
+    assert cache.store("a", block_inputs, prompts)
+    assert cache.current_size_bytes == 2 * 4 * 100
+    assert cache.take("a", block_inputs[0] + 1, prompts) is None  # different inputs
+    assert cache.current_size_bytes == 0
+
+    assert cache.store("a", block_inputs, prompts)
+    assert cache.store("b", block_inputs, prompts)  # evicts "a" since the cache can hold only 3 tensors
+    assert not cache.store("c", block_inputs * 2, prompts)  # does not fit at all
+    assert cache.take("a", block_inputs[0], prompts) is None
+    assert cache.take("b", block_inputs[0], prompts[::-1]) is None  # different prompts
+
+    assert cache.store("b", block_inputs, prompts)
+    entry = cache.take("b", block_inputs[0].clone(), [prompt.clone() for prompt in prompts])
+    assert entry is not None and entry.block_inputs[1] is block_inputs[1]
+    assert cache.take("b", block_inputs[0], prompts) is None  # entries are used only once
+
+    assert cache.store("c", block_inputs, prompts)
+    time.sleep(0.6)
+    assert cache.take("c", block_inputs[0], prompts) is None  # expired
+    assert cache.current_size_bytes == 0